@@ -0,0 +1,150 @@
+import math
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+import models
+from job_queue import CLASS_PRIORITIES, JOB_CLASSES, QUEUED, RUNNING, job_class
+
+# Queued jobs per class beyond which new requests are turned away.
+MAX_QUEUE_DEPTH = {
+    "interactive": int(os.getenv("MAX_INTERACTIVE_QUEUE_DEPTH", "50")),
+    "bulk": int(os.getenv("MAX_BULK_QUEUE_DEPTH", "100")),
+}
+
+# Story generations and regenerations one user may have waiting at once.
+MAX_QUEUED_JOBS_PER_USER = int(os.getenv("MAX_QUEUED_JOBS_PER_USER", "3"))
+MAX_QUEUED_REGENERATIONS_PER_USER = int(
+    os.getenv("MAX_QUEUED_REGENERATIONS_PER_USER", "5")
+)
+
+# Recently started jobs used for wait and run time estimates.
+RECENT_JOBS = 50
+
+# Assumed run time before any job of a class has finished.
+DEFAULT_RUN_SECONDS = 10.0
+
+# Retry-After bounds in seconds.
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 600
+
+
+class QueueFull(Exception):
+    """A generation request was turned away; retry after ``retry_after`` s."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def class_kinds(name: str) -> List[str]:
+    return [kind for kind, cls in JOB_CLASSES.items() if cls == name]
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands timezone-aware columns back naive.
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _count(db: Session, name: str, status: str, owner_id: Optional[int] = None):
+    query = db.query(models.GenerationJob.id).filter(
+        models.GenerationJob.kind.in_(class_kinds(name)),
+        models.GenerationJob.status == status,
+    )
+    if owner_id is not None:
+        query = query.filter(models.GenerationJob.owner_id == owner_id)
+    return query.count()
+
+
+def _recent_durations(db: Session, name: str) -> Dict[str, List[float]]:
+    """Wait (queued -> started) and run (started -> finished) seconds."""
+    jobs = (
+        db.query(models.GenerationJob)
+        .filter(
+            models.GenerationJob.kind.in_(class_kinds(name)),
+            models.GenerationJob.started_at.isnot(None),
+        )
+        .order_by(models.GenerationJob.started_at.desc())
+        .limit(RECENT_JOBS)
+        .all()
+    )
+    waits, runs = [], []
+    for job in jobs:
+        started = _as_utc(job.started_at)
+        if job.created_at:
+            waits.append((started - _as_utc(job.created_at)).total_seconds())
+        if job.finished_at:
+            runs.append((_as_utc(job.finished_at) - started).total_seconds())
+    return {"wait": waits, "run": runs}
+
+
+def _p95(values: List[float]) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+
+def estimate_retry_after(db: Session, name: str, jobs: int) -> int:
+    """Seconds for ``jobs`` more jobs of a class to finish, going by the
+    recent mean run time."""
+    runs = _recent_durations(db, name)["run"]
+    mean_run = sum(runs) / len(runs) if runs else DEFAULT_RUN_SECONDS
+    seconds = math.ceil(max(1, jobs) * mean_run)
+    return int(min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, seconds)))
+
+
+def check_admission(db: Session, kind: str, owner_id: Optional[int] = None):
+    """Raise ``QueueFull`` if a new ``kind`` job should not be queued now."""
+    name = job_class(kind)
+
+    depth = _count(db, name, QUEUED)
+    if depth >= MAX_QUEUE_DEPTH[name]:
+        raise QueueFull(
+            "The generation queue is full, please try again shortly",
+            estimate_retry_after(db, name, depth - MAX_QUEUE_DEPTH[name] + 1),
+        )
+
+    if owner_id is not None:
+        queued = _count(db, name, QUEUED, owner_id)
+        if name == "bulk" and queued >= MAX_QUEUED_JOBS_PER_USER:
+            raise QueueFull(
+                "You already have stories waiting to be generated",
+                estimate_retry_after(db, name, 1),
+            )
+        if name == "interactive" and queued >= MAX_QUEUED_REGENERATIONS_PER_USER:
+            raise QueueFull(
+                "You already have images waiting to be regenerated",
+                estimate_retry_after(db, name, 1),
+            )
+
+
+def queue_stats(db: Session) -> Dict[str, dict]:
+    """Queue depth and wait times per job class."""
+    now = datetime.now(timezone.utc)
+    stats = {}
+    for name in CLASS_PRIORITIES:
+        oldest = (
+            db.query(models.GenerationJob.created_at)
+            .filter(
+                models.GenerationJob.kind.in_(class_kinds(name)),
+                models.GenerationJob.status == QUEUED,
+            )
+            .order_by(models.GenerationJob.created_at)
+            .first()
+        )
+        durations = _recent_durations(db, name)
+        waits = durations["wait"]
+        stats[name] = {
+            "queued": _count(db, name, QUEUED),
+            "running": _count(db, name, RUNNING),
+            "max_queued": MAX_QUEUE_DEPTH[name],
+            "oldest_queued_seconds": (
+                (now - _as_utc(oldest[0])).total_seconds() if oldest else 0.0
+            ),
+            "wait_seconds_mean": sum(waits) / len(waits) if waits else None,
+            "wait_seconds_p95": _p95(waits),
+        }
+    return stats
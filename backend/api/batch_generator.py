@@ -1,122 +1,668 @@
-from diffusers import (
-    StableDiffusionXLPipeline,
-    StableDiffusionXLAdapterPipeline,
-    AutoencoderKL,
-    UniPCMultistepScheduler,
-    T2IAdapter,
-)
-import torch, os
 from PIL import Image
+import os
 from io import BytesIO
+from uuid import uuid4
 import models
 from database import SessionLocal
 from text_processor import get_resolved_sentences, detect_and_translate_to_english
-from s3 import upload_image_to_s3
-from diffusers.utils import load_image
+from s3 import download_image_from_s3, upload_image_to_s3
 import random
-from controlnet_aux import OpenposeDetector
-import numpy as np
+from batching import (
+    REFINE_STRENGTH,
+    REGENERATE_MAX_BATCH,
+    chunked,
+    pick_batch_size,
+    sentence_seed,
+)
+from job_queue import (
+    REPLACED,
+    JobCancelled,
+    enqueue_job,
+    get_job,
+    update_job_payload,
+    update_job_progress,
+)
+from sqlalchemy.exc import IntegrityError
+import result_cache
+from result_cache import cache_key
+from pose_cache import PoseNotFound, load_source as load_pose_source, pose_cache
+from generation_backend import get_backend, refine_steps
+from timing import stage
+from metrics import IMAGES, STORY_IMAGES, diffusion_call
+from derivatives import derivative_urls, encode_derivatives, placeholder
+from panel_writer import BackgroundStage, PANEL_UPLOAD_WORKERS
+
+STYLE_PROMPT = "Storyboard sketch of {}, black and white, cinematic, high quality"
+NEGATIVE_PROMPT = (
+    "ugly, deformed, disfigured, poor details, bad anatomy, abstract, bad physics"
+)
+NUM_INFERENCE_STEPS = 30
+GUIDANCE_SCALE = 8.5
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Draft previews: few steps at a fraction of the final resolution. They are
+# stored as provisional images and re-rendered at full quality by a
+# follow-up "finalize" job.
+DRAFT_INFERENCE_STEPS = int(os.getenv("DRAFT_INFERENCE_STEPS", "8"))
+DRAFT_SCALE = float(os.getenv("DRAFT_SCALE", "0.5"))
 
-vae = AutoencoderKL.from_pretrained(
-    "madebyollin/sdxl-vae-fp16-fix", use_safetensors=True
-).to(device, dtype=torch.float32)
+POSE_DETECT_RESOLUTION = 512
+POSE_IMAGE_RESOLUTION = 1024
 
-pipe = StableDiffusionXLPipeline.from_pretrained(
-    "stabilityai/stable-diffusion-xl-base-1.0",
-    vae=vae,
 
-    variant="fp16",
-    use_safetensors=True,
-).to(device, dtype=torch.float32)
+def model_version(steps: int = NUM_INFERENCE_STEPS, draft: bool = False) -> str:
+    """Part of every result cache key; anything that changes pixels for the
+    same caption and seed belongs here."""
+    version = f"{get_backend().model_version}|steps={steps}|cfg={GUIDANCE_SCALE}"
+    return f"{version}|draft={DRAFT_SCALE}" if draft else version
 
-pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
-pipe.enable_model_cpu_offload()
 
-# Load LoRA weights
-pipe.load_lora_weights(
-    "safetensors/Storyboard_sketch.safetensors", adapter_name="sketch"
-)
-pipe.load_lora_weights("safetensors/anglesv2.safetensors", adapter_name="angles")
-pipe.set_adapters(["sketch", "angles"], adapter_weights=[0.5, 0.5])
+def progress_callback(
+    db, job_id: int, completed: int, total: int, steps: int = NUM_INFERENCE_STEPS
+):
+    """Step callback that records denoising progress on the job row.
+
+    Raises ``JobCancelled`` once the job was cancelled, which stops the
+    pipeline between two denoising steps.
+    """
+    if job_id is None:
+        return None
+
+    def on_step(step: int):
+        running = update_job_progress(
+            db,
+            job_id,
+            completed=completed,
+            total=total,
+            step=step,
+            steps=steps,
+        )
+        if not running:
+            raise JobCancelled(job_id)
+
+    return on_step
+
+
+def extract_pose_map(db, pose_id: str, pose_img: Image.Image = None) -> Image.Image:
+    """OpenPose skeleton for a pose upload, cached on disk by pose id.
+
+    Uploads not cached on this host are read from the database; raises
+    ``PoseNotFound`` if it has none either.
+    """
+    skeleton = pose_cache.get_skeleton(
+        pose_id, POSE_DETECT_RESOLUTION, POSE_IMAGE_RESOLUTION
+    )
+    if skeleton is not None:
+        return skeleton
+
+    if pose_img is not None:
+        pose_cache.put_source(pose_id, pose_img)
+    else:
+        pose_img = pose_cache.get_source(pose_id)
+        if pose_img is None:
+            pose_img = load_pose_source(db, pose_id)
+            if pose_img is None:
+                raise PoseNotFound(pose_id)
+            pose_cache.put_source(pose_id, pose_img)
+
+    with stage("pose_detect"):
+        image = get_backend().detect_pose(
+            pose_img, POSE_DETECT_RESOLUTION, POSE_IMAGE_RESOLUTION
+        )
+    pose_cache.put_skeleton(
+        pose_id, POSE_DETECT_RESOLUTION, POSE_IMAGE_RESOLUTION, image
+    )
+    return image
 
-generator = torch.Generator(device)
 
+RESOLUTIONS = {
+    "16:9": (1024, 576),
+    "1:1": (1024, 1024),
+    "9:16": (576, 1024),
+}
 
-openpose = OpenposeDetector.from_pretrained("lllyasviel/ControlNet")
 
-adapter = T2IAdapter.from_pretrained(
-    "TencentARC/t2i-adapter-openpose-sdxl-1.0", torch_dtype=torch.float16
-)
+def get_dimensions(resolution: str) -> tuple[int, int]:
+    return RESOLUTIONS.get(resolution, (1024, 1024))
+
+
+def render_settings(resolution: str, draft: bool = False) -> tuple[int, int, int]:
+    """Width, height and denoising steps for a final render or a draft."""
+    width, height = get_dimensions(resolution)
+    if not draft:
+        return width, height, NUM_INFERENCE_STEPS
+
+    # SDXL needs dimensions divisible by 8.
+    def scale(size):
+        return max(8, int(size * DRAFT_SCALE) // 8 * 8)
+
+    return scale(width), scale(height), DRAFT_INFERENCE_STEPS
+
+
+def warmup_sizes() -> list[tuple[int, int]]:
+    """Every (width, height) a final render or a draft can run at."""
+    return sorted(
+        {
+            render_settings(resolution, draft)[:2]
+            for resolution in RESOLUTIONS
+            for draft in (False, True)
+        }
+    )
+
+
+def warmup_pose_sizes() -> list[tuple[int, int]]:
+    """The square pose maps a final render or a draft runs at."""
+    return sorted(
+        {
+            (side, side)
+            for side in (POSE_IMAGE_RESOLUTION, render_settings("1:1", True)[0])
+        }
+    )
+
+
+def warmup_refine_sizes() -> list[tuple[int, int]]:
+    """Refinements always run at the final render size."""
+    return sorted({get_dimensions(resolution) for resolution in RESOLUTIONS})
+
+
+def warmup_plan(backend) -> dict[str, list[tuple[int, int, int]]]:
+    """``(width, height, images per replica)`` each pipeline is warmed at.
+
+    Stories and finalize passes send micro-batches sized by
+    ``pick_batch_size``; regenerations send up to ``REGENERATE_MAX_BATCH``
+    images spread over the replicas; a lone regeneration or the last panel
+    of a story sends one.
+    """
+    free_bytes = backend.free_memory_bytes()
+    regenerate = -(-REGENERATE_MAX_BATCH // backend.replicas)
+
+    def with_batches(sizes, story=False):
+        return [
+            (width, height, batch)
+            for width, height in sizes
+            for batch in sorted(
+                {1, regenerate}
+                | ({pick_batch_size(width, height, free_bytes)} if story else set())
+            )
+        ]
+
+    return {
+        "text_to_image": with_batches(warmup_sizes(), story=True),
+        "pose_to_image": with_batches(warmup_pose_sizes()),
+        "image_to_image": with_batches(warmup_refine_sizes()),
+    }
 
-posepipe = StableDiffusionXLAdapterPipeline.from_pretrained(
-    "stabilityai/stable-diffusion-xl-base-1.0",
-    adapter=adapter,
-    vae=vae,
-    variant="fp16",
-    use_safetensors=True,
-).to(device, dtype=torch.float32)
 
-posepipe.enable_model_cpu_offload()
-posepipe.scheduler = UniPCMultistepScheduler.from_config(posepipe.scheduler.config)
+def load_source_image(image_path: str, width: int, height: int) -> Image.Image:
+    """The current panel a refinement starts from, at the render size."""
+    with stage("fetch_source"):
+        data = download_image_from_s3(image_path)
+    return Image.open(BytesIO(data)).convert("RGB").resize((width, height))
 
-posepipe.load_lora_weights(
-    "safetensors/Storyboard_sketch.safetensors", adapter_name="sketch"
-)
-posepipe.load_lora_weights("safetensors/anglesv2.safetensors", adapter_name="angles")
-posepipe.set_adapters(["sketch", "angles"], adapter_weights=[0.5, 0.5])
 
+def encode_and_upload(
+    image: Image.Image, filename: str, folder: str
+) -> tuple[str, str]:
+    """Upload every derivative of ``image``.
 
-def get_dimensions(resolution: str) -> tuple[int, int]:
-    resolution_map = {
-        "16:9": (1024, 576),
-        "1:1": (1024, 1024),
-        "9:16": (576, 1024),
+    Returns the full-size JPEG URL and the inline placeholder for the row.
+    """
+    with stage("encode"):
+        encoded = list(encode_derivatives(image, filename))
+        preview = placeholder(image)
+
+    # One token per image, so every derivative shares the full image's key.
+    token = uuid4().hex
+    with stage("upload"):
+        urls = [
+            upload_image_to_s3(
+                data, name, folder=folder, content_type=content_type, token=token
+            )
+            for name, data, content_type in encoded
+        ]
+    return urls[0], preview
+
+
+def enqueue_finalize(db, storyboard_id: int, resolution: str, panels: list[dict]):
+    """Queue full-quality renders to replace freshly stored drafts."""
+    storyboard = (
+        db.query(models.Storyboard)
+        .filter(models.Storyboard.id == storyboard_id)
+        .first()
+    )
+    if storyboard is None:
+        # Deleted along with its drafts.
+        return None
+    return enqueue_job(
+        db,
+        "finalize",
+        {"resolution": resolution, "panels": panels},
+        storyboard_id=storyboard_id,
+        owner_id=storyboard.owner_id if storyboard else None,
+    )
+
+
+def resume_state(db, job_id: int) -> tuple[list[str], dict]:
+    """Sentences and already saved panels of an earlier attempt of a job.
+
+    Returns ``(None, {})`` for a job that has not got that far yet.
+    """
+    if job_id is None:
+        return None, {}
+    job = get_job(db, job_id)
+    sentences = (job.payload or {}).get("sentences") if job else None
+    saved = {
+        image.sentence_index: image
+        for image in db.query(models.Image).filter(models.Image.job_id == job_id)
     }
-    return resolution_map.get(resolution, (1024, 1024))
+    if saved:
+        print(f"[Info] Resuming job {job_id}: {len(saved)} panels already saved")
+    return sentences, saved
+
+
+def save_panel(db, db_image: models.Image) -> models.Image:
+    """Insert a story panel once per (job, sentence).
+
+    If another attempt of the same job saved the sentence first, that row
+    is returned instead.
+    """
+    with stage("db_commit"):
+        db.add(db_image)
+        try:
+            db.commit()  # Commit after each image
+            return db_image
+        except IntegrityError:
+            db.rollback()
+    return (
+        db.query(models.Image)
+        .filter(
+            models.Image.job_id == db_image.job_id,
+            models.Image.sentence_index == db_image.sentence_index,
+        )
+        .one()
+    )
 
 
-def generate_batch_images(story: str, storyboard_id: int, resolution: str = "1:1"):
+def generate_batch_images(
+    story: str,
+    storyboard_id: int,
+    resolution: str = "1:1",
+    seed: int = None,
+    job_id: int = None,
+    draft: bool = False,
+) -> list[dict]:
     db = SessionLocal()
+    panels = []
     try:
-        prompts = get_resolved_sentences(story)
-        width, height = get_dimensions(resolution)
-
-        for num, prompt in enumerate(prompts):
-            result = pipe(
-                prompt=f"Storyboard sketch of {prompt}, black and white, cinematic, high quality",
-                negative_prompt="ugly, deformed, disfigured, poor details, bad anatomy, abstract, bad physics",
-                guidance_scale=8.5,
-                height=height,
-                width=width,
-                num_inference_steps=30,
-                generator=generator,
+        prompts, saved = resume_state(db, job_id)
+        if prompts is None:
+            prompts = get_resolved_sentences(story)
+            if job_id is not None:
+                # Kept with the job so a resumed attempt renders exactly the
+                # same sentences, even if translation would now differ.
+                update_job_payload(db, job_id, sentences=prompts)
+        width, height, steps = render_settings(resolution, draft)
+        backend = get_backend()
+        version = model_version(steps, draft)
+        seed = seed if seed is not None else random.randint(0, 2**32 - 1)
+        # Micro-batches are sized per replica; a replica pool splits each
+        # one across its idle replicas.
+        batch_size = backend.replicas * pick_batch_size(
+            width, height, backend.free_memory_bytes()
+        )
+
+        seeds = [sentence_seed(seed, prompt) for prompt in prompts]
+        keys = [
+            cache_key(prompt, image_seed, resolution, version)
+            for prompt, image_seed in zip(prompts, seeds)
+        ]
+
+        # Reuse cached renders, and render each distinct sentence only once
+        # even if it appears several times in the story.
+        rendered = {}
+        placeholders = {}
+        pending = []
+        pending_keys = set()
+        for num, key in enumerate(keys):
+            if num in saved:
+                rendered.setdefault(key, saved[num].image_path)
+                placeholders.setdefault(key, saved[num].placeholder)
+                continue
+            if key in rendered or key in pending_keys:
+                continue
+            entry = result_cache.lookup_entry(db, key)
+            if entry:
+                rendered[key] = entry.image_path
+                placeholders[key] = entry.placeholder
+            else:
+                pending.append((num, key))
+                pending_keys.add(key)
+
+        completed = 0
+
+        def save_ready_panels(session):
+            # Panels are committed in story order as soon as they exist.
+            nonlocal completed
+            while completed < len(prompts) and (
+                completed in saved or keys[completed] in rendered
+            ):
+                db_image = saved.get(completed)
+                if db_image is None:
+                    db_image = save_panel(
+                        session,
+                        models.Image(
+                            storyboard_id=storyboard_id,
+                            image_path=rendered[keys[completed]],
+                            derivatives=derivative_urls(rendered[keys[completed]]),
+                            placeholder=placeholders.get(keys[completed]),
+                            caption=prompts[completed],
+                            seed=seeds[completed],
+                            is_draft=draft,
+                            job_id=job_id,
+                            sentence_index=completed,
+                        ),
+                    )
+                panels.append(
+                    {
+                        "image_id": db_image.id,
+                        "prompt": prompts[completed],
+                        "seed": seeds[completed],
+                        "image_path": db_image.image_path,
+                    }
+                )
+                completed += 1
+
+        save_ready_panels(db)
+
+        # Encoding, uploading and saving happen on background threads while
+        # the next micro-batch denoises. Uploads run in parallel; one persist
+        # thread with its own session writes the rows in story order.
+        writer_db = SessionLocal()
+
+        def persist(item):
+            key, s3_url, preview = item
+            placeholders[key] = preview
+            rendered[key] = s3_url
+            result_cache.store(writer_db, key, s3_url, preview)
+            save_ready_panels(writer_db)
+
+        def upload(item):
+            num, key, image = item
+            s3_url, preview = encode_and_upload(
+                image, f"image_{num + 1}.jpg", f"storyboards/{storyboard_id}"
             )
+            persister.submit((key, s3_url, preview))
+
+        try:
+            with BackgroundStage(persist, name="persist") as persister, BackgroundStage(
+                upload, PANEL_UPLOAD_WORKERS, name="upload"
+            ) as uploader:
+                # All sentences share the resolution, negative prompt and
+                # guidance, so they run as micro-batches; each sentence gets
+                # its own generator.
+                for batch in chunked(pending, batch_size):
+                    with diffusion_call(steps, len(batch)):
+                        images = backend.text_to_image(
+                            [STYLE_PROMPT.format(prompts[num]) for num, _ in batch],
+                            NEGATIVE_PROMPT,
+                            [seeds[num] for num, _ in batch],
+                            width,
+                            height,
+                            steps,
+                            GUIDANCE_SCALE,
+                            on_step=progress_callback(
+                                db, job_id, completed, len(prompts), steps
+                            ),
+                        )
+
+                    # Blocks while the upload queue is full.
+                    for (num, key), image in zip(batch, images):
+                        uploader.submit((num, key, image))
+        finally:
+            writer_db.close()
+
+        STORY_IMAGES.observe(len(panels))
+        IMAGES.inc(len(pending), source="rendered")
+        IMAGES.inc(len(panels) - len(saved) - len(pending), source="cache")
+
+        if draft and panels:
+            enqueue_finalize(db, storyboard_id, resolution, panels)
+
+        return panels
+
+    except JobCancelled:
+        db.rollback()
+        # Drafts saved before a new story replaced this one stay on the
+        # storyboard, so they still get their full-quality pass. A story
+        # cancelled outright is not rendered again.
+        job = get_job(db, job_id) if job_id is not None else None
+        if draft and panels and job and job.error == REPLACED:
+            enqueue_finalize(db, storyboard_id, resolution, panels)
+        raise
+    except Exception as e:
+        print(f"Error during image generation: {e}")
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
-            image = result.images[0]
-            buf = BytesIO()
-            image.save(buf, format="JPEG")
-            buf.seek(0)
 
-            s3_url = upload_image_to_s3(
-                buf.read(),
-                f"image_{num + 1}.jpg",
-                folder=f"storyboards/{storyboard_id}",
+def _render_single_images(
+    db,
+    pending: list[dict],
+    resolution: str,
+    draft: bool,
+    isOpenPose: bool,
+    strength: float = None,
+):
+    """Render every cache miss of a regeneration batch in one backend call.
+
+    With ``strength`` set the misses are refinements of their current panel.
+    """
+    backend = get_backend()
+    width, height, steps = render_settings(resolution, draft)
+    run_steps = steps if strength is None else refine_steps(steps, strength)
+    callbacks = {
+        item["job_id"]: progress_callback(db, item["job_id"], 0, 1, run_steps)
+        for item in pending
+        if item["job_id"] is not None
+    }
+    cancelled = set()
+
+    def on_step(step: int):
+        # Cancelled jobs drop out of the batch; the pipeline only stops once
+        # nobody is waiting for any of its images.
+        for job_id, callback in callbacks.items():
+            if job_id in cancelled:
+                continue
+            try:
+                callback(step)
+            except JobCancelled:
+                cancelled.add(job_id)
+        if len(cancelled) == len(pending):
+            raise JobCancelled(pending[0]["job_id"])
+
+    prompts = [STYLE_PROMPT.format(item["prompt"]) for item in pending]
+    seeds = [item["seed"] for item in pending]
+
+    with diffusion_call(run_steps, len(pending)):
+        if strength is not None:
+            images = backend.image_to_image(
+                prompts,
+                NEGATIVE_PROMPT,
+                seeds,
+                [item["source_image"] for item in pending],
+                strength,
+                steps,
+                GUIDANCE_SCALE,
+                on_step=on_step if callbacks else None,
             )
-
-            db_image = models.Image(
-                storyboard_id=storyboard_id, image_path=s3_url, caption=prompt
+        elif isOpenPose:
+            images = backend.pose_to_image(
+                prompts,
+                NEGATIVE_PROMPT,
+                seeds,
+                [item["pose_map"] for item in pending],
+                steps,
+                GUIDANCE_SCALE,
+                on_step=on_step if callbacks else None,
+            )
+        else:
+            images = backend.text_to_image(
+                prompts,
+                NEGATIVE_PROMPT,
+                seeds,
+                width,
+                height,
+                steps,
+                GUIDANCE_SCALE,
+                on_step=on_step if callbacks else None,
             )
-            db.add(db_image)
-            db.commit()  # Commit after each image
-            db.refresh(
-                db_image
-            )  # Optional, in case you want to return/use it immediately
+
+    for item, image in zip(pending, images):
+        if item["job_id"] in cancelled:
+            item["cancelled"] = True
+            continue
+        db_image = item["db_image"]
+        item["image_path"], item["placeholder"] = encode_and_upload(
+            image,
+            f"image_{db_image.id}.jpg",
+            f"storyboards/{db_image.storyboard_id}",
+        )
+        result_cache.store(db, item["key"], item["image_path"], item["placeholder"])
+
+
+def generate_single_images(requests: list[dict]) -> list:
+    """Regenerate several panels with one batched diffusion call.
+
+    Every request holds the keyword arguments of ``generate_single_image``
+    and must share its resolution, pose/text pipeline and draft flag with
+    the others. Returns one entry per request: the updated image row, or the
+    exception that request failed with, so a bad request does not take its
+    neighbours down with it.
+
+    Requests with ``mode="refine"`` (which must also share their
+    ``strength``) start from the panel's current image instead of noise.
+    """
+    first = requests[0]
+    resolution = first.get("resolution", "1:1")
+    isOpenPose = first.get("isOpenPose", False)
+    draft = first.get("draft", False)
+    strength = None
+    if first.get("mode") == "refine":
+        strength = first.get("strength") or REFINE_STRENGTH
+
+    results = [None] * len(requests)
+    pending = []
+    db = SessionLocal()
+    try:
+        width, height, steps = render_settings(resolution, draft)
+        version = model_version(steps, draft)
+
+        for index, request in enumerate(requests):
+            try:
+                # Get existing image record
+                image_id = request["image_id"]
+                db_image = (
+                    db.query(models.Image).filter(models.Image.id == image_id).first()
+                )
+                if not db_image:
+                    raise ValueError(f"Image with id {image_id} not found.")
+
+                with stage("translate"):
+                    prompt = detect_and_translate_to_english(request["caption"])
+                seed = request.get("seed")
+                seed = seed if seed is not None else random.randint(0, 2**32 - 1)
+                pose_id = request.get("pose_id") if isOpenPose else None
+                source = None
+                if strength is not None:
+                    if not db_image.image_path:
+                        raise ValueError(f"Image {image_id} has nothing to refine.")
+                    source = f"{db_image.image_path}@{strength:g}"
+                key = cache_key(prompt, seed, resolution, version, pose_id, source)
+
+                entry = result_cache.lookup_entry(db, key)
+                item = {
+                    "index": index,
+                    "db_image": db_image,
+                    "caption": request["caption"],
+                    "prompt": prompt,
+                    "seed": seed,
+                    "pose_id": pose_id,
+                    "key": key,
+                    "job_id": request.get("job_id"),
+                    # Same caption, seed, resolution and pose as an earlier
+                    # render: point at the stored object instead.
+                    "image_path": entry.image_path if entry else None,
+                    "placeholder": entry.placeholder if entry else None,
+                }
+                if item["image_path"] is None and strength is not None:
+                    item["source_image"] = load_source_image(
+                        db_image.image_path, width, height
+                    )
+                elif item["image_path"] is None and isOpenPose:
+                    pose_map = extract_pose_map(db, pose_id, request.get("pose_img"))
+                    if draft:
+                        side = render_settings("1:1", draft)[0]
+                        pose_map = pose_map.resize((side, side))
+                    item["pose_map"] = pose_map
+                pending.append(item)
+            except Exception as e:
+                print(f"Error during image regeneration: {e}")
+                db.rollback()
+                results[index] = e
+
+        misses = [item for item in pending if item["image_path"] is None]
+        if misses:
+            _render_single_images(db, misses, resolution, draft, isOpenPose, strength)
+        IMAGES.inc(len(misses), source="rendered")
+        IMAGES.inc(len(pending) - len(misses), source="cache")
+
+        for item in pending:
+            if item.get("cancelled"):
+                results[item["index"]] = JobCancelled(item["job_id"])
+        pending = [item for item in pending if not item.get("cancelled")]
+
+        # Update image records
+        for item in pending:
+            db_image = item["db_image"]
+            db_image.image_path = item["image_path"]
+            db_image.derivatives = derivative_urls(item["image_path"])
+            db_image.placeholder = item["placeholder"]
+            db_image.caption = item["caption"]
+            db_image.seed = item["seed"]
+            db_image.is_draft = draft
+        with stage("db_commit"):
+            db.commit()
+
+        for item in pending:
+            db_image = item["db_image"]
+            if draft:
+                enqueue_finalize(
+                    db,
+                    db_image.storyboard_id,
+                    resolution,
+                    [
+                        {
+                            "image_id": db_image.id,
+                            "prompt": item["prompt"],
+                            "seed": item["seed"],
+                            "image_path": item["image_path"],
+                            "pose_id": item["pose_id"],
+                        }
+                    ],
+                )
+            db.refresh(db_image)
+            results[item["index"]] = db_image
+
+        return results
 
     except Exception as e:
-        print(f"Error during image generation: {e}")
+        print(f"Error during image regeneration: {e}")
         db.rollback()
+        for item in pending:
+            if results[item["index"]] is None:
+                results[item["index"]] = e
+        return results
     finally:
         db.close()
 
@@ -128,69 +674,160 @@ def generate_single_image(
     resolution: str = "1:1",
     isOpenPose: bool = False,
     pose_img: Image.Image = None,
+    job_id: int = None,
+    pose_id: str = None,
+    draft: bool = False,
+    mode: str = "generate",
+    strength: float = None,
 ):
+    (result,) = generate_single_images(
+        [
+            {
+                "image_id": image_id,
+                "caption": caption,
+                "seed": seed,
+                "resolution": resolution,
+                "isOpenPose": isOpenPose,
+                "pose_img": pose_img,
+                "job_id": job_id,
+                "pose_id": pose_id,
+                "draft": draft,
+                "mode": mode,
+                "strength": strength,
+            }
+        ]
+    )
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def finalize_images(panels: list[dict], resolution: str = "1:1", job_id: int = None):
+    """Replace draft panels with full-quality renders of the same seed.
+
+    A panel is skipped if its row was deleted or no longer shows the draft,
+    e.g. because the user regenerated it in the meantime.
+    """
     db = SessionLocal()
     try:
-        # Get existing image record
-        db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
-        processed_caption = detect_and_translate_to_english(caption)
-        width, height = get_dimensions(resolution)
-        seed = seed if seed is not None else random.randint(0, 2**32 - 1)
-        gen = torch.Generator(device).manual_seed(seed)
-
-        if not db_image:
-            raise ValueError(f"Image with id {image_id} not found.")
-
-        if isOpenPose:
-
-
-            image = openpose(pose_img, detect_resolution=512, image_resolution=1024)
-            image = np.array(image)[:, :, ::-1]
-            image = Image.fromarray(np.uint8(image))
+        backend = get_backend()
+        width, height, steps = render_settings(resolution)
+        version = model_version(steps)
+        batch_size = backend.replicas * pick_batch_size(
+            width, height, backend.free_memory_bytes()
+        )
 
-            result = posepipe(
-                prompt=f"Storyboard sketch of {processed_caption}, black and white, cinematic, high quality",
-                negative_prompt="ugly, deformed, disfigured, poor details, bad anatomy, abstract, bad physics",
-                image=image,
-                adapter_conditioning_scale=1,
-                guidance_scale=8.5,
-                num_inference_steps=30,
-                generator=gen,
+        def still_draft(panel):
+            db_image = (
+                db.query(models.Image)
+                .filter(models.Image.id == panel["image_id"])
+                .first()
             )
-
-        else:
-            result = pipe(
-                prompt=f"Storyboard sketch of {processed_caption}, black and white, cinematic, high quality",
-                negative_prompt="ugly, deformed, disfigured, poor details, bad anatomy, abstract, bad physics",
-                guidance_scale=8.5,
-                num_inference_steps=30,
-                width=width,
-                height=height,
-                generator=gen,
+            if (
+                db_image
+                and db_image.is_draft
+                and db_image.image_path == panel["image_path"]
+            ):
+                return db_image
+            return None
+
+        replaced = []
+
+        def replace(panel, s3_url, preview):
+            db_image = still_draft(panel)
+            if db_image is None:
+                return
+            db_image.image_path = s3_url
+            db_image.derivatives = derivative_urls(s3_url)
+            db_image.placeholder = preview
+            db_image.is_draft = False
+            with stage("db_commit"):
+                db.commit()
+            replaced.append({"id": panel["image_id"], "image_path": s3_url})
+
+        text_panels, pose_panels = [], []
+        for panel in panels:
+            key = cache_key(
+                panel["prompt"],
+                panel["seed"],
+                resolution,
+                version,
+                panel.get("pose_id"),
             )
+            if still_draft(panel) is None:
+                continue
+            entry = result_cache.lookup_entry(db, key)
+            if entry:
+                replace(panel, entry.image_path, entry.placeholder)
+            elif panel.get("pose_id"):
+                pose_panels.append((panel, key))
+            else:
+                text_panels.append((panel, key))
+
+        completed = 0
+        for batch in chunked(text_panels, batch_size):
+            with diffusion_call(steps, len(batch)):
+                images = backend.text_to_image(
+                    [STYLE_PROMPT.format(panel["prompt"]) for panel, _ in batch],
+                    NEGATIVE_PROMPT,
+                    [panel["seed"] for panel, _ in batch],
+                    width,
+                    height,
+                    steps,
+                    GUIDANCE_SCALE,
+                    on_step=progress_callback(
+                        db, job_id, completed, len(panels), steps
+                    ),
+                )
+            for (panel, key), image in zip(batch, images):
+                db_image = still_draft(panel)
+                if db_image is None:
+                    continue
+                s3_url, preview = encode_and_upload(
+                    image,
+                    f"image_{db_image.id}.jpg",
+                    f"storyboards/{db_image.storyboard_id}",
+                )
+                result_cache.store(db, key, s3_url, preview)
+                replace(panel, s3_url, preview)
+                completed += 1
+
+        for panel, key in pose_panels:
+            try:
+                pose_map = extract_pose_map(db, panel["pose_id"])
+            except PoseNotFound as e:
+                # The draft stays; the other panels are still finalized.
+                print(f"[Info] Keeping draft image {panel['image_id']}: {e}")
+                continue
+            with diffusion_call(steps, 1):
+                images = backend.pose_to_image(
+                    [STYLE_PROMPT.format(panel["prompt"])],
+                    NEGATIVE_PROMPT,
+                    [panel["seed"]],
+                    [pose_map],
+                    steps,
+                    GUIDANCE_SCALE,
+                    on_step=progress_callback(
+                        db, job_id, completed, len(panels), steps
+                    ),
+                )
+            db_image = still_draft(panel)
+            if db_image is None:
+                continue
+            s3_url, preview = encode_and_upload(
+                images[0],
+                f"image_{db_image.id}.jpg",
+                f"storyboards/{db_image.storyboard_id}",
+            )
+            result_cache.store(db, key, s3_url, preview)
+            replace(panel, s3_url, preview)
+            completed += 1
 
-        # Save and upload
-        image = result.images[0]
-        buf = BytesIO()
-        image.save(buf, format="JPEG")
-        buf.seek(0)
-
-        s3_url = upload_image_to_s3(
-            buf.read(),
-            f"image_{image_id}.jpg",
-            folder=f"storyboards/{db_image.storyboard_id}",
-        )
-
-        # Update image record
-        db_image.image_path = s3_url
-        db_image.caption = caption
-        db.commit()
-        db.refresh(db_image)
-
-        return db_image
+        return replaced
 
     except Exception as e:
-        print(f"Error during image regeneration: {e}")
+        print(f"Error during draft finalization: {e}")
         db.rollback()
+        raise
     finally:
         db.close()
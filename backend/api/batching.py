@@ -0,0 +1,72 @@
+import hashlib
+import os
+from typing import Iterator, List, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# Fixed micro-batch size; leave unset (or "auto") to size batches from free memory.
+GENERATION_BATCH_SIZE = os.getenv("GENERATION_BATCH_SIZE", "auto")
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+
+# Rough peak memory one 1024x1024 image adds to a float32 SDXL call with
+# classifier-free guidance (UNet activations for the cond/uncond pair plus
+# the VAE decode). Scaled linearly by pixel count for other resolutions.
+BYTES_PER_MEGAPIXEL = int(os.getenv("BATCH_BYTES_PER_MEGAPIXEL", str(3 * 1024**3)))
+MEMORY_HEADROOM = 0.8
+
+# Single-image regenerations from different requests are grouped by the
+# worker: it waits up to the window (seconds) for compatible jobs and runs
+# at most this many through the pipeline together.
+REGENERATE_BATCH_WINDOW = float(os.getenv("REGENERATE_BATCH_WINDOW", "0.05"))
+REGENERATE_MAX_BATCH = int(os.getenv("REGENERATE_MAX_BATCH", "4"))
+
+# Default share of the denoising schedule a "refine" regeneration re-runs
+# on top of the current panel. Lower keeps more of the composition.
+REFINE_STRENGTH = float(os.getenv("REFINE_STRENGTH", "0.35"))
+
+
+def chunked(items: Sequence[T], size: int) -> Iterator[List[T]]:
+    for start in range(0, len(items), size):
+        yield list(items[start : start + size])
+
+
+def sentence_seed(base_seed: int, prompt: str) -> int:
+    """Seed for one sentence of a story.
+
+    Derived from the story's base seed and the sentence text, so a sentence
+    renders the same regardless of which micro-batch it lands in.
+    """
+    digest = hashlib.sha256(f"{base_seed}:{prompt}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big")
+
+
+def pick_batch_size(
+    width: int, height: int, free_bytes: Optional[int], configured: str = None
+) -> int:
+    configured = GENERATION_BATCH_SIZE if configured is None else configured
+    if configured and configured != "auto":
+        return max(1, int(configured))
+
+    if not free_bytes:
+        return 1
+
+    per_image = BYTES_PER_MEGAPIXEL * (width * height) / (1024 * 1024)
+    fits = int(free_bytes * MEMORY_HEADROOM // per_image)
+    return max(1, min(MAX_BATCH_SIZE, fits))
+
+
+def single_batch_key(
+    resolution: str, isOpenPose: bool, draft: bool, strength: Optional[float] = None
+) -> str:
+    """Regenerations with equal keys run through the same pipeline at the same
+    shape and step count, so they can share one batched call.
+
+    ``strength`` is set for refinements, which share a call only at equal
+    strength.
+    """
+    if strength is not None:
+        pipeline = f"refine@{strength:g}"
+    else:
+        pipeline = "pose" if isOpenPose else "text"
+    quality = "draft" if draft else "final"
+    return f"single|{resolution}|{pipeline}|{quality}"
@@ -0,0 +1,316 @@
+"""End-to-end storyboard generation benchmark.
+
+Runs ``generate_batch_images`` over a fixed corpus of stories with a local
+SQLite database and a local directory standing in for S3, and reports
+p50/p95 per stage (translate, coref, sentence_split, diffusion, encode,
+upload, db_commit) and per story as JSON::
+
+    GENERATION_BACKEND=stub python benchmark.py --runs 3 --output run.json
+    python benchmark.py --baseline run.json --max-regression 0.2
+
+Exits with status 1 when a stage regresses past the threshold.
+
+``--profiles`` instead compares diffusers memory profiles, each in its own
+process, by peak RSS and story latency, e.g. to size CPU-only nodes::
+
+    python benchmark.py --backend diffusers --runs 1 --profiles full,cpu-bf16
+"""
+
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+import batch_generator
+import text_processor
+from database import Base
+from generation_backend import (
+    GENERATION_BACKEND,
+    GENERATION_REPLICAS,
+    MEMORY_PROFILE,
+    MEMORY_PROFILES,
+    create_backend,
+    memory_profile,
+    set_backend,
+)
+from timing import collect_stages
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "benchmarks", "stories.json")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear-interpolated percentile, ``q`` in [0, 100]."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(samples: Dict[str, List[float]]) -> Dict[str, dict]:
+    return {
+        name: {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "mean": sum(values) / len(values),
+        }
+        for name, values in sorted(samples.items())
+        if values
+    }
+
+
+def find_regressions(report: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Stages whose p50 or p95 grew by more than ``max_regression`` (0.2 = 20%)."""
+    regressions = []
+    for name, stats in report["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before:
+            continue
+        for metric in ("p50", "p95"):
+            limit = before[metric] * (1 + max_regression)
+            if stats[metric] > limit and stats[metric] - before[metric] > 1e-3:
+                regressions.append(
+                    f"{name} {metric}: {stats[metric]:.4f}s > "
+                    f"{before[metric]:.4f}s baseline (+{max_regression:.0%} allowed)"
+                )
+    return regressions
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def profile_row(report: dict) -> dict:
+    """What one memory profile's run costs in memory and latency."""
+    stages = report["stages"]
+    return {
+        "peak_rss_mb": round(report["peak_rss_bytes"] / 1024**2, 1),
+        "story_p50": stages["total"]["p50"],
+        "story_p95": stages["total"]["p95"],
+        "diffusion_p50": stages.get("diffusion", {}).get("p50"),
+    }
+
+
+def compare_profiles(profiles: List[str], argv: List[str]) -> Dict[str, dict]:
+    """Run the benchmark once per memory profile.
+
+    Each profile runs in a fresh process: the profile is applied when the
+    pipelines load, and peak RSS only ever grows within a process.
+    """
+    rows = {}
+    for profile in profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "report.json")
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), *argv, "--output", output],
+                env={**os.environ, "MEMORY_PROFILE": profile},
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            with open(output, encoding="utf-8") as f:
+                rows[profile] = profile_row(json.load(f))
+        print(f"[Info] {profile}: {rows[profile]}", file=sys.stderr)
+    return rows
+
+
+@contextmanager
+def replaced(module, name, value):
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+def local_uploader(directory: str):
+    """Stand-in for ``upload_image_to_s3`` that writes to a local directory."""
+
+    def upload(
+        image_bytes: bytes,
+        filename: str,
+        folder: str = "images",
+        content_type: str = "image/jpeg",
+        token: str = None,
+    ):
+        target = os.path.join(directory, folder)
+        os.makedirs(target, exist_ok=True)
+        path = os.path.join(target, f"{token or uuid.uuid4().hex}_{filename}")
+        with open(path, "wb") as f:
+            f.write(image_bytes)
+        return f"file://{path}"
+
+    return upload
+
+
+def run_story(session_factory, story: str, seed: int) -> Dict[str, float]:
+    db = session_factory()
+    try:
+        user = models.User(username=f"bench-{uuid.uuid4().hex}", email=None)
+        db.add(user)
+        db.commit()
+        storyboard = models.Storyboard(
+            name="benchmark",
+            owner_id=user.id,
+            thumbnail="",
+            created_at=datetime.now(timezone.utc),
+            updated_at=datetime.now(timezone.utc),
+        )
+        db.add(storyboard)
+        db.commit()
+        storyboard_id = storyboard.id
+    finally:
+        db.close()
+
+    with collect_stages() as timings:
+        start = time.perf_counter()
+        batch_generator.generate_batch_images(story, storyboard_id, "1:1", seed=seed)
+        total = time.perf_counter() - start
+
+    per_story = {name: sum(values) for name, values in timings.items()}
+    per_story["total"] = total
+    return per_story
+
+
+def run_benchmark(corpus: List[dict], runs: int, workdir: str) -> dict:
+    samples: Dict[str, List[float]] = {}
+
+    for run in range(runs):
+        # A fresh database per run, so the result cache starts cold every time.
+        engine = create_engine(f"sqlite:///{os.path.join(workdir, f'run{run}.db')}")
+        Base.metadata.create_all(bind=engine)
+        session_factory = sessionmaker(bind=engine)
+
+        with replaced(batch_generator, "SessionLocal", session_factory), replaced(
+            batch_generator, "upload_image_to_s3", local_uploader(workdir)
+        ):
+            for entry in corpus:
+                per_story = run_story(session_factory, entry["story"], seed=run)
+                for name, seconds in per_story.items():
+                    samples.setdefault(name, []).append(seconds)
+
+        engine.dispose()
+
+    stages = summarize(samples)
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "runs": runs,
+        "stories": len(corpus),
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--backend",
+        default=GENERATION_BACKEND,
+        help="Generation backend to drive (stub or diffusers)",
+    )
+    parser.add_argument(
+        "--no-translate",
+        action="store_true",
+        help="Skip the Google Translate call (still timed as a stage)",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=GENERATION_REPLICAS,
+        help="Pipeline replicas to spread each story over",
+    )
+    parser.add_argument(
+        "--profiles",
+        help="Comma-separated memory profiles to compare, or 'all'",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="Allowed p50/p95 slowdown per stage versus the baseline",
+    )
+    args = parser.parse_args()
+
+    if args.profiles:
+        profiles = (
+            list(MEMORY_PROFILES)
+            if args.profiles == "all"
+            else args.profiles.split(",")
+        )
+        for profile in profiles:
+            memory_profile(profile)
+        argv = [
+            "--corpus",
+            args.corpus,
+            "--runs",
+            str(args.runs),
+            "--backend",
+            args.backend,
+            "--replicas",
+            str(args.replicas),
+        ]
+        if args.no_translate:
+            argv.append("--no-translate")
+        output = json.dumps(compare_profiles(profiles, argv), indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(output)
+        print(output)
+        return
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    set_backend(create_backend(args.backend, args.replicas))
+
+    with tempfile.TemporaryDirectory() as workdir, replaced(
+        text_processor,
+        "detect_and_translate_to_english",
+        (lambda text: text)
+        if args.no_translate
+        else text_processor.detect_and_translate_to_english,
+    ):
+        report = run_benchmark(corpus, args.runs, workdir)
+    report["backend"] = args.backend
+    report["replicas"] = args.replicas
+    report["memory_profile"] = MEMORY_PROFILE
+    report["peak_rss_bytes"] = peak_rss_bytes()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"[Regression] {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
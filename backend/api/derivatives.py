@@ -0,0 +1,88 @@
+import base64
+import os
+from io import BytesIO
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+# Longest side in pixels of each derivative; None keeps the rendered size.
+DERIVATIVE_SIZES = {"thumb": 256, "medium": 512, "full": None}
+
+# Name -> (PIL format, file extension, content type)
+DERIVATIVE_FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+}
+
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY", "85"))
+
+# Longest side of the inline placeholder; a few hundred bytes as WebP.
+PLACEHOLDER_SIZE = 16
+
+# The full-size JPEG is what ``images.image_path`` points at.
+FULL_SUFFIX = "_full.jpg"
+
+
+def derivative_filename(stem: str, size: str, extension: str) -> str:
+    return f"{stem}_{size}.{extension}"
+
+
+def encode_derivatives(
+    image: Image.Image, filename: str
+) -> Iterator[Tuple[str, bytes, str]]:
+    """Yield ``(filename, data, content_type)`` for every size and format.
+
+    The full-size JPEG comes first so its URL is known before the rest.
+    """
+    stem = os.path.splitext(filename)[0]
+    for size, longest in reversed(DERIVATIVE_SIZES.items()):
+        resized = image
+        if longest and max(image.size) > longest:
+            resized = image.copy()
+            resized.thumbnail((longest, longest), Image.LANCZOS)
+        for pil_format, extension, content_type in DERIVATIVE_FORMATS.values():
+            buf = BytesIO()
+            resized.save(buf, format=pil_format, quality=DERIVATIVE_QUALITY)
+            name = derivative_filename(stem, size, extension)
+            yield name, buf.getvalue(), content_type
+
+
+def derivative_urls(image_path: Optional[str]) -> Optional[Dict[str, Dict[str, str]]]:
+    """``{size: {format: url}}`` for an uploaded full-size JPEG.
+
+    Derivatives share the full image's key, so they can be derived from its
+    URL. Images uploaded before derivatives existed return None.
+    """
+    if not image_path or not image_path.endswith(FULL_SUFFIX):
+        return None
+    base = image_path[: -len(FULL_SUFFIX)]
+    return {
+        size: {
+            name: f"{base}_{size}.{extension}"
+            for name, (_, extension, _) in DERIVATIVE_FORMATS.items()
+        }
+        for size in DERIVATIVE_SIZES
+    }
+
+
+def thumbnail_url(image_path: str) -> str:
+    urls = derivative_urls(image_path)
+    return urls["thumb"]["jpeg"] if urls else image_path
+
+
+def object_urls(image_path: str) -> List[str]:
+    """Every stored object behind ``image_path``, for deletion."""
+    urls = derivative_urls(image_path)
+    if not urls:
+        return [image_path]
+    return [url for formats in urls.values() for url in formats.values()]
+
+
+def placeholder(image: Image.Image) -> str:
+    """Tiny blurred preview as a data URI, stored on the image row so the
+    storyboard can lay out before any S3 object has loaded."""
+    preview = image.convert("RGB")
+    preview.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.BILINEAR)
+    buf = BytesIO()
+    preview.save(buf, format="WEBP", quality=40)
+    return "data:image/webp;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
@@ -0,0 +1,365 @@
+import gc
+import os
+from functools import partial
+
+import numpy as np
+import torch
+from PIL import Image
+
+from generation_backend import (
+    GenerationBackend,
+    PIPELINE_CACHE_DIR,
+    PIPELINE_MODE,
+    memory_profile,
+)
+from model_registry import registry
+from prompt_cache import embedding_cache
+
+default_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+OPTIMIZED = PIPELINE_MODE == "optimized"
+PROFILE = memory_profile()
+
+if OPTIMIZED:
+    # Compiled graphs are cached on disk, so later boots mostly skip inductor.
+    os.environ.setdefault(
+        "TORCHINDUCTOR_CACHE_DIR", os.path.join(PIPELINE_CACHE_DIR, "inductor")
+    )
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+# Active LoRA adapters and their weights, shared by pipe and posepipe.
+LORA_ADAPTERS = {"sketch": 0.5, "angles": 0.5}
+
+# Both SDXL text encoders are shared by pipe and posepipe, so one cache
+# namespace covers them; the LoRA weights also touch the text encoders.
+TEXT_ENCODER = "sdxl-base"
+LORA_STATE = ",".join(f"{name}={weight}" for name, weight in LORA_ADAPTERS.items())
+
+
+def model_name(name: str, replica: int = 0) -> str:
+    """Registry name of one replica's copy of a model."""
+    return name if replica == 0 else f"{name}#{replica}"
+
+
+def pipeline_dtype(device) -> torch.dtype:
+    # Optimized mode runs in half precision, which only pays off on a GPU.
+    if OPTIMIZED and torch.device(device).type == "cuda":
+        return torch.float16
+    return getattr(torch, PROFILE["dtype"])
+
+
+def place(pipe, device):
+    """Put a pipeline on its device the way the memory profile says.
+
+    Optimized pipelines always stay resident, which compiled modules need.
+    Attention slicing and VAE tiling act on the UNet and VAE, so they reach
+    every pipeline sharing them.
+    """
+    offload = PROFILE["offload"]
+    if OPTIMIZED or torch.device(device).type != "cuda":
+        offload = None
+
+    if offload == "sequential":
+        pipe.enable_sequential_cpu_offload(device=device)
+    elif offload == "model":
+        pipe.enable_model_cpu_offload(device=device)
+    else:
+        pipe.to(device)
+
+    if PROFILE.get("attention_slicing"):
+        pipe.enable_attention_slicing()
+    if PROFILE.get("vae_tiling"):
+        pipe.vae.enable_tiling()
+
+
+def optimize(pipe):
+    """Fold the LoRAs into the base weights and compile the UNet and VAE.
+
+    The sub-pipelines built with ``from_pipe`` share these modules, so they
+    are compiled once per replica.
+    """
+    pipe.fuse_lora(adapter_names=list(LORA_ADAPTERS))
+    pipe.unload_lora_weights()
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.unet = torch.compile(pipe.unet)
+    pipe.vae.decode = torch.compile(pipe.vae.decode)
+
+
+# Models are loaded on first use (or from `worker.py --warmup`), so importing
+# this module stays cheap. Every replica loads its own copy on its own device.
+def _load_vae(device, replica):
+    from diffusers import AutoencoderKL
+
+    # Placed on its device together with the pipeline that uses it.
+    return AutoencoderKL.from_pretrained(
+        "madebyollin/sdxl-vae-fp16-fix",
+        torch_dtype=pipeline_dtype(device),
+        use_safetensors=True,
+    )
+
+
+def _load_pipe(device, replica):
+    from diffusers import StableDiffusionXLPipeline, UniPCMultistepScheduler
+
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        "stabilityai/stable-diffusion-xl-base-1.0",
+        vae=registry.get(model_name("vae", replica)),
+        variant="fp16",
+        torch_dtype=pipeline_dtype(device),
+        use_safetensors=True,
+    )
+
+    pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+    place(pipe, device)
+
+    # Load LoRA weights
+    pipe.load_lora_weights(
+        "safetensors/Storyboard_sketch.safetensors", adapter_name="sketch"
+    )
+    pipe.load_lora_weights("safetensors/anglesv2.safetensors", adapter_name="angles")
+    pipe.set_adapters(
+        list(LORA_ADAPTERS), adapter_weights=list(LORA_ADAPTERS.values())
+    )
+    if OPTIMIZED:
+        optimize(pipe)
+    return pipe
+
+
+def _load_openpose():
+    from controlnet_aux import OpenposeDetector
+
+    return OpenposeDetector.from_pretrained("lllyasviel/ControlNet")
+
+
+def _load_adapter(device, replica):
+    from diffusers import T2IAdapter
+
+    return T2IAdapter.from_pretrained(
+        "TencentARC/t2i-adapter-openpose-sdxl-1.0", torch_dtype=pipeline_dtype(device)
+    )
+
+
+def _load_posepipe(device, replica):
+    from diffusers import StableDiffusionXLAdapterPipeline, UniPCMultistepScheduler
+
+    pipe = registry.get(model_name("pipe", replica))
+
+    # Reuse the base pipeline's UNet, VAE and text encoders, which already
+    # carry the sketch/angles LoRAs, instead of loading a second SDXL copy.
+    # Only the adapter and a scheduler of its own are new.
+    posepipe = StableDiffusionXLAdapterPipeline.from_pipe(
+        pipe,
+        adapter=registry.get(model_name("t2i_adapter", replica)),
+        scheduler=UniPCMultistepScheduler.from_config(pipe.scheduler.config),
+    )
+    place(posepipe, device)
+    return posepipe
+
+
+def _load_img2img(device, replica):
+    from diffusers import StableDiffusionXLImg2ImgPipeline, UniPCMultistepScheduler
+
+    pipe = registry.get(model_name("pipe", replica))
+
+    # Refinements start from an existing panel; like posepipe this shares
+    # every weight with the base pipeline.
+    img2img = StableDiffusionXLImg2ImgPipeline.from_pipe(
+        pipe, scheduler=UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+    )
+    place(img2img, device)
+    return img2img
+
+
+# The OpenPose detector is small and shared by every replica.
+registry.register("openpose", _load_openpose)
+
+REPLICA_LOADERS = {
+    "vae": _load_vae,
+    "pipe": _load_pipe,
+    "t2i_adapter": _load_adapter,
+    "posepipe": _load_posepipe,
+    "img2img": _load_img2img,
+}
+
+
+def register_replica(device, replica: int = 0):
+    for name, loader in REPLICA_LOADERS.items():
+        registry.register(model_name(name, replica), partial(loader, device, replica))
+
+
+register_replica(default_device)
+
+
+def encode_text(text: str, device=default_device, replica: int = 0):
+    """Return ``(prompt_embeds, pooled_prompt_embeds)`` for one text, cached.
+
+    Embeddings are the same on every replica, so they share one cache.
+    """
+
+    def compute():
+        pipe = registry.get(model_name("pipe", replica))
+        with torch.no_grad():
+            prompt_embeds, _, pooled, _ = pipe.encode_prompt(
+                prompt=text,
+                device=device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False,
+            )
+        # Kept on the CPU; the pipeline moves embeddings to its device.
+        return prompt_embeds.cpu(), pooled.cpu()
+
+    return embedding_cache.get_or_compute((text, TEXT_ENCODER, LORA_STATE), compute)
+
+
+def prompt_embedding_kwargs(
+    prompts: list[str], negative_prompt: str, device=default_device, replica: int = 0
+) -> dict:
+    """Precomputed positive/negative embeddings for a batch of prompts."""
+    positives = [encode_text(prompt, device, replica) for prompt in prompts]
+    negative_embeds, negative_pooled = encode_text(negative_prompt, device, replica)
+    count = len(prompts)
+    return {
+        "prompt_embeds": torch.cat([embeds for embeds, _ in positives]),
+        "pooled_prompt_embeds": torch.cat([pooled for _, pooled in positives]),
+        "negative_prompt_embeds": negative_embeds.repeat(count, 1, 1),
+        "negative_pooled_prompt_embeds": negative_pooled.repeat(count, 1),
+    }
+
+
+def step_end_callback(on_step):
+    if on_step is None:
+        return None
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        on_step(step + 1)
+        return callback_kwargs
+
+    return on_step_end
+
+
+class DiffusersBackend(GenerationBackend):
+    """SDXL with the sketch/angles LoRAs and the OpenPose T2I adapter."""
+
+    name = "diffusers"
+    model_version = f"sdxl-base-1.0|{LORA_STATE}"
+
+    def __init__(self, device=None, replica: int = 0):
+        self.device = torch.device(device) if device else default_device
+        self.replica = replica
+        # Lower precision and VAE tiling change pixels slightly, so their
+        # renders are cached apart from full-precision ones.
+        dtype = pipeline_dtype(self.device)
+        if dtype != torch.float32:
+            self.model_version += f"|{str(dtype).replace('torch.', '')}"
+        if PROFILE.get("vae_tiling"):
+            self.model_version += "|vae-tiling"
+        if replica:
+            register_replica(self.device, replica)
+
+    def _model(self, name: str):
+        return registry.get(model_name(name, self.replica))
+
+    def _embeddings(self, prompts, negative_prompt):
+        return prompt_embedding_kwargs(
+            prompts, negative_prompt, self.device, self.replica
+        )
+
+    def _generators(self, seeds):
+        # One generator per image, so no two jobs or replicas share RNG state.
+        return [torch.Generator(self.device).manual_seed(seed) for seed in seeds]
+
+    def text_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        width,
+        height,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        result = self._model("pipe")(
+            **self._embeddings(prompts, negative_prompt),
+            guidance_scale=guidance_scale,
+            height=height,
+            width=width,
+            num_inference_steps=steps,
+            generator=self._generators(seeds),
+            callback_on_step_end=step_end_callback(on_step),
+        )
+        return result.images
+
+    def pose_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        pose_maps,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        result = self._model("posepipe")(
+            **self._embeddings(prompts, negative_prompt),
+            image=pose_maps if len(pose_maps) > 1 else pose_maps[0],
+            adapter_conditioning_scale=1,
+            guidance_scale=guidance_scale,
+            num_inference_steps=steps,
+            generator=self._generators(seeds),
+            callback_on_step_end=step_end_callback(on_step),
+        )
+        return result.images
+
+    def image_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        init_images,
+        strength,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        result = self._model("img2img")(
+            **self._embeddings(prompts, negative_prompt),
+            image=init_images,
+            strength=strength,
+            guidance_scale=guidance_scale,
+            num_inference_steps=steps,
+            generator=self._generators(seeds),
+            callback_on_step_end=step_end_callback(on_step),
+        )
+        return result.images
+
+    def detect_pose(self, image, detect_resolution, image_resolution):
+        pose = registry.get("openpose")(
+            image,
+            detect_resolution=detect_resolution,
+            image_resolution=image_resolution,
+        )
+        pose = np.array(pose)[:, :, ::-1]
+        return Image.fromarray(np.uint8(pose))
+
+    def free_memory_bytes(self):
+        if self.device.type == "cuda":
+            free, _total = torch.cuda.mem_get_info(self.device)
+            return free
+        return super().free_memory_bytes()
+
+    def memory_in_use_bytes(self):
+        if self.device.type == "cuda":
+            return {str(self.device): torch.cuda.memory_allocated(self.device)}
+        return super().memory_in_use_bytes()
+
+    def release_memory(self):
+        gc.collect()
+        if self.device.type == "cuda":
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+
+    def warmup(self):
+        registry.get("openpose")
+        for name in REPLICA_LOADERS:
+            self._model(name)
@@ -0,0 +1,574 @@
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import psutil
+from PIL import Image, ImageDraw, ImageOps
+
+# "diffusers" runs SDXL; "stub" draws synthetic images without any model.
+GENERATION_BACKEND = os.getenv("GENERATION_BACKEND", "diffusers")
+
+# Pipeline replicas per worker process. Diffusers replicas are placed
+# round-robin on GENERATION_DEVICES (e.g. "cuda:0,cuda:1"), defaulting to the
+# first GPU, or the CPU without one.
+GENERATION_REPLICAS = int(os.getenv("GENERATION_REPLICAS", "1"))
+GENERATION_DEVICES = [
+    device for device in os.getenv("GENERATION_DEVICES", "").split(",") if device
+]
+
+# "eager" runs the pipelines as loaded. "optimized" keeps them resident in
+# half precision with the LoRAs fused and the UNet and VAE compiled, and the
+# worker warms every render size up before it takes jobs.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "eager")
+
+# Memory/speed trade-offs of the diffusers pipelines, picked with
+# MEMORY_PROFILE. Offloading only applies on a GPU: "model" pages whole
+# models onto it per call, "sequential" single layers (least VRAM, slowest).
+# Without a GPU every profile keeps the models resident in RAM.
+MEMORY_PROFILES = {
+    "full": {"dtype": "float32", "offload": "model"},
+    "cpu-bf16": {"dtype": "bfloat16", "offload": None},
+    "attention-slicing": {
+        "dtype": "float32",
+        "offload": "model",
+        "attention_slicing": True,
+    },
+    "vae-tiling": {"dtype": "float32", "offload": "model", "vae_tiling": True},
+    "sequential-offload": {"dtype": "float32", "offload": "sequential"},
+}
+MEMORY_PROFILE = os.getenv("MEMORY_PROFILE", "full")
+
+# Compiled kernels and the last warm start report, kept across restarts.
+PIPELINE_CACHE_DIR = os.getenv(
+    "PIPELINE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sceneweaver")
+)
+
+# Denoising steps per warmup call; compilation does not depend on the count.
+WARMUP_STEPS = 2
+
+# Simulated seconds per denoising step for the stub backend.
+STUB_STEP_LATENCY = float(os.getenv("STUB_STEP_LATENCY", "0"))
+
+StepCallback = Optional[Callable[[int], None]]
+
+
+def memory_profile(name: str = MEMORY_PROFILE) -> dict:
+    if name not in MEMORY_PROFILES:
+        raise ValueError(f"Unknown memory profile: {name}")
+    return MEMORY_PROFILES[name]
+
+
+def refine_steps(steps: int, strength: float) -> int:
+    """Denoising steps an image-to-image call at ``strength`` actually runs."""
+    return max(1, min(steps, int(steps * strength)))
+
+
+class GenerationBackend:
+    """What the generation path needs from an image model.
+
+    ``on_step`` is called with the 1-based step number after each denoising
+    step. Seeds are per image, so results do not depend on batching.
+    """
+
+    name = "base"
+    model_version = "base"
+    # Calls this backend can run at once; see ReplicaPool.
+    replicas = 1
+
+    def text_to_image(
+        self,
+        prompts: List[str],
+        negative_prompt: str,
+        seeds: List[int],
+        width: int,
+        height: int,
+        steps: int,
+        guidance_scale: float,
+        on_step: StepCallback = None,
+    ) -> List[Image.Image]:
+        raise NotImplementedError
+
+    def pose_to_image(
+        self,
+        prompts: List[str],
+        negative_prompt: str,
+        seeds: List[int],
+        pose_maps: List[Image.Image],
+        steps: int,
+        guidance_scale: float,
+        on_step: StepCallback = None,
+    ) -> List[Image.Image]:
+        raise NotImplementedError
+
+    def image_to_image(
+        self,
+        prompts: List[str],
+        negative_prompt: str,
+        seeds: List[int],
+        init_images: List[Image.Image],
+        strength: float,
+        steps: int,
+        guidance_scale: float,
+        on_step: StepCallback = None,
+    ) -> List[Image.Image]:
+        """Re-render existing images towards new prompts.
+
+        Only the last ``strength`` share of the ``steps`` schedule runs, so
+        the composition of ``init_images`` survives.
+        """
+        raise NotImplementedError
+
+    def detect_pose(
+        self, image: Image.Image, detect_resolution: int, image_resolution: int
+    ) -> Image.Image:
+        raise NotImplementedError
+
+    def free_memory_bytes(self) -> Optional[int]:
+        return psutil.virtual_memory().available
+
+    def memory_in_use_bytes(self) -> Dict[str, int]:
+        """Memory held per device; on the CPU that is the process RSS."""
+        return {"cpu": psutil.Process().memory_info().rss}
+
+    def release_memory(self):
+        """Free cached allocations, e.g. after a cancelled call."""
+
+    def warmup(self):
+        pass
+
+
+class StubBackend(GenerationBackend):
+    """Deterministic synthetic images for tests and load benchmarks.
+
+    The same prompt and seed always produce the same picture, and each call
+    sleeps ``step_latency`` per step to stand in for the UNet.
+    """
+
+    name = "stub"
+    model_version = "stub-1"
+
+    def __init__(self, step_latency: float = STUB_STEP_LATENCY):
+        self.step_latency = step_latency
+
+    def _run_steps(self, steps: int, on_step: StepCallback):
+        for step in range(1, steps + 1):
+            if self.step_latency:
+                time.sleep(self.step_latency)
+            if on_step is not None:
+                on_step(step)
+
+    def _draw(self, prompt: str, seed: int, width: int, height: int) -> Image.Image:
+        digest = hashlib.sha256(f"{seed}:{prompt}".encode("utf-8")).digest()
+        rng = random.Random(digest)
+        shade = rng.randint(200, 255)
+        image = Image.new("RGB", (width, height), (shade, shade, shade))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1 = min(width, x0 + rng.randint(1, max(1, width // 3)))
+            y1 = min(height, y0 + rng.randint(1, max(1, height // 3)))
+            ink = rng.randint(0, 120)
+            draw.rectangle([x0, y0, x1, y1], outline=(ink, ink, ink), width=3)
+        return image
+
+    def text_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        width,
+        height,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        self._run_steps(steps, on_step)
+        return [
+            self._draw(prompt, seed, width, height)
+            for prompt, seed in zip(prompts, seeds)
+        ]
+
+    def pose_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        pose_maps,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        self._run_steps(steps, on_step)
+        images = []
+        for prompt, seed, pose_map in zip(prompts, seeds, pose_maps):
+            image = self._draw(prompt, seed, *pose_map.size)
+            images.append(Image.blend(image, pose_map.convert("RGB"), 0.5))
+        return images
+
+    def image_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        init_images,
+        strength,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        self._run_steps(refine_steps(steps, strength), on_step)
+        images = []
+        for prompt, seed, init_image in zip(prompts, seeds, init_images):
+            source = init_image.convert("RGB")
+            image = self._draw(prompt, seed, *source.size)
+            images.append(Image.blend(source, image, strength))
+        return images
+
+    def detect_pose(self, image, detect_resolution, image_resolution):
+        edges = ImageOps.grayscale(image).resize((detect_resolution, detect_resolution))
+        return edges.resize((image_resolution, image_resolution)).convert("RGB")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class _ChunkStopped(Exception):
+    """Stops a replica's chunk after another chunk of the same call failed."""
+
+
+class ReplicaPool(GenerationBackend):
+    """Spreads every call over several replicas of one backend.
+
+    A call is split into one contiguous chunk per replica and each chunk
+    runs on the next idle replica, so a story's sentences render in
+    parallel and concurrent jobs share the replicas instead of queueing on
+    one model. Seeds are per image, so the split does not change any pixels.
+    """
+
+    name = "pool"
+
+    def __init__(self, backends: List[GenerationBackend]):
+        self.backends = list(backends)
+        self.replicas = len(self.backends)
+        self.model_version = self.backends[0].model_version
+        self._idle = queue.Queue()
+        for backend in self.backends:
+            self._idle.put(backend)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.replicas, thread_name_prefix="replica"
+        )
+
+    def _on_idle_replica(self, call: Callable[[GenerationBackend], list]):
+        backend = self._idle.get()
+        try:
+            return call(backend)
+        finally:
+            self._idle.put(backend)
+
+    def _spread(self, count: int, call, on_step: StepCallback) -> list:
+        """Run ``call(backend, indices, chunk_on_step)`` over per-replica
+        chunks and concatenate the results in order.
+
+        One running chunk at a time reports its steps to ``on_step``. Once a
+        chunk raises, e.g. because ``on_step`` cancelled the job, the others
+        stop at their next step, and the error is only raised after every
+        replica is free again.
+        """
+        parts = min(count, self.replicas)
+        bounds = [round(num * count / parts) for num in range(parts + 1)]
+        stop = threading.Event()
+        lock = threading.Lock()
+        reporter = [None]
+
+        def chunk_on_step(num, step):
+            if stop.is_set():
+                raise _ChunkStopped()
+            if on_step is None:
+                return
+            with lock:
+                if reporter[0] is None:
+                    reporter[0] = num
+                if reporter[0] == num:
+                    on_step(step)
+
+        def run_chunk(num, indices, backend):
+            try:
+                if stop.is_set():
+                    raise _ChunkStopped()
+                return call(
+                    backend,
+                    indices=indices,
+                    chunk_on_step=partial(chunk_on_step, num),
+                )
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                with lock:
+                    if reporter[0] == num:
+                        reporter[0] = None
+
+        futures = [
+            self._executor.submit(
+                self._on_idle_replica, partial(run_chunk, num, range(start, end))
+            )
+            for num, (start, end) in enumerate(zip(bounds, bounds[1:]))
+        ]
+        wait(futures)
+        errors = [
+            future.exception()
+            for future in futures
+            if not isinstance(future.exception(), (type(None), _ChunkStopped))
+        ]
+        if errors:
+            raise errors[0]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def text_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        width,
+        height,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        def call(backend, indices, chunk_on_step):
+            return backend.text_to_image(
+                [prompts[num] for num in indices],
+                negative_prompt,
+                [seeds[num] for num in indices],
+                width,
+                height,
+                steps,
+                guidance_scale,
+                on_step=chunk_on_step,
+            )
+
+        return self._spread(len(prompts), call, on_step)
+
+    def pose_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        pose_maps,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        def call(backend, indices, chunk_on_step):
+            return backend.pose_to_image(
+                [prompts[num] for num in indices],
+                negative_prompt,
+                [seeds[num] for num in indices],
+                [pose_maps[num] for num in indices],
+                steps,
+                guidance_scale,
+                on_step=chunk_on_step,
+            )
+
+        return self._spread(len(prompts), call, on_step)
+
+    def image_to_image(
+        self,
+        prompts,
+        negative_prompt,
+        seeds,
+        init_images,
+        strength,
+        steps,
+        guidance_scale,
+        on_step=None,
+    ):
+        def call(backend, indices, chunk_on_step):
+            return backend.image_to_image(
+                [prompts[num] for num in indices],
+                negative_prompt,
+                [seeds[num] for num in indices],
+                [init_images[num] for num in indices],
+                strength,
+                steps,
+                guidance_scale,
+                on_step=chunk_on_step,
+            )
+
+        return self._spread(len(prompts), call, on_step)
+
+    def detect_pose(self, image, detect_resolution, image_resolution):
+        return self._on_idle_replica(
+            lambda backend: backend.detect_pose(
+                image, detect_resolution, image_resolution
+            )
+        )
+
+    def free_memory_bytes(self):
+        # Per replica: batch sizes are picked for one replica's share.
+        free = [backend.free_memory_bytes() for backend in self.backends]
+        return None if None in free else min(free)
+
+    def memory_in_use_bytes(self):
+        used = {}
+        for backend in self.backends:
+            used.update(backend.memory_in_use_bytes())
+        return used
+
+    def release_memory(self):
+        for backend in self.backends:
+            backend.release_memory()
+
+    def warmup(self):
+        for backend in self.backends:
+            backend.warmup()
+
+
+PIPELINES = ("text_to_image", "pose_to_image", "image_to_image")
+
+
+def _warmup_call(
+    backend: GenerationBackend,
+    pipeline: str,
+    width: int,
+    height: int,
+    batch: int,
+    negative_prompt: str,
+    guidance_scale: float,
+    steps: int,
+):
+    # ``batch`` images per replica, so a pool warms all of them at once.
+    count = batch * backend.replicas
+    prompts = ["warmup"] * count
+    seeds = list(range(count))
+    if pipeline == "text_to_image":
+        return backend.text_to_image(
+            prompts, negative_prompt, seeds, width, height, steps, guidance_scale
+        )
+    # Pose and refine renders take their size from the input image.
+    blanks = [Image.new("RGB", (width, height))] * count
+    if pipeline == "pose_to_image":
+        return backend.pose_to_image(
+            prompts, negative_prompt, seeds, blanks, steps, guidance_scale
+        )
+    return backend.image_to_image(
+        prompts, negative_prompt, seeds, blanks, 1.0, steps, guidance_scale
+    )
+
+
+def warm_start(
+    backend: GenerationBackend,
+    plan: Dict[str, Iterable[Tuple[int, int, int]]],
+    negative_prompt: str,
+    guidance_scale: float,
+    steps: int = WARMUP_STEPS,
+    report_path: Optional[str] = None,
+) -> dict:
+    """Run every ``(width, height, batch)`` of ``plan`` through a pipeline twice.
+
+    ``plan`` maps pipeline names to shapes, ``batch`` being images per
+    replica; a pipeline missing from it is reported as skipped. Shapes only
+    match real calls with the same negative prompt and guidance scale:
+    guidance above 1 doubles the batch the UNet sees. The first call at a
+    shape pays the one-time costs (compilation, kernel selection, allocator
+    growth); its gap to the second call is what the first real request at
+    that shape no longer waits for. The report is kept at ``report_path`` so
+    the next boot can show what the on-disk compile cache saved.
+    """
+    previous = None
+    if report_path and os.path.exists(report_path):
+        with open(report_path) as f:
+            previous = json.load(f)
+
+    start = time.perf_counter()
+    pipelines = {}
+    for pipeline in PIPELINES:
+        timings = {}
+        for width, height, batch in plan.get(pipeline, ()):
+            calls = []
+            for _ in range(2):
+                call_start = time.perf_counter()
+                _warmup_call(
+                    backend,
+                    pipeline,
+                    width,
+                    height,
+                    batch,
+                    negative_prompt,
+                    guidance_scale,
+                    steps,
+                )
+                calls.append(time.perf_counter() - call_start)
+            timings[f"{width}x{height} batch {batch}"] = {
+                "first_seconds": calls[0],
+                "warm_seconds": calls[1],
+            }
+        pipelines[pipeline] = {"skipped": not timings, "sizes": timings}
+
+    report = {
+        "mode": PIPELINE_MODE,
+        "startup_seconds": time.perf_counter() - start,
+        "previous_startup_seconds": previous and previous.get("startup_seconds"),
+        "guidance_scale": guidance_scale,
+        "pipelines": pipelines,
+    }
+    if report_path:
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def create_replica(name: str, num: int = 0) -> GenerationBackend:
+    if name == "stub":
+        return StubBackend()
+    if name == "diffusers":
+        # Imported lazily: pulls in torch.
+        from diffusers_backend import DiffusersBackend
+
+        device = (
+            GENERATION_DEVICES[num % len(GENERATION_DEVICES)]
+            if GENERATION_DEVICES
+            else None
+        )
+        return DiffusersBackend(device, replica=num)
+    raise ValueError(f"Unknown generation backend: {name}")
+
+
+def create_backend(name: str, replicas: int = 1) -> GenerationBackend:
+    if replicas > 1:
+        return ReplicaPool([create_replica(name, num) for num in range(replicas)])
+    return create_replica(name)
+
+
+def get_backend() -> GenerationBackend:
+    """The process-wide backend selected by ``GENERATION_BACKEND``."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(GENERATION_BACKEND, GENERATION_REPLICAS)
+    return _backend
+
+
+def loaded_backend() -> Optional[GenerationBackend]:
+    """The process-wide backend if one was created, without creating it."""
+    return _backend
+
+
+def set_backend(backend: GenerationBackend):
+    """Replace the process-wide backend, e.g. with a stub for benchmarks."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,464 @@
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import models
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATUSES = {COMPLETED, FAILED, CANCELLED}
+
+# Recorded as the error of a story cancelled because a new one replaced it.
+REPLACED = "Replaced by a new story"
+
+# Interactive regenerations run ahead of bulk story work; lower runs first.
+JOB_CLASSES = {"single": "interactive", "batch": "bulk", "finalize": "bulk"}
+CLASS_PRIORITIES = {"interactive": 0, "bulk": 1}
+
+# Jobs one user may have running at once, across all workers (0 = no limit).
+MAX_RUNNING_JOBS_PER_USER = int(os.getenv("MAX_RUNNING_JOBS_PER_USER", "2"))
+
+# Queued jobs considered per claim when picking the fairest one.
+CLAIM_WINDOW = 200
+
+# How far back, in seconds, an owner's last started job counts when owners
+# take turns. Keeps the lookup bounded as the job history grows.
+SERVED_WINDOW_SECONDS = float(os.getenv("SERVED_WINDOW_SECONDS", "3600"))
+
+# A running job whose worker has not checked in for this long is assumed
+# lost (crashed or killed) and goes back to the queue, up to
+# MAX_JOB_ATTEMPTS claims in total.
+STALE_JOB_SECONDS = float(os.getenv("STALE_JOB_SECONDS", "300"))
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))
+
+
+def job_class(kind: str) -> str:
+    return JOB_CLASSES.get(kind, "bulk")
+
+
+def enqueue_job(
+    db: Session,
+    kind: str,
+    payload: dict,
+    storyboard_id: Optional[int] = None,
+    owner_id: Optional[int] = None,
+    pose_image: Optional[bytes] = None,
+    batch_key: Optional[str] = None,
+    idempotency_key: Optional[str] = None,
+) -> models.GenerationJob:
+    job = models.GenerationJob(
+        kind=kind,
+        status=QUEUED,
+        storyboard_id=storyboard_id,
+        owner_id=owner_id,
+        payload=payload,
+        batch_key=batch_key,
+        idempotency_key=idempotency_key,
+        priority=CLASS_PRIORITIES[job_class(kind)],
+        pose_image=pose_image,
+        attempts=0,
+        created_at=datetime.now(timezone.utc),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_job(db: Session, job_id: int) -> Optional[models.GenerationJob]:
+    return db.query(models.GenerationJob).filter(models.GenerationJob.id == job_id).first()
+
+
+def _claim(db: Session, job_id: int) -> bool:
+    claimed = (
+        db.query(models.GenerationJob)
+        .filter(
+            models.GenerationJob.id == job_id,
+            models.GenerationJob.status == QUEUED,
+        )
+        .update(
+            {
+                models.GenerationJob.status: RUNNING,
+                models.GenerationJob.started_at: datetime.now(timezone.utc),
+                models.GenerationJob.heartbeat_at: datetime.now(timezone.utc),
+                models.GenerationJob.attempts: models.GenerationJob.attempts + 1,
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return bool(claimed)
+
+
+def running_counts(db: Session) -> Dict[Tuple[Optional[int], int], int]:
+    """Running jobs per ``(owner, priority)``, i.e. per owner and job class."""
+    rows = (
+        db.query(
+            models.GenerationJob.owner_id,
+            models.GenerationJob.priority,
+            func.count(models.GenerationJob.id),
+        )
+        .filter(models.GenerationJob.status == RUNNING)
+        .group_by(models.GenerationJob.owner_id, models.GenerationJob.priority)
+        .all()
+    )
+    return {(owner_id, priority): count for owner_id, priority, count in rows}
+
+
+def last_served(
+    db: Session, owner_ids: Iterable[int], window: float = SERVED_WINDOW_SECONDS
+) -> Dict[Optional[int], datetime]:
+    """When each of ``owner_ids`` last had a job started.
+
+    Only the last ``window`` seconds are looked at; owners not served in
+    that time count as never served.
+    """
+    owner_ids = {owner_id for owner_id in owner_ids if owner_id is not None}
+    if not owner_ids:
+        return {}
+    since = datetime.now(timezone.utc) - timedelta(seconds=window)
+    return dict(
+        db.query(
+            models.GenerationJob.owner_id, func.max(models.GenerationJob.started_at)
+        )
+        .filter(
+            models.GenerationJob.started_at >= since,
+            models.GenerationJob.owner_id.in_(owner_ids),
+        )
+        .group_by(models.GenerationJob.owner_id)
+        .all()
+    )
+
+
+def _at_limit(
+    running: Dict[Tuple[Optional[int], int], int],
+    owner_id: Optional[int],
+    priority: int,
+    max_running: int,
+) -> bool:
+    return bool(
+        owner_id is not None
+        and max_running
+        and running.get((owner_id, priority), 0) >= max_running
+    )
+
+
+def fair_order(
+    candidates: list,
+    running: Dict[Tuple[Optional[int], int], int],
+    served: Optional[Dict[Optional[int], datetime]] = None,
+    max_running: int = MAX_RUNNING_JOBS_PER_USER,
+) -> List[int]:
+    """Order queued ``(id, owner_id, priority)`` rows, oldest first, for claiming.
+
+    Higher priority classes go first. Within a class owners take turns: a
+    job's turn is the number of jobs its owner already has running or
+    queued ahead of it in that class, and equal turns go to the owner
+    served least recently. Someone with ten queued stories therefore gets
+    one turn per round like everyone else. Owners with ``max_running`` jobs
+    of a class running are skipped for that class only, so running stories
+    never hold back a regeneration.
+    """
+    served = served or {}
+    ahead = defaultdict(int)
+    ordered = []
+    for position, (job_id, owner_id, priority) in enumerate(candidates):
+        if _at_limit(running, owner_id, priority, max_running):
+            continue
+        turn = running.get((owner_id, priority), 0) + ahead[(owner_id, priority)]
+        ahead[(owner_id, priority)] += 1
+        last = served.get(owner_id)
+        recency = (1, last) if last is not None else (0,)
+        ordered.append((priority or 0, turn, recency, position, job_id))
+    return [entry[-1] for entry in sorted(ordered)]
+
+
+def _queued_candidates(db: Session, *criteria) -> list:
+    """Oldest queued ``(id, owner_id, priority)`` rows matching ``criteria``.
+
+    Postgres skips rows another worker has locked; the conditional UPDATE
+    in ``_claim`` keeps claims safe on SQLite, which has no row locks.
+    """
+    return (
+        db.query(
+            models.GenerationJob.id,
+            models.GenerationJob.owner_id,
+            models.GenerationJob.priority,
+        )
+        .filter(models.GenerationJob.status == QUEUED, *criteria)
+        .order_by(models.GenerationJob.created_at, models.GenerationJob.id)
+        .with_for_update(skip_locked=True)
+        .limit(CLAIM_WINDOW)
+        .all()
+    )
+
+
+def claim_job(db: Session) -> Optional[models.GenerationJob]:
+    """Atomically move the next job, in fair order, to running and return it."""
+    candidates = _queued_candidates(db)
+
+    served = last_served(db, (owner_id for _, owner_id, _ in candidates))
+    for job_id in fair_order(candidates, running_counts(db), served):
+        if _claim(db, job_id):
+            return get_job(db, job_id)
+
+    db.commit()
+    return None
+
+
+def claim_jobs(db: Session, batch_key: str, limit: int) -> List[models.GenerationJob]:
+    """Claim up to ``limit`` queued jobs that share ``batch_key``.
+
+    Jobs are taken in fair order, and nobody goes past their running limit
+    by joining a batch.
+    """
+    if limit <= 0:
+        return []
+
+    candidates = _queued_candidates(db, models.GenerationJob.batch_key == batch_key)
+    running = running_counts(db)
+    classes = {
+        job_id: (owner_id, priority) for job_id, owner_id, priority in candidates
+    }
+
+    claimed = []
+    served = last_served(db, (owner_id for _, owner_id, _ in candidates))
+    for job_id in fair_order(candidates, running, served):
+        if len(claimed) >= limit:
+            break
+        owner_id, priority = classes[job_id]
+        if _at_limit(running, owner_id, priority, MAX_RUNNING_JOBS_PER_USER):
+            continue
+        if _claim(db, job_id):
+            claimed.append(job_id)
+            running[(owner_id, priority)] = running.get((owner_id, priority), 0) + 1
+    db.commit()
+    return [get_job(db, job_id) for job_id in claimed]
+
+
+class JobCancelled(Exception):
+    """Raised from a step callback to stop a job that was cancelled."""
+
+    def __init__(self, job_id: int):
+        super().__init__(f"Job {job_id} was cancelled")
+        self.job_id = job_id
+
+
+def update_job_progress(db: Session, job_id: int, **progress) -> bool:
+    """Record how far a running job has got, e.g. panel/step counters.
+
+    Returns False once the job is no longer running, e.g. cancelled.
+    """
+    updated = (
+        db.query(models.GenerationJob)
+        .filter(
+            models.GenerationJob.id == job_id,
+            models.GenerationJob.status == RUNNING,
+        )
+        .update(
+            {
+                models.GenerationJob.progress: progress,
+                models.GenerationJob.heartbeat_at: datetime.now(timezone.utc),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return bool(updated)
+
+
+def update_job_payload(db: Session, job_id: int, **fields):
+    """Merge ``fields`` into a job's payload, e.g. state needed to resume it."""
+    job = get_job(db, job_id)
+    job.payload = {**(job.payload or {}), **fields}
+    db.commit()
+
+
+def touch_jobs(db: Session, job_ids: List[int]):
+    """Record that the worker running these jobs is still alive."""
+    db.query(models.GenerationJob).filter(
+        models.GenerationJob.id.in_(job_ids),
+        models.GenerationJob.status == RUNNING,
+    ).update(
+        {models.GenerationJob.heartbeat_at: datetime.now(timezone.utc)},
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def requeue_stale_jobs(
+    db: Session,
+    stale_after: float = STALE_JOB_SECONDS,
+    max_attempts: int = MAX_JOB_ATTEMPTS,
+) -> List[int]:
+    """Put running jobs whose worker stopped checking in back in the queue.
+
+    Jobs resume from their saved progress. A job that has already been
+    claimed ``max_attempts`` times fails instead. Returns the requeued ids.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=stale_after)
+    stale = (
+        db.query(models.GenerationJob.id, models.GenerationJob.attempts)
+        .filter(
+            models.GenerationJob.status == RUNNING,
+            models.GenerationJob.heartbeat_at < cutoff,
+        )
+        .all()
+    )
+
+    requeued = []
+    for job_id, attempts in stale:
+        if (attempts or 0) >= max_attempts:
+            values = {
+                models.GenerationJob.status: FAILED,
+                models.GenerationJob.error: "Worker stopped responding",
+                models.GenerationJob.finished_at: datetime.now(timezone.utc),
+            }
+        else:
+            values = {models.GenerationJob.status: QUEUED}
+        # Conditional, so two workers cannot both requeue the same job.
+        updated = (
+            db.query(models.GenerationJob)
+            .filter(
+                models.GenerationJob.id == job_id,
+                models.GenerationJob.status == RUNNING,
+                models.GenerationJob.heartbeat_at < cutoff,
+            )
+            .update(values, synchronize_session=False)
+        )
+        db.commit()
+        if updated and values[models.GenerationJob.status] == QUEUED:
+            print(f"[Info] Requeued stale job {job_id}")
+            requeued.append(job_id)
+    return requeued
+
+
+def find_job_by_key(
+    db: Session, owner_id: int, idempotency_key: str, statuses: List[str]
+) -> Optional[models.GenerationJob]:
+    """Latest job of an owner submitted under ``idempotency_key``."""
+    return (
+        db.query(models.GenerationJob)
+        .filter(
+            models.GenerationJob.owner_id == owner_id,
+            models.GenerationJob.idempotency_key == idempotency_key,
+            models.GenerationJob.status.in_(statuses),
+        )
+        .order_by(models.GenerationJob.id.desc())
+        .first()
+    )
+
+
+def retry_job(db: Session, job: models.GenerationJob):
+    """Queue a failed job again; it resumes from the panels it saved."""
+    job.status = QUEUED
+    job.error = None
+    job.finished_at = None
+    db.commit()
+
+
+def _finish(db: Session, job: models.GenerationJob, status: str, **fields):
+    # A job cancelled while it ran stays cancelled.
+    db.refresh(job)
+    if job.status == CANCELLED:
+        return
+    job.status = status
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.pose_image = None
+    job.finished_at = datetime.now(timezone.utc)
+    db.commit()
+
+
+def complete_job(db: Session, job: models.GenerationJob, result: dict = None):
+    _finish(db, job, COMPLETED, result=result)
+
+
+def fail_job(db: Session, job: models.GenerationJob, error: str):
+    _finish(db, job, FAILED, error=error)
+
+
+def cancel_job(
+    db: Session, job: models.GenerationJob, reason: Optional[str] = None
+) -> bool:
+    """Cancel a queued or running job. A running job stops at its next
+    denoising step. ``reason`` is kept as the job's error. Returns False if
+    the job had already finished."""
+    cancelled = (
+        db.query(models.GenerationJob)
+        .filter(
+            models.GenerationJob.id == job.id,
+            models.GenerationJob.status.in_([QUEUED, RUNNING]),
+        )
+        .update(
+            {
+                models.GenerationJob.status: CANCELLED,
+                models.GenerationJob.error: reason,
+                models.GenerationJob.pose_image: None,
+                models.GenerationJob.finished_at: datetime.now(timezone.utc),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    db.refresh(job)
+    return bool(cancelled)
+
+
+def cancel_storyboard_jobs(
+    db: Session,
+    storyboard_id: int,
+    kinds: Optional[List[str]] = None,
+    reason: Optional[str] = None,
+) -> List[int]:
+    """Cancel every unfinished job of a storyboard; returns their ids."""
+    query = db.query(models.GenerationJob).filter(
+        models.GenerationJob.storyboard_id == storyboard_id,
+        models.GenerationJob.status.in_([QUEUED, RUNNING]),
+    )
+    if kinds is not None:
+        query = query.filter(models.GenerationJob.kind.in_(kinds))
+    return [job.id for job in query.all() if cancel_job(db, job, reason)]
+
+
+def poll_job(
+    session_factory: Callable[[], Session], job_id: int
+) -> Optional[models.GenerationJob]:
+    """Read a job in a session of its own; the returned row is detached."""
+    db = session_factory()
+    try:
+        return get_job(db, job_id)
+    finally:
+        db.close()
+
+
+async def wait_for_job(
+    session_factory: Callable[[], Session],
+    job_id: int,
+    timeout: float,
+    poll_interval: float = 0.5,
+) -> models.GenerationJob:
+    """Poll a job until a worker finishes it or ``timeout`` seconds pass.
+
+    Each poll opens a short-lived session in the thread pool, so a waiting
+    request neither holds a pooled connection nor blocks the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        job = await run_in_threadpool(poll_job, session_factory, job_id)
+        if job is None or job.status in FINISHED_STATUSES:
+            return job
+        if loop.time() >= deadline:
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout}s")
+        await asyncio.sleep(poll_interval)
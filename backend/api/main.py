@@ -7,6 +7,8 @@ from fastapi import (
     Form,
     UploadFile,
     File,
+    Query,
+    Header,
 )
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
@@ -25,11 +27,10 @@ from schemas import (
     StoryboardOut,
     StoryboardCreateNoOwner,
     ImageOut,
+    JobOut,
 )
 import auth, database, storyboards
-from PIL import Image
-from fastapi.responses import StreamingResponse
-from io import BytesIO
+from fastapi.responses import StreamingResponse, Response
 import random
 from typing import List, Optional
 import models
@@ -37,14 +38,43 @@ import secrets
 import string
 from reset_password import send_reset_email
 from fastapi import BackgroundTasks
-from batch_generator import generate_batch_images, generate_single_image
+from job_queue import (
+    enqueue_job,
+    get_job,
+    wait_for_job,
+    cancel_job,
+    cancel_storyboard_jobs,
+    find_job_by_key,
+    retry_job,
+    COMPLETED,
+    FAILED,
+    QUEUED,
+    REPLACED,
+    RUNNING,
+)
+from admission import QueueFull, check_admission, queue_stats
+import metrics
+from progress import storyboard_events
 from s3 import delete_image_from_s3
+from result_cache import is_image_path_referenced
+from pose_cache import (
+    has_source as has_pose_source,
+    is_valid_pose_id,
+    pose_id_for,
+    store_source as store_pose_source,
+)
+from derivatives import object_urls, thumbnail_url
+from batching import REFINE_STRENGTH, single_batch_key
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 import os
+import hashlib
 
 app = FastAPI()
 
+# How long /regenerate-image waits for the worker before giving up.
+REGENERATE_TIMEOUT = float(os.getenv("REGENERATE_TIMEOUT", "600"))
+
 
 origins = [
     "http://35.213.136.241",
@@ -67,6 +97,31 @@ async def root():
     return {"message": "Welcome to SceneWeaver"}
 
 
+def admit(db: Session, kind: str, owner_id: Optional[int] = None):
+    """Turn a generation request away with 429 when the queue is too deep."""
+    try:
+        check_admission(db, kind, owner_id)
+    except QueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+@app.get("/queue/stats")
+def get_queue_stats(db: Session = Depends(database.get_db)):
+    # Depth and wait times per job class, for dashboards and alerting
+    return queue_stats(db)
+
+
+@app.get("/metrics")
+def get_metrics(db: Session = Depends(database.get_db)):
+    # Prometheus scrape target; generation itself is measured on the workers
+    metrics.update_queue_gauges(queue_stats(db))
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.post("/regenerate-image/{image_id}")
 async def regenerate_image(
     image_id: int,
@@ -75,13 +130,50 @@ async def regenerate_image(
     resolution: str = Form(...),
     isOpenPose: bool = Form(False),
     pose_img: UploadFile = File(None),
+    pose_id: Optional[str] = Form(None),
+    draft: bool = Form(False),
+    mode: str = Form("generate"),
+    strength: Optional[float] = Form(None),
     db: Session = Depends(database.get_db),
     token: str = Depends(auth.oauth2_scheme),
 ):
+    # "refine" re-renders the current panel for small caption edits: a
+    # fraction of the denoising steps, keeping the composition.
+    if mode not in ("generate", "refine"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="mode must be 'generate' or 'refine'",
+        )
+    if mode == "refine":
+        if isOpenPose:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="A pose cannot be applied when refining",
+            )
+        strength = REFINE_STRENGTH if strength is None else strength
+        if not 0 < strength <= 1:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="strength must be between 0 and 1",
+            )
+        # Already cheap, and a draft's finalize pass would render from
+        # noise and lose the refined composition.
+        draft = False
+    else:
+        strength = None
+    # A pose reference is sent once; later requests can pass the returned
+    # pose_id and reuse the skeleton the worker extracted.
+    if isOpenPose and not pose_img and not is_valid_pose_id(pose_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A pose image or a valid pose_id is required",
+        )
+
+    # Verify token and get current user
+    username = auth.verify_token_string(token)
+    user = auth.get_user_by_username(db, username)
+    admit(db, "single", user.id)
     try:
-        # Verify token and get current user
-        username = auth.verify_token_string(token)
-        user = auth.get_user_by_username(db, username)
 
         # Get the image with its associated storyboard
         db_image = (
@@ -99,15 +191,56 @@ async def regenerate_image(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Image not found or not owned by user",
             )
-        pose_image_obj = None
+        pose_image_data = None
         if isOpenPose and pose_img:
-            image_data = await pose_img.read()
-            pose_image_obj = Image.open(BytesIO(image_data))
+            pose_image_data = await pose_img.read()
+            pose_id = pose_id_for(pose_image_data)
+            store_pose_source(db, pose_id, pose_image_data)
+        elif isOpenPose and not has_pose_source(db, pose_id):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="This pose is no longer stored; upload the pose image again",
+            )
 
-        # Regenerate the image (this will maintain the same filename)
-        generate_single_image(
-            image_id, caption, seed, resolution, isOpenPose, pose_image_obj
+        # Hand the regeneration to the worker and wait for it to finish
+        job = enqueue_job(
+            db,
+            "single",
+            {
+                "image_id": image_id,
+                "caption": caption,
+                "seed": seed,
+                "resolution": resolution,
+                "isOpenPose": isOpenPose,
+                "pose_id": pose_id if isOpenPose else None,
+                "draft": draft,
+                "mode": mode,
+                "strength": strength,
+            },
+            storyboard_id=db_image.storyboard_id,
+            owner_id=user.id,
+            pose_image=pose_image_data,
+            batch_key=single_batch_key(resolution, isOpenPose, draft, strength),
         )
+        # End the request's transaction so no connection is held meanwhile
+        job_id = job.id
+        db.commit()
+        try:
+            job = await wait_for_job(SessionLocal, job_id, REGENERATE_TIMEOUT)
+        except TimeoutError:
+            # The client gives up here, so a late result must not replace
+            # the panel afterwards. A job that just finished is kept.
+            if cancel_job(db, job):
+                raise HTTPException(
+                    status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                    detail={
+                        "message": "Image regeneration timed out and was cancelled",
+                        "job_id": job.id,
+                        "status_url": f"/jobs/{job.id}",
+                    },
+                )
+        if job.status != COMPLETED:
+            raise RuntimeError(job.error or "generation job failed")
 
         # Update storyboard's updated_at timestamp
         storyboard = (
@@ -119,8 +252,15 @@ async def regenerate_image(
             storyboard.updated_at = datetime.now(timezone.utc)
             db.commit()
 
-        return {"message": "Image regenerated successfully"}
+        return {
+            "message": "Image regenerated successfully",
+            "job_id": job.id,
+            "pose_id": pose_id if isOpenPose else None,
+        }
 
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(
@@ -221,6 +361,9 @@ async def get_storyboard_images(
                 image_path=image.image_path,
                 caption=image.caption,
                 storyboard_id=image.storyboard_id,
+                is_draft=bool(image.is_draft),
+                derivatives=image.derivatives,
+                placeholder=image.placeholder,
             )
             for image in storyboards.images
         ]
@@ -375,7 +518,7 @@ def create_storyboard(
         db.refresh(db_storyboard)
 
         if db_storyboard.images:
-            db_storyboard.thumbnail = db_storyboard.images[0].image_path
+            db_storyboard.thumbnail = thumbnail_url(db_storyboard.images[0].image_path)
             db.commit()
 
         return db_storyboard
@@ -459,11 +602,19 @@ def delete_storyboard(
                 detail="Storyboard not found or not owned by user",
             )
 
-        for image in db_storyboard.images:
-            delete_image_from_s3(image.image_path)
+        image_paths = {image.image_path for image in db_storyboard.images}
+
+        # Stop any generation still working on this storyboard
+        cancel_storyboard_jobs(db, db_storyboard.id)
 
         db.delete(db_storyboard)
         db.commit()
+
+        # Cached renders can be shared between images; keep objects in use.
+        for image_path in image_paths:
+            if not is_image_path_referenced(db, image_path):
+                for url in object_urls(image_path):
+                    delete_image_from_s3(url)
         return {"message": "Storyboard deleted successfully"}
 
     except Exception as e:
@@ -500,8 +651,8 @@ def get_user_storyboards(
         for storyboard in storyboards:
             if storyboard.images:
                 newest_image = max(storyboard.images, key=lambda img: img.id)
-                if storyboard.thumbnail != newest_image.image_path:
-                    storyboard.thumbnail = newest_image.image_path
+                if storyboard.thumbnail != thumbnail_url(newest_image.image_path):
+                    storyboard.thumbnail = thumbnail_url(newest_image.image_path)
                     storyboard.updated_at = datetime.now(timezone.utc)
 
         db.commit()
@@ -583,13 +734,15 @@ def delete_image(
                 detail="Image not found or not owned by user",
             )
 
-        # Delete the image from S3
-        delete_image_from_s3(db_image.image_path)
-
         # Delete the image from database
         db.delete(db_image)
         db.commit()
 
+        # Delete the image from S3 unless a cached render still shares it
+        if not is_image_path_referenced(db, db_image.image_path):
+            for url in object_urls(db_image.image_path):
+                delete_image_from_s3(url)
+
         # Update storyboard thumbnail if needed
         storyboard = (
             db.query(models.Storyboard)
@@ -599,11 +752,11 @@ def delete_image(
 
         if storyboard:
             # If the deleted image was the thumbnail, update it to the newest remaining image
-            if storyboard.thumbnail == db_image.image_path:
+            if storyboard.thumbnail == thumbnail_url(db_image.image_path):
                 remaining_images = storyboard.images
                 if remaining_images:
                     newest_image = max(remaining_images, key=lambda img: img.id)
-                    storyboard.thumbnail = newest_image.image_path
+                    storyboard.thumbnail = thumbnail_url(newest_image.image_path)
                 else:
                     storyboard.thumbnail = "https://sceneweaver.s3.ap-southeast-2.amazonaws.com/assets/thumbnail.png"
 
@@ -687,12 +840,19 @@ async def reset_password(
     return {"message": "Password updated successfully"}
 
 
+def story_key(storyboard_id: int, story: str, resolution: str, draft: bool) -> str:
+    """Idempotency key of a story submitted without one."""
+    text = f"{storyboard_id}|{resolution}|{draft}|{story}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
 @app.post("/generate-images/{storyboard_id}")
 async def generate_images(
-    background_tasks: BackgroundTasks,
     storyboard_id: int,
     story: str = Form(...),
     resolution: str = Form("1:1"),
+    draft: bool = Form(False),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: Session = Depends(database.get_db),
     token: str = Depends(auth.oauth2_scheme),
 ):
@@ -707,16 +867,111 @@ async def generate_images(
     if not storyboard:
         raise HTTPException(status_code=404, detail="Storyboard not found")
 
+    # A resubmitted story attaches to the job already working on it, and a
+    # failed one picks up from the panels it saved. Without an explicit key
+    # only unfinished jobs match, so the same story can still be redone.
+    statuses = [QUEUED, RUNNING, FAILED]
+    if idempotency_key:
+        statuses.append(COMPLETED)
+    else:
+        idempotency_key = story_key(storyboard.id, story, resolution, draft)
+    existing = find_job_by_key(db, user.id, idempotency_key, statuses)
+    if existing and existing.storyboard_id == storyboard.id:
+        if existing.status == FAILED:
+            retry_job(db, existing)
+        return {"message": "Image generation resumed", "job_id": existing.id}
+
+    # A new story replaces one that is still generating. Finalize jobs are
+    # left alone: the drafts they upgrade stay on the storyboard. The old
+    # story is cancelled first so it does not count against admission.
+    cancel_storyboard_jobs(db, storyboard.id, kinds=["batch"], reason=REPLACED)
+
+    admit(db, "batch", user.id)
+
     storyboard.updated_at = datetime.now(timezone.utc)
     db.commit()
 
-    background_tasks.add_task(generate_batch_images, story, storyboard.id, resolution)
+    job = enqueue_job(
+        db,
+        "batch",
+        {
+            "story": story,
+            "resolution": resolution,
+            "seed": random.randint(0, 2**32 - 1),
+            "draft": draft,
+        },
+        storyboard_id=storyboard.id,
+        owner_id=user.id,
+        idempotency_key=idempotency_key,
+    )
 
     if storyboard.images:
         # Sort images by id in descending order (newest first)
         sorted_images = sorted(storyboard.images, key=lambda img: img.id, reverse=True)
         newest_image = sorted_images[0]
-        storyboard.thumbnail = newest_image.image_path
+        storyboard.thumbnail = thumbnail_url(newest_image.image_path)
         db.commit()
 
-    return {"message": "Image generation started"}
+    return {"message": "Image generation started", "job_id": job.id}
+
+
+@app.get("/jobs/{job_id}", response_model=JobOut)
+def get_generation_job(
+    job_id: int,
+    db: Session = Depends(database.get_db),
+    token: str = Depends(auth.oauth2_scheme),
+):
+    username = auth.verify_token_string(token)
+    user = auth.get_user_by_username(db, username)
+
+    job = get_job(db, job_id)
+    if not job or job.owner_id != user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=JobOut)
+def cancel_generation_job(
+    job_id: int,
+    db: Session = Depends(database.get_db),
+    token: str = Depends(auth.oauth2_scheme),
+):
+    username = auth.verify_token_string(token)
+    user = auth.get_user_by_username(db, username)
+
+    job = get_job(db, job_id)
+    if not job or job.owner_id != user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    # Finished jobs are returned unchanged
+    cancel_job(db, job)
+    return job
+
+
+@app.get("/storyboard/events/{storyboard_id}")
+def stream_storyboard_events(
+    storyboard_id: int,
+    token: str = Query(...),
+    job_id: Optional[int] = Query(None),
+    after: int = Query(0),
+    db: Session = Depends(database.get_db),
+):
+    # EventSource cannot send an Authorization header, so the token comes in
+    # the query string. It is checked once, not on every update.
+    username = auth.verify_token_string(token)
+    user = auth.get_user_by_username(db, username)
+
+    storyboard = (
+        db.query(models.Storyboard)
+        .filter_by(id=storyboard_id, owner_id=user.id)
+        .first()
+    )
+    if not storyboard:
+        raise HTTPException(status_code=404, detail="Storyboard not found")
+
+    return StreamingResponse(
+        storyboard_events(SessionLocal, storyboard_id, job_id, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,370 @@
+"""Prometheus-style metrics for the generation pipeline.
+
+Counters, gauges and histograms live in one process-wide registry and are
+rendered in the Prometheus text format by ``render``. The API serves them
+at ``/metrics``; workers, where generation actually runs, serve them with
+``worker.py --metrics-port``.
+
+Every stage timed with ``timing.stage`` is observed automatically.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import psutil
+
+import timing
+from job_queue import JobCancelled
+
+# Seconds; covers a cached lookup up to a long story on a CPU host.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {labels}")
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """``(suffix, formatted labels, value)`` for every series."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [("", _format_labels(self.labels, key), value) for key, value in values]
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    With ``collect`` the gauge is read at render time instead:
+    ``collect()`` returns ``{label values: value}``.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name,
+        help,
+        labels=(),
+        collect: Optional[Callable[[], Dict[tuple, float]]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> Optional[float]:
+        return self._values.get(self._key(labels))
+
+    def samples(self):
+        if self._collect is not None:
+            values = sorted(self._collect().items())
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [("", _format_labels(self.labels, key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Label values -> [per-bucket counts, sum, count]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for num, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][num] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def samples(self):
+        with self._lock:
+            series = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self._series.items()
+            )
+        samples = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                labels = _format_labels(
+                    self.labels + ("le",), key + (_format_value(bound),)
+                )
+                samples.append(("_bucket", labels, cumulative))
+            labels = _format_labels(self.labels, key)
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+# Content type of ``render``'s output.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    return registry.render()
+
+
+def _backend_memory() -> Dict[tuple, float]:
+    # Only workers hold a backend; the API process reports nothing here.
+    from generation_backend import loaded_backend
+
+    backend = loaded_backend()
+    if backend is None:
+        return {}
+    return {
+        (str(device),): used for device, used in backend.memory_in_use_bytes().items()
+    }
+
+
+STAGE_SECONDS = registry.register(
+    Histogram(
+        "sceneweaver_stage_seconds",
+        "Time spent per generation stage (translate, coref, diffusion, ...)",
+        ("stage",),
+    )
+)
+STAGE_FAILURES = registry.register(
+    Counter(
+        "sceneweaver_stage_failures_total",
+        "Generation stages that raised, by stage",
+        ("stage",),
+    )
+)
+QUEUE_WAIT_SECONDS = registry.register(
+    Histogram(
+        "sceneweaver_queue_wait_seconds",
+        "Time from enqueue until a worker claimed the job",
+        ("kind",),
+    )
+)
+JOB_SECONDS = registry.register(
+    Histogram(
+        "sceneweaver_job_seconds",
+        "Time from claim until the job finished",
+        ("kind", "status"),
+    )
+)
+JOBS = registry.register(
+    Counter(
+        "sceneweaver_jobs_total",
+        "Finished generation jobs by kind and status",
+        ("kind", "status"),
+    )
+)
+DIFFUSION_STEP_RATE = registry.register(
+    Histogram(
+        "sceneweaver_diffusion_image_steps_per_second",
+        "Denoising steps times images per second of each pipeline call",
+        (),
+        buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200),
+    )
+)
+STORY_IMAGES = registry.register(
+    Histogram(
+        "sceneweaver_story_images",
+        "Panels per generated story",
+        (),
+        buckets=(1, 2, 4, 8, 16, 32, 64),
+    )
+)
+IMAGES = registry.register(
+    Counter(
+        "sceneweaver_images_total",
+        "Panels produced, by source (rendered or served from the result cache)",
+        ("source",),
+    )
+)
+MODEL_MEMORY = registry.register(
+    Gauge(
+        "sceneweaver_model_memory_bytes",
+        "Memory held by the generation backend, per device",
+        ("device",),
+        collect=_backend_memory,
+    )
+)
+PROCESS_RSS = registry.register(
+    Gauge(
+        "sceneweaver_process_resident_memory_bytes",
+        "Resident memory of this process",
+        collect=lambda: {(): psutil.Process().memory_info().rss},
+    )
+)
+QUEUE_DEPTH = registry.register(
+    Gauge(
+        "sceneweaver_queue_jobs",
+        "Generation jobs per class and status",
+        ("job_class", "status"),
+    )
+)
+QUEUE_OLDEST_SECONDS = registry.register(
+    Gauge(
+        "sceneweaver_queue_oldest_seconds",
+        "Age of the oldest queued job per class",
+        ("job_class",),
+    )
+)
+
+
+def update_queue_gauges(stats: Dict[str, dict]):
+    """Copy ``admission.queue_stats`` into the queue gauges."""
+    for name, values in stats.items():
+        QUEUE_DEPTH.set(values["queued"], job_class=name, status="queued")
+        QUEUE_DEPTH.set(values["running"], job_class=name, status="running")
+        QUEUE_OLDEST_SECONDS.set(values["oldest_queued_seconds"], job_class=name)
+
+
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands timezone-aware columns back naive.
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def observe_queue_wait(job):
+    if job.created_at and job.started_at:
+        waited = _as_utc(job.started_at) - _as_utc(job.created_at)
+        QUEUE_WAIT_SECONDS.observe(waited.total_seconds(), kind=job.kind)
+
+
+def observe_job(job, status: str, seconds: float):
+    JOBS.inc(kind=job.kind, status=status)
+    JOB_SECONDS.observe(seconds, kind=job.kind, status=status)
+
+
+@contextmanager
+def diffusion_call(steps: int, images: int):
+    """Time one pipeline call as the "diffusion" stage and record its rate."""
+    with timing.stage("diffusion"):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+    if seconds > 0:
+        DIFFUSION_STEP_RATE.observe(steps * images / seconds)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "") -> ThreadingHTTPServer:
+    """Serve ``/metrics`` from a background thread, e.g. in a worker."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
+
+
+def _on_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def _on_stage_failure(name: str, error: BaseException):
+    # A cancelled job stops mid-stage on purpose; that is not a failure.
+    if not isinstance(error, JobCancelled):
+        STAGE_FAILURES.inc(stage=name)
+
+
+timing.add_listener(_on_stage)
+timing.add_failure_listener(_on_stage_failure)
@@ -0,0 +1,110 @@
+"""Schema changes for databases created by an earlier version.
+
+``Base.metadata.create_all`` creates missing tables but never alters one
+that already exists, so every column or constraint added to an existing
+table needs a step here. Each step checks the live schema first, which
+makes ``migrate`` safe to run on every start::
+
+    python migrations.py
+"""
+
+from typing import List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+# (table, column, type and default), oldest first.
+COLUMNS = [
+    ("images", "seed", "BIGINT"),
+    ("generation_jobs", "progress", "JSON"),
+    ("images", "is_draft", "BOOLEAN DEFAULT FALSE"),
+    ("generation_jobs", "batch_key", "VARCHAR"),
+    ("images", "derivatives", "JSON"),
+    ("images", "placeholder", "TEXT"),
+    ("generation_cache", "placeholder", "TEXT"),
+    ("generation_jobs", "priority", "INTEGER DEFAULT 1"),
+    ("generation_jobs", "idempotency_key", "VARCHAR"),
+    ("generation_jobs", "heartbeat_at", "TIMESTAMP WITH TIME ZONE"),
+    (
+        "images",
+        "job_id",
+        "INTEGER REFERENCES generation_jobs (id) ON DELETE SET NULL",
+    ),
+    ("images", "sentence_index", "INTEGER"),
+]
+
+# (name, table, columns, unique), named as create_all would name them.
+INDEXES = [
+    ("ix_generation_jobs_batch_key", "generation_jobs", ["batch_key"], False),
+    ("ix_generation_jobs_priority", "generation_jobs", ["priority"], False),
+    (
+        "ix_generation_jobs_idempotency_key",
+        "generation_jobs",
+        ["idempotency_key"],
+        False,
+    ),
+    ("ix_generation_jobs_heartbeat_at", "generation_jobs", ["heartbeat_at"], False),
+    ("ix_generation_jobs_started_at", "generation_jobs", ["started_at"], False),
+    (
+        "uq_images_job_id_sentence_index",
+        "images",
+        ["job_id", "sentence_index"],
+        True,
+    ),
+]
+
+
+def _has_index(inspector, table: str, columns: List[str], unique: bool) -> bool:
+    existing = [
+        index["column_names"]
+        for index in inspector.get_indexes(table)
+        if index["unique"] or not unique
+    ]
+    if unique:
+        existing += [
+            constraint["column_names"]
+            for constraint in inspector.get_unique_constraints(table)
+        ]
+    return list(columns) in existing
+
+
+def migrate(engine: Engine) -> List[str]:
+    """Bring an existing database up to the models; returns what was done."""
+    applied = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table, column, definition in COLUMNS:
+            if table not in tables:
+                continue
+            if column in {c["name"] for c in inspector.get_columns(table)}:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+            applied.append(f"{table}.{column}")
+
+        for name, table, columns, unique in INDEXES:
+            if table not in tables or _has_index(inspector, table, columns, unique):
+                continue
+            column_list = ", ".join(columns)
+            if unique and engine.dialect.name != "sqlite":
+                statement = (
+                    f"ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({column_list})"
+                )
+            else:
+                # SQLite cannot add constraints; a unique index is equivalent.
+                kind = "UNIQUE INDEX" if unique else "INDEX"
+                statement = f"CREATE {kind} {name} ON {table} ({column_list})"
+            conn.execute(text(statement))
+            applied.append(name)
+
+    for step in applied:
+        print(f"[Info] Migrated: {step}")
+    return applied
+
+
+if __name__ == "__main__":
+    import models
+    from database import engine
+
+    models.Base.metadata.create_all(bind=engine)
+    migrate(engine)
@@ -0,0 +1,78 @@
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Optional
+
+
+class ModelRegistry:
+    """Loads heavy models on first use instead of at import time.
+
+    Loaders are registered by name and run at most once per process, either
+    lazily from ``get`` or eagerly from ``warmup``. Load state and timings are
+    available from ``status`` so workers can report what they have resident.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._models: Dict[str, Any] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._loaded_at: Dict[str, datetime] = {}
+        self._errors: Dict[str, str] = {}
+        # Re-entrant so a loader can pull in the models it is built from.
+        self._lock = threading.RLock()
+
+    def register(self, name: str, loader: Callable[[], Any]):
+        with self._lock:
+            self._loaders[name] = loader
+
+    def get(self, name: str) -> Any:
+        if name in self._models:
+            return self._models[name]
+
+        with self._lock:
+            if name in self._models:
+                return self._models[name]
+            if name not in self._loaders:
+                raise KeyError(f"No model registered under '{name}'")
+
+            print(f"[Info] Loading model '{name}'...")
+            start = time.perf_counter()
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                self._errors[name] = str(e)
+                raise
+            self._load_seconds[name] = time.perf_counter() - start
+            self._loaded_at[name] = datetime.now(timezone.utc)
+            self._errors.pop(name, None)
+            self._models[name] = model
+            print(f"[Info] Loaded '{name}' in {self._load_seconds[name]:.1f}s")
+            return model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def warmup(self, names: Optional[Iterable[str]] = None):
+        for name in names if names is not None else list(self._loaders):
+            self.get(name)
+
+    def unload(self, name: str):
+        with self._lock:
+            self._models.pop(name, None)
+            self._load_seconds.pop(name, None)
+            self._loaded_at.pop(name, None)
+
+    def status(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                name: {
+                    "loaded": name in self._models,
+                    "load_seconds": self._load_seconds.get(name),
+                    "loaded_at": self._loaded_at.get(name),
+                    "error": self._errors.get(name),
+                }
+                for name in self._loaders
+            }
+
+
+registry = ModelRegistry()
@@ -1,4 +1,16 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    DateTime,
+    Boolean,
+    BigInteger,
+    JSON,
+    LargeBinary,
+    Text,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship
 from database import  Base
 from datetime import datetime, timezone
@@ -36,9 +48,23 @@ class Image(Base):
     storyboard_id = Column(Integer, ForeignKey("storyboards.id"))
     image_path = Column(String)
     caption = Column(String)
+    seed = Column(BigInteger, nullable=True)
+    is_draft = Column(Boolean, default=False)
+    # {size: {format: url}} for the thumb/medium/full JPEG and WebP copies
+    derivatives = Column(JSON, nullable=True)
+    # Tiny inline preview (data URI) shown until the real image loads
+    placeholder = Column(Text, nullable=True)
+    # The story job and sentence this panel was generated for. Unique, so a
+    # resumed job never saves the same sentence twice.
+    job_id = Column(
+        Integer, ForeignKey("generation_jobs.id", ondelete="SET NULL"), nullable=True
+    )
+    sentence_index = Column(Integer, nullable=True)
 
     storyboard = relationship("Storyboard", back_populates="images")
 
+    __table_args__ = (UniqueConstraint("job_id", "sentence_index"),)
+
 
 class PasswordResetToken(Base):
     __tablename__ = "password_reset_tokens"
@@ -50,3 +76,54 @@ class PasswordResetToken(Base):
     created_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
 
 
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, index=True)  # "batch", "single" or "finalize"
+    status = Column(String, index=True, default="queued")
+    storyboard_id = Column(
+        Integer, ForeignKey("storyboards.id", ondelete="SET NULL"), index=True
+    )
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    payload = Column(JSON)
+    # Jobs with the same key can share one batched pipeline call.
+    batch_key = Column(String, nullable=True, index=True)
+    # Lower runs first; see job_queue.CLASS_PRIORITIES
+    priority = Column(Integer, default=1, index=True)
+    # Resubmitting under the same key returns (or resumes) this job.
+    idempotency_key = Column(String, nullable=True, index=True)
+    pose_image = Column(LargeBinary, nullable=True)
+    result = Column(JSON, nullable=True)
+    progress = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    # Refreshed by the worker while it runs the job.
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class GenerationCacheEntry(Base):
+    __tablename__ = "generation_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, unique=True, index=True)
+    image_path = Column(String, index=True)
+    placeholder = Column(Text, nullable=True)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True))
+    last_used_at = Column(DateTime(timezone=True), index=True)
+
+
+class PoseSource(Base):
+    __tablename__ = "pose_sources"
+
+    # Pose uploads by pose id, so any worker can extract a skeleton that is
+    # not in its local pose cache.
+    id = Column(Integer, primary_key=True, index=True)
+    pose_id = Column(String, unique=True, index=True)
+    image = Column(LargeBinary)
+    created_at = Column(DateTime(timezone=True))
+    last_used_at = Column(DateTime(timezone=True), index=True)
@@ -0,0 +1,96 @@
+import contextvars
+import os
+import queue
+import threading
+from typing import Callable, Optional
+
+# Threads encoding and uploading finished images, and how many images may
+# wait for them before the generator blocks.
+PANEL_UPLOAD_WORKERS = int(os.getenv("PANEL_UPLOAD_WORKERS", "4"))
+PANEL_QUEUE_SIZE = int(os.getenv("PANEL_QUEUE_SIZE", "8"))
+
+_STOP = object()
+
+
+class BackgroundStage:
+    """Run ``handler`` over submitted items on worker threads.
+
+    ``submit`` blocks while ``max_pending`` items are waiting, so a slow
+    consumer holds the producer back instead of buffering every image in
+    memory. The first exception raised by ``handler`` stops the stage and is
+    re-raised by the next ``submit`` or by ``close``.
+
+    Worker threads run in a copy of the creating thread's context, so stage
+    timings still reach the caller's ``collect_stages`` block.
+    """
+
+    def __init__(
+        self,
+        handler: Callable,
+        workers: int = 1,
+        max_pending: int = PANEL_QUEUE_SIZE,
+        name: str = "stage",
+    ):
+        self._handler = handler
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._error: Optional[BaseException] = None
+        self._abandoned = False
+        self._lock = threading.Lock()
+        self._threads = []
+        for num in range(max(1, workers)):
+            context = contextvars.copy_context()
+            thread = threading.Thread(
+                target=context.run,
+                args=(self._work,),
+                name=f"{name}-{num}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            # After a failure the remaining items are drained, not handled.
+            if self._error is not None or self._abandoned:
+                continue
+            try:
+                self._handler(item)
+            except BaseException as e:
+                with self._lock:
+                    if self._error is None:
+                        self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, item):
+        self._raise_error()
+        self._queue.put(item)
+
+    def _shutdown(self):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def close(self):
+        """Wait for every submitted item, then re-raise the first failure."""
+        self._shutdown()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # The caller failed or was cancelled: skip what is still queued
+            # and don't mask its exception.
+            self._abandoned = True
+            self._shutdown()
+        return False
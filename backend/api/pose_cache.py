@@ -0,0 +1,202 @@
+import hashlib
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+POSE_CACHE_DIR = os.getenv(
+    "POSE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sceneweaver-poses")
+)
+POSE_CACHE_MAX_BYTES = int(os.getenv("POSE_CACHE_MAX_BYTES", str(512 * 1024**2)))
+
+# Upper bound on stored pose uploads; least recently used ones go first.
+POSE_SOURCES_MAX_ENTRIES = int(os.getenv("POSE_SOURCES_MAX_ENTRIES", "1000"))
+
+_POSE_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+def pose_id_for(upload: bytes) -> str:
+    """Content hash of an uploaded pose reference, used as its pose id."""
+    return hashlib.sha256(upload).hexdigest()
+
+
+def is_valid_pose_id(pose_id: str) -> bool:
+    return bool(pose_id) and bool(_POSE_ID.match(pose_id))
+
+
+class PoseNotFound(ValueError):
+    """No upload is stored for a pose id; the pose has to be sent again."""
+
+    def __init__(self, pose_id: str):
+        super().__init__(f"Unknown pose id {pose_id}; upload the pose image again.")
+        self.pose_id = pose_id
+
+
+def store_source(db: Session, pose_id: str, upload: bytes):
+    """Keep a pose upload where every worker can read it."""
+    now = datetime.now(timezone.utc)
+    entry = (
+        db.query(models.PoseSource).filter(models.PoseSource.pose_id == pose_id).first()
+    )
+    if entry is not None:
+        entry.last_used_at = now
+        db.commit()
+        return
+    db.add(
+        models.PoseSource(
+            pose_id=pose_id, image=upload, created_at=now, last_used_at=now
+        )
+    )
+    try:
+        db.commit()
+    except IntegrityError:
+        # The same pose was uploaded concurrently.
+        db.rollback()
+        return
+    evict_sources(db, POSE_SOURCES_MAX_ENTRIES)
+
+
+def has_source(db: Session, pose_id: str) -> bool:
+    """Whether a pose upload is stored; marks it as recently used."""
+    updated = (
+        db.query(models.PoseSource)
+        .filter(models.PoseSource.pose_id == pose_id)
+        .update(
+            {models.PoseSource.last_used_at: datetime.now(timezone.utc)},
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return bool(updated)
+
+
+def load_source(db: Session, pose_id: str) -> Optional[Image.Image]:
+    entry = (
+        db.query(models.PoseSource).filter(models.PoseSource.pose_id == pose_id).first()
+    )
+    if entry is None:
+        return None
+    return Image.open(BytesIO(entry.image))
+
+
+def evict_sources(db: Session, max_entries: int) -> int:
+    """Drop least recently used pose uploads beyond ``max_entries``."""
+    overflow = db.query(models.PoseSource).count() - max_entries
+    if overflow <= 0:
+        return 0
+    stale = (
+        db.query(models.PoseSource)
+        .order_by(models.PoseSource.last_used_at, models.PoseSource.id)
+        .limit(overflow)
+        .all()
+    )
+    for entry in stale:
+        db.delete(entry)
+    db.commit()
+    return len(stale)
+
+
+class PoseCache:
+    """Bounded on-disk store of pose uploads and extracted skeleton maps.
+
+    Files are named by pose id (and detection resolution for skeletons);
+    the least recently used files are removed once ``max_bytes`` is exceeded.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _skeleton_name(
+        self, pose_id: str, detect_resolution: int, image_resolution: int
+    ) -> str:
+        if not is_valid_pose_id(pose_id):
+            raise ValueError(f"Invalid pose id: {pose_id!r}")
+        return f"{pose_id}_{detect_resolution}_{image_resolution}.png"
+
+    def _source_name(self, pose_id: str) -> str:
+        if not is_valid_pose_id(pose_id):
+            raise ValueError(f"Invalid pose id: {pose_id!r}")
+        return f"{pose_id}_source.png"
+
+    def _read(self, name: str) -> Optional[Image.Image]:
+        path = self._path(name)
+        try:
+            image = Image.open(path)
+            image.load()
+        except (FileNotFoundError, OSError):
+            return None
+        os.utime(path)  # mark as recently used
+        return image
+
+    def _write(self, name: str, image: Image.Image):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format="PNG")
+            os.replace(tmp_path, self._path(name))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.prune()
+
+    def get_skeleton(
+        self, pose_id: str, detect_resolution: int, image_resolution: int
+    ) -> Optional[Image.Image]:
+        return self._read(
+            self._skeleton_name(pose_id, detect_resolution, image_resolution)
+        )
+
+    def put_skeleton(
+        self,
+        pose_id: str,
+        detect_resolution: int,
+        image_resolution: int,
+        image: Image.Image,
+    ):
+        self._write(
+            self._skeleton_name(pose_id, detect_resolution, image_resolution), image
+        )
+
+    def get_source(self, pose_id: str) -> Optional[Image.Image]:
+        return self._read(self._source_name(pose_id))
+
+    def put_source(self, pose_id: str, image: Image.Image):
+        self._write(self._source_name(pose_id), image)
+
+    def prune(self):
+        try:
+            entries = [
+                entry
+                for entry in os.scandir(self.directory)
+                if entry.is_file() and entry.name.endswith(".png")
+            ]
+        except FileNotFoundError:
+            return
+
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+pose_cache = PoseCache(POSE_CACHE_DIR, POSE_CACHE_MAX_BYTES)
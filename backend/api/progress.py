@@ -0,0 +1,141 @@
+import asyncio
+import json
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import models
+from job_queue import COMPLETED, FAILED, FINISHED_STATUSES
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def latest_job(db: Session, storyboard_id: int) -> Optional[models.GenerationJob]:
+    return (
+        db.query(models.GenerationJob)
+        .filter(models.GenerationJob.storyboard_id == storyboard_id)
+        .order_by(models.GenerationJob.id.desc())
+        .first()
+    )
+
+
+def snapshot(
+    session_factory: Callable[[], Session],
+    storyboard_id: int,
+    job_id: Optional[int],
+    after_image_id: int,
+) -> Tuple[Optional[dict], List[dict]]:
+    """Read the job state and any images committed since ``after_image_id``."""
+    db = session_factory()
+    try:
+        if job_id is None:
+            job = latest_job(db, storyboard_id)
+        else:
+            job = (
+                db.query(models.GenerationJob)
+                .filter(
+                    models.GenerationJob.id == job_id,
+                    models.GenerationJob.storyboard_id == storyboard_id,
+                )
+                .first()
+            )
+
+        job_state = None
+        if job is not None:
+            job_state = {
+                "job_id": job.id,
+                "kind": job.kind,
+                "status": job.status,
+                "progress": job.progress or {},
+                "result": job.result,
+                "error": job.error,
+            }
+
+        images = (
+            db.query(models.Image)
+            .filter(
+                models.Image.storyboard_id == storyboard_id,
+                models.Image.id > after_image_id,
+            )
+            .order_by(models.Image.id)
+            .all()
+        )
+        return job_state, [
+            {"id": image.id, "image_path": image.image_path, "caption": image.caption}
+            for image in images
+        ]
+    finally:
+        db.close()
+
+
+async def storyboard_events(
+    session_factory: Callable[[], Session],
+    storyboard_id: int,
+    job_id: Optional[int] = None,
+    after_image_id: int = 0,
+    poll_interval: float = 1.0,
+    heartbeat_interval: float = 15.0,
+) -> AsyncIterator[str]:
+    """Yield server-sent events describing a storyboard's generation job.
+
+    Emits ``queued``, ``running`` (with step counters), one ``image`` per
+    committed panel and finally ``completed`` or ``failed``.
+    """
+    last_state = None
+    idle = 0.0
+
+    while True:
+        job_state, images = await run_in_threadpool(
+            snapshot, session_factory, storyboard_id, job_id, after_image_id
+        )
+        sent = False
+
+        for image in images:
+            after_image_id = image["id"]
+            yield format_sse("image", image)
+            sent = True
+
+        if job_state is None:
+            yield format_sse("idle", {"storyboard_id": storyboard_id})
+            return
+
+        job_id = job_state["job_id"]
+        state = (job_state["status"], job_state["progress"])
+        if state != last_state:
+            last_state = state
+            status = job_state["status"]
+            data = {"job_id": job_id}
+
+            if status == COMPLETED:
+                # Regenerations and draft finalization update existing rows
+                # rather than adding new ones.
+                result = job_state["result"] or {}
+                if "image_id" in result:
+                    yield format_sse(
+                        "image",
+                        {
+                            "id": result["image_id"],
+                            "image_path": result.get("image_path"),
+                        },
+                    )
+                for image in result.get("images") or []:
+                    yield format_sse("image", image)
+                yield format_sse("completed", data)
+            elif status == FAILED:
+                yield format_sse("failed", {**data, "error": job_state["error"]})
+            else:
+                yield format_sse(status, {**data, **job_state["progress"]})
+            sent = True
+
+        if job_state["status"] in FINISHED_STATUSES:
+            return
+
+        idle = 0.0 if sent else idle + poll_interval
+        if idle >= heartbeat_interval:
+            idle = 0.0
+            yield ": keep-alive\n\n"
+
+        await asyncio.sleep(poll_interval)
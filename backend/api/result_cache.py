@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+from s3 import delete_image_from_s3
+from derivatives import object_urls
+
+# Upper bound on cached generations; least recently used entries go first.
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
+
+
+def cache_key(
+    caption: str,
+    seed: int,
+    resolution: str,
+    model_version: str,
+    pose_hash: Optional[str] = None,
+    source: Optional[str] = None,
+) -> str:
+    """Content address of one generation: same inputs, same image.
+
+    ``source`` identifies the image and strength a refinement started from.
+    """
+    inputs = [caption, seed, resolution, pose_hash, model_version]
+    if source is not None:
+        inputs.append(source)
+    material = json.dumps(inputs, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def lookup_entry(db: Session, key: str) -> Optional[models.GenerationCacheEntry]:
+    entry = (
+        db.query(models.GenerationCacheEntry)
+        .filter(models.GenerationCacheEntry.key == key)
+        .first()
+    )
+    if entry is None:
+        return None
+
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_used_at = datetime.now(timezone.utc)
+    db.commit()
+    return entry
+
+
+def lookup(db: Session, key: str) -> Optional[str]:
+    entry = lookup_entry(db, key)
+    return entry.image_path if entry else None
+
+
+def store(db: Session, key: str, image_path: str, placeholder: str = None):
+    now = datetime.now(timezone.utc)
+    db.add(
+        models.GenerationCacheEntry(
+            key=key,
+            image_path=image_path,
+            placeholder=placeholder,
+            hits=0,
+            created_at=now,
+            last_used_at=now,
+        )
+    )
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker cached the same generation first.
+        db.rollback()
+        return
+
+    evict(db, RESULT_CACHE_MAX_ENTRIES)
+
+
+def evict(db: Session, max_entries: int) -> List[str]:
+    """Drop least recently used entries beyond ``max_entries``.
+
+    Returns the evicted image paths. Their S3 objects are deleted unless an
+    image row still points at them.
+    """
+    overflow = db.query(models.GenerationCacheEntry).count() - max_entries
+    if overflow <= 0:
+        return []
+
+    stale = (
+        db.query(models.GenerationCacheEntry)
+        .order_by(
+            models.GenerationCacheEntry.last_used_at,
+            models.GenerationCacheEntry.id,
+        )
+        .limit(overflow)
+        .all()
+    )
+    paths = [entry.image_path for entry in stale]
+    for entry in stale:
+        db.delete(entry)
+    db.commit()
+
+    for path in set(paths):
+        if not is_image_path_referenced(db, path):
+            for url in object_urls(path):
+                delete_image_from_s3(url)
+    return paths
+
+
+def is_image_path_referenced(db: Session, image_path: str) -> bool:
+    """Whether any image row or cache entry still uses this S3 object."""
+    in_images = (
+        db.query(models.Image.id).filter(models.Image.image_path == image_path).first()
+    )
+    if in_images:
+        return True
+    return (
+        db.query(models.GenerationCacheEntry.id)
+        .filter(models.GenerationCacheEntry.image_path == image_path)
+        .first()
+        is not None
+    )
@@ -16,19 +16,35 @@ s3 = boto3.client(
 
 BUCKET_NAME = "sceneweaver" 
 
-def upload_image_to_s3(image_bytes: bytes, filename: str, folder: str = "images"):
-    key = f"{folder}/{uuid4().hex}_{filename}"
+def upload_image_to_s3(
+    image_bytes: bytes,
+    filename: str,
+    folder: str = "images",
+    content_type: str = "image/jpeg",
+    token: str = None,
+):
+    # Objects uploaded with the same token share a key prefix
+    key = f"{folder}/{token or uuid4().hex}_{filename}"
     s3.upload_fileobj(
         BytesIO(image_bytes),
         BUCKET_NAME,
         key,
         ExtraArgs={
-            "ContentType": "image/jpeg",
+            "ContentType": content_type,
             "ContentDisposition": f'attachment; filename="{filename}"'
         }
     )
     return f"https://{BUCKET_NAME}.s3.ap-southeast-2.amazonaws.com/{key}"
 
+def download_image_from_s3(image_url: str) -> bytes:
+    prefix = f"https://{BUCKET_NAME}.s3.ap-southeast-2.amazonaws.com/"
+    if not image_url.startswith(prefix):
+        raise ValueError("Invalid image URL format")
+
+    buf = BytesIO()
+    s3.download_fileobj(BUCKET_NAME, image_url.replace(prefix, ""), buf)
+    return buf.getvalue()
+
 def delete_image_from_s3(image_url: str):
    
     try:
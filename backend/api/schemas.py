@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 class UserOut(BaseModel):
@@ -29,10 +29,26 @@ class ImageOut(BaseModel):
     image_path: str
     caption: str
     storyboard_id: int
+    is_draft: bool = False
+    derivatives: Optional[Dict[str, Dict[str, str]]] = None
+    placeholder: Optional[str] = None
     # storyboard: Optional[StoryboardOut] = None # Remove or comment out the nested StoryboardOut
     model_config = {"from_attributes": True}
 
 
+class JobOut(BaseModel):
+    id: int
+    kind: str
+    status: str
+    storyboard_id: Optional[int]
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: Optional[datetime]
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    model_config = {"from_attributes": True}
+
+
 class UserCreate(BaseModel):
     username: str
     email: EmailStr
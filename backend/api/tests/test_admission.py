@@ -0,0 +1,72 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+from admission import QueueFull, check_admission, queue_stats
+from job_queue import claim_job, complete_job, enqueue_job
+
+
+class TestAdmission:
+    def test_rejects_when_class_queue_is_full(self, db):
+        with patch.dict(admission.MAX_QUEUE_DEPTH, {"interactive": 2}):
+            check_admission(db, "single")
+            enqueue_job(db, "single", {"image_id": 1}, owner_id=1)
+            enqueue_job(db, "single", {"image_id": 2}, owner_id=2)
+
+            with pytest.raises(QueueFull) as full:
+                check_admission(db, "single")
+
+            # Bulk work has its own queue.
+            check_admission(db, "batch", owner_id=3)
+
+        assert full.value.retry_after >= admission.MIN_RETRY_AFTER
+
+    def test_limits_queued_stories_per_user(self, db):
+        for n in range(admission.MAX_QUEUED_JOBS_PER_USER):
+            enqueue_job(db, "batch", {"n": n}, owner_id=1)
+
+        with pytest.raises(QueueFull):
+            check_admission(db, "batch", owner_id=1)
+        check_admission(db, "batch", owner_id=2)
+
+    def test_limits_queued_regenerations_per_user(self, db):
+        for n in range(admission.MAX_QUEUED_REGENERATIONS_PER_USER):
+            enqueue_job(db, "single", {"image_id": n}, owner_id=1)
+
+        with pytest.raises(QueueFull):
+            check_admission(db, "single", owner_id=1)
+        check_admission(db, "single", owner_id=2)
+        check_admission(db, "batch", owner_id=1)
+
+    def test_retry_after_follows_recent_run_times(self, db):
+        job = enqueue_job(db, "batch", {"n": 0}, owner_id=1)
+        claim_job(db)
+        job.started_at = datetime.now(timezone.utc) - timedelta(seconds=30)
+        db.commit()
+        complete_job(db, job)
+
+        assert admission.estimate_retry_after(db, "bulk", 2) == pytest.approx(60, abs=2)
+
+
+class TestQueueStats:
+    def test_depth_and_waits_per_class(self, db):
+        enqueue_job(db, "batch", {"n": 0}, owner_id=1)
+        enqueue_job(db, "batch", {"n": 1}, owner_id=2)
+        enqueue_job(db, "single", {"image_id": 1}, owner_id=1)
+        claim_job(db)  # the regeneration
+
+        stats = queue_stats(db)
+
+        assert stats["interactive"]["queued"] == 0
+        assert stats["interactive"]["running"] == 1
+        assert stats["interactive"]["wait_seconds_p95"] >= 0
+        assert stats["bulk"]["queued"] == 2
+        assert stats["bulk"]["running"] == 0
+        assert stats["bulk"]["wait_seconds_mean"] is None
+        assert stats["bulk"]["oldest_queued_seconds"] >= 0
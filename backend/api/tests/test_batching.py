@@ -0,0 +1,71 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import (
+    chunked,
+    pick_batch_size,
+    sentence_seed,
+    single_batch_key,
+    MAX_BATCH_SIZE,
+)
+
+GIB = 1024**3
+
+
+class TestChunked:
+    def test_splits_into_micro_batches(self):
+        """Items are grouped in order, with a short final batch"""
+        assert list(chunked([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+
+    def test_empty(self):
+        assert list(chunked([], 4)) == []
+
+
+class TestSentenceSeed:
+    def test_is_deterministic(self):
+        """The same story seed and sentence always give the same seed"""
+        assert sentence_seed(42, "A cat sits.") == sentence_seed(42, "A cat sits.")
+
+    def test_differs_per_sentence_and_story(self):
+        seed = sentence_seed(42, "A cat sits.")
+        assert seed != sentence_seed(42, "A dog runs.")
+        assert seed != sentence_seed(43, "A cat sits.")
+
+    def test_fits_torch_seed_range(self):
+        assert 0 <= sentence_seed(2**32 - 1, "x") < 2**32
+
+
+class TestPickBatchSize:
+    def test_configured_size_wins(self):
+        assert pick_batch_size(1024, 1024, 100 * GIB, configured="3") == 3
+
+    def test_auto_scales_with_free_memory(self):
+        """More free memory allows bigger batches, up to the cap"""
+        small = pick_batch_size(1024, 1024, 8 * GIB, configured="auto")
+        large = pick_batch_size(1024, 1024, 24 * GIB, configured="auto")
+
+        assert 1 <= small < large
+        assert pick_batch_size(1024, 1024, 1000 * GIB, configured="auto") == (
+            MAX_BATCH_SIZE
+        )
+
+    def test_smaller_images_fit_more_per_batch(self):
+        square = pick_batch_size(1024, 1024, 16 * GIB, configured="auto")
+        wide = pick_batch_size(1024, 576, 16 * GIB, configured="auto")
+        assert wide >= square
+
+    def test_never_below_one(self):
+        assert pick_batch_size(1024, 1024, 0, configured="auto") == 1
+        assert pick_batch_size(1024, 1024, GIB // 10, configured="auto") == 1
+
+
+class TestSingleBatchKey:
+    def test_refinements_batch_only_at_equal_strength(self):
+        text = single_batch_key("1:1", False, False)
+        refine = single_batch_key("1:1", False, False, 0.35)
+
+        assert text == "single|1:1|text|final"
+        assert refine == "single|1:1|refine@0.35|final"
+        assert refine != single_batch_key("1:1", False, False, 0.5)
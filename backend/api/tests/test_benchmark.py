@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timing import stage, collect_stages
+from benchmark import (
+    percentile,
+    summarize,
+    find_regressions,
+    peak_rss_bytes,
+    profile_row,
+)
+from generation_backend import MEMORY_PROFILES, memory_profile
+
+
+class TestStageTiming:
+    def test_collects_stages_inside_block(self):
+        """Stages are grouped by name while a collector is active"""
+        with collect_stages() as timings:
+            with stage("encode"):
+                pass
+            with stage("encode"):
+                pass
+            with stage("upload"):
+                pass
+
+        assert sorted(timings) == ["encode", "upload"]
+        assert len(timings["encode"]) == 2
+        assert all(seconds >= 0 for seconds in timings["encode"])
+
+    def test_stage_outside_collector_is_ignored(self):
+        with stage("encode"):
+            pass
+
+        with collect_stages() as timings:
+            pass
+        assert timings == {}
+
+    def test_failed_stage_is_still_timed(self):
+        with collect_stages() as timings:
+            with pytest.raises(RuntimeError):
+                with stage("upload"):
+                    raise RuntimeError("S3 down")
+
+        assert len(timings["upload"]) == 1
+
+
+class TestReport:
+    def test_percentile(self):
+        values = [1.0, 2.0, 3.0, 4.0, 5.0]
+        assert percentile(values, 50) == 3.0
+        assert percentile(values, 95) == pytest.approx(4.8)
+        assert percentile([], 50) == 0.0
+
+    def test_summarize(self):
+        summary = summarize({"diffusion": [1.0, 3.0], "empty": []})
+        assert summary == {
+            "diffusion": {"count": 2, "p50": 2.0, "p95": 2.9, "mean": 2.0}
+        }
+
+    def test_regression_threshold(self):
+        """Only slowdowns beyond the allowed ratio are reported"""
+        baseline = {"stages": {"diffusion": {"p50": 1.0, "p95": 2.0}}}
+        within = {"stages": {"diffusion": {"p50": 1.1, "p95": 2.2}}}
+        beyond = {"stages": {"diffusion": {"p50": 1.5, "p95": 2.1}}}
+        new_stage = {"stages": {"upload": {"p50": 9.0, "p95": 9.0}}}
+
+        assert find_regressions(within, baseline, 0.2) == []
+        assert len(find_regressions(beyond, baseline, 0.2)) == 1
+        assert find_regressions(new_stage, baseline, 0.2) == []
+
+
+class TestMemoryProfiles:
+    def test_profile_row(self):
+        report = {
+            "peak_rss_bytes": 3 * 1024**3,
+            "stages": {
+                "total": {"p50": 40.0, "p95": 50.0},
+                "diffusion": {"p50": 35.0, "p95": 45.0},
+            },
+        }
+
+        assert profile_row(report) == {
+            "peak_rss_mb": 3072.0,
+            "story_p50": 40.0,
+            "story_p95": 50.0,
+            "diffusion_p50": 35.0,
+        }
+
+    def test_peak_rss_is_measured(self):
+        assert peak_rss_bytes() > 1024**2
+
+    def test_profiles(self):
+        assert memory_profile("full") == {"dtype": "float32", "offload": "model"}
+        assert memory_profile("cpu-bf16")["offload"] is None
+        assert {profile["dtype"] for profile in MEMORY_PROFILES.values()} <= {
+            "float32",
+            "bfloat16",
+        }
+        with pytest.raises(ValueError):
+            memory_profile("nope")
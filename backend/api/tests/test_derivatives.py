@@ -0,0 +1,67 @@
+import base64
+import os
+import sys
+from io import BytesIO
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from derivatives import (
+    derivative_urls,
+    encode_derivatives,
+    object_urls,
+    placeholder,
+    thumbnail_url,
+)
+
+FULL = "https://bucket/storyboards/1/abc_image_1_full.jpg"
+
+
+class TestDerivatives:
+    def test_encodes_every_size_and_format(self):
+        encoded = list(encode_derivatives(Image.new("RGB", (1024, 576)), "image_1.jpg"))
+        sizes = {name: Image.open(BytesIO(data)).size for name, data, _ in encoded}
+
+        # The full-size JPEG comes first; it becomes images.image_path.
+        assert encoded[0][0] == "image_1_full.jpg"
+        assert sizes == {
+            "image_1_full.jpg": (1024, 576),
+            "image_1_full.webp": (1024, 576),
+            "image_1_medium.jpg": (512, 288),
+            "image_1_medium.webp": (512, 288),
+            "image_1_thumb.jpg": (256, 144),
+            "image_1_thumb.webp": (256, 144),
+        }
+        assert {content_type for _, _, content_type in encoded} == {
+            "image/jpeg",
+            "image/webp",
+        }
+
+    def test_urls_follow_the_full_image(self):
+        urls = derivative_urls(FULL)
+
+        assert urls["full"]["jpeg"] == FULL
+        assert (
+            urls["thumb"]["webp"]
+            == "https://bucket/storyboards/1/abc_image_1_thumb.webp"
+        )
+        assert (
+            thumbnail_url(FULL) == "https://bucket/storyboards/1/abc_image_1_thumb.jpg"
+        )
+        assert len(object_urls(FULL)) == 6
+
+    def test_legacy_images_have_no_derivatives(self):
+        legacy = "https://bucket/storyboards/1/abc_image_1.jpg"
+
+        assert derivative_urls(legacy) is None
+        assert thumbnail_url(legacy) == legacy
+        assert object_urls(legacy) == [legacy]
+
+    def test_placeholder_is_a_tiny_data_uri(self):
+        preview = placeholder(Image.new("RGB", (1024, 576), "white"))
+        header, data = preview.split(",", 1)
+
+        assert header == "data:image/webp;base64"
+        assert len(preview) < 400
+        assert Image.open(BytesIO(base64.b64decode(data))).size == (16, 9)
@@ -0,0 +1,765 @@
+import json
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from generation_backend import (
+    ReplicaPool,
+    StubBackend,
+    create_backend,
+    loaded_backend,
+    set_backend,
+    warm_start,
+)
+import batch_generator
+from pose_cache import PoseCache, PoseNotFound, pose_id_for, store_source
+import worker
+from job_queue import (
+    JobCancelled,
+    cancel_job,
+    claim_job,
+    enqueue_job,
+    CANCELLED,
+    COMPLETED,
+    FAILED,
+    REPLACED,
+)
+
+
+class TestStubBackend:
+    def test_is_deterministic_per_prompt_and_seed(self):
+        """Same prompt and seed give the same pixels, regardless of batch"""
+        backend = StubBackend()
+        alone = backend.text_to_image(["a cat"], "neg", [1], 64, 32, 2, 8.5)[0]
+        batched = backend.text_to_image(
+            ["a dog", "a cat"], "neg", [5, 1], 64, 32, 2, 8.5
+        )[1]
+        other_seed = backend.text_to_image(["a cat"], "neg", [2], 64, 32, 2, 8.5)[0]
+
+        assert alone.size == (64, 32)
+        assert alone.tobytes() == batched.tobytes()
+        assert alone.tobytes() != other_seed.tobytes()
+
+    def test_reports_every_step(self):
+        steps = []
+        StubBackend().text_to_image(
+            ["a cat"], "neg", [1], 32, 32, 4, 8.5, on_step=steps.append
+        )
+        assert steps == [1, 2, 3, 4]
+
+    def test_pose_output_matches_pose_map_size(self):
+        backend = StubBackend()
+        pose_map = backend.detect_pose(Image.new("RGB", (300, 200)), 64, 128)
+        image = backend.pose_to_image(["a cat"], "neg", [1], [pose_map], 1, 8.5)[0]
+
+        assert pose_map.size == (128, 128)
+        assert image.size == (128, 128)
+
+    def test_refine_runs_a_share_of_the_steps(self):
+        """img2img keeps the source's size and only runs the tail of the schedule"""
+        backend = StubBackend()
+        source = Image.new("RGB", (64, 32), (0, 0, 0))
+        steps = []
+
+        (image,) = backend.image_to_image(
+            ["a cat"], "neg", [1], [source], 0.3, 30, 8.5, on_step=steps.append
+        )
+
+        assert steps == list(range(1, 10))
+        assert image.size == (64, 32)
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            create_backend("nope")
+
+
+class TestWarmStart:
+    def test_warms_every_shape_on_every_replica(self, tmp_path):
+        pool = create_backend("stub", replicas=2)
+        plan = {"text_to_image": [(1024, 1024, 1), (512, 512, 3)]}
+        report_path = str(tmp_path / "cache" / "warm_start.json")
+
+        with patch.object(
+            StubBackend, "text_to_image", autospec=True, return_value=[]
+        ) as text_to_image:
+            report = warm_start(pool, plan, "neg", 8.5, report_path=report_path)
+
+        # Two calls per shape, each split over both replicas.
+        assert text_to_image.call_count == 2 * 2 * 2
+        assert {call.args[0] for call in text_to_image.call_args_list} == set(
+            pool.backends
+        )
+        assert (
+            sorted(len(call.args[1]) for call in text_to_image.call_args_list)
+            == [1] * 4 + [3] * 4
+        )
+        text = report["pipelines"]["text_to_image"]
+        assert set(text["sizes"]) == {"1024x1024 batch 1", "512x512 batch 3"}
+        assert report["pipelines"]["pose_to_image"] == {"skipped": True, "sizes": {}}
+        assert report["previous_startup_seconds"] is None
+        with open(report_path) as f:
+            assert json.load(f)["pipelines"] == report["pipelines"]
+
+    def test_warms_with_the_production_call_arguments(self):
+        """Guidance above 1 doubles the UNet batch, so warmup must match it"""
+        backend = StubBackend()
+        plan = batch_generator.warmup_plan(backend)
+
+        with patch.object(
+            StubBackend, "text_to_image", autospec=True, return_value=[]
+        ) as text_to_image, patch.object(
+            StubBackend, "pose_to_image", autospec=True, return_value=[]
+        ) as pose_to_image, patch.object(
+            StubBackend, "image_to_image", autospec=True, return_value=[]
+        ) as image_to_image:
+            warm_start(
+                backend,
+                plan,
+                batch_generator.NEGATIVE_PROMPT,
+                batch_generator.GUIDANCE_SCALE,
+            )
+
+        for call in text_to_image.call_args_list:
+            assert call.args[2] == batch_generator.NEGATIVE_PROMPT
+            assert call.args[7] == batch_generator.GUIDANCE_SCALE
+        for call in pose_to_image.call_args_list + image_to_image.call_args_list:
+            assert call.args[2] == batch_generator.NEGATIVE_PROMPT
+            assert call.args[-1] == batch_generator.GUIDANCE_SCALE
+        # The input image sets the render size.
+        assert {
+            (*call.args[4][0].size, len(call.args[4]))
+            for call in pose_to_image.call_args_list
+        } == set(plan["pose_to_image"])
+        assert {
+            (*call.args[4][0].size, len(call.args[4]))
+            for call in image_to_image.call_args_list
+        } == set(plan["image_to_image"])
+
+    def test_plan_uses_the_batch_sizes_the_scheduler_sends(self):
+        pool = create_backend("stub", replicas=2)
+
+        with patch.object(
+            batch_generator, "pick_batch_size", return_value=3
+        ), patch.object(batch_generator, "REGENERATE_MAX_BATCH", 4):
+            plan = batch_generator.warmup_plan(pool)
+
+        # Stories: 3 per replica; regenerations: 4 over 2 replicas; or one.
+        assert {batch for _, _, batch in plan["text_to_image"]} == {1, 2, 3}
+        assert len(plan["text_to_image"]) == 6 * 3
+        assert plan["pose_to_image"] == [
+            (512, 512, 1),
+            (512, 512, 2),
+            (1024, 1024, 1),
+            (1024, 1024, 2),
+        ]
+        assert {(w, h) for w, h, _ in plan["image_to_image"]} == {
+            (576, 1024),
+            (1024, 576),
+            (1024, 1024),
+        }
+
+    def test_reports_the_previous_boot(self, tmp_path):
+        report_path = str(tmp_path / "warm_start.json")
+        plan = {"text_to_image": [(64, 64, 1)]}
+        first = warm_start(StubBackend(), plan, "", 8.5, report_path=report_path)
+
+        second = warm_start(StubBackend(), plan, "", 8.5, report_path=report_path)
+
+        assert second["previous_startup_seconds"] == first["startup_seconds"]
+
+
+class TestBatchGenerationWithStub:
+    def test_story_panels_are_saved_in_order_and_deduplicated(self, session_factory):
+        """Repeated sentences are rendered once but still get their own panel"""
+        uploads = []
+
+        def fake_upload(data, filename, folder="images", **kwargs):
+            uploads.append(filename)
+            return f"https://bucket/{folder}/{filename}"
+
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=StubBackend()
+        ), patch.object(
+            batch_generator,
+            "get_resolved_sentences",
+            return_value=["A cat sits.", "A dog runs.", "A cat sits."],
+        ), patch.object(
+            batch_generator, "upload_image_to_s3", side_effect=fake_upload
+        ):
+            batch_generator.generate_batch_images("story", 1, "16:9", seed=7)
+
+        db = session_factory()
+        images = db.query(models.Image).order_by(models.Image.id).all()
+
+        assert [image.caption for image in images] == [
+            "A cat sits.",
+            "A dog runs.",
+            "A cat sits.",
+        ]
+        assert images[0].image_path == images[2].image_path
+        assert images[1].derivatives["thumb"]["webp"].endswith("image_2_thumb.webp")
+        assert images[1].placeholder.startswith("data:image/webp;base64,")
+        assert images[0].placeholder == images[2].placeholder
+        assert images[0].seed == images[2].seed
+        assert [name for name in uploads if name.endswith("_full.jpg")] == [
+            "image_1_full.jpg",
+            "image_2_full.jpg",
+        ]
+        assert len(uploads) == 12
+
+    def test_failed_upload_fails_the_batch(self, session_factory):
+        """An upload error on a background thread is not swallowed"""
+
+        def failing_upload(data, filename, folder="images", **kwargs):
+            raise IOError("S3 is down")
+
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=StubBackend()
+        ), patch.object(
+            batch_generator,
+            "get_resolved_sentences",
+            return_value=["A cat sits.", "A dog runs."],
+        ), patch.object(
+            batch_generator, "upload_image_to_s3", side_effect=failing_upload
+        ):
+            with pytest.raises(IOError, match="S3 is down"):
+                batch_generator.generate_batch_images("story", 1, "1:1", seed=7)
+
+        assert session_factory().query(models.Image).count() == 0
+
+
+class TestDraftMode:
+    def test_drafts_are_stored_then_finalized(self, session_factory):
+        """Draft panels are small and provisional until the finalize job runs"""
+        sizes = {}
+
+        def fake_upload(data, filename, folder="images", **kwargs):
+            path = f"https://bucket/{folder}/{len(sizes)}_{filename}"
+            sizes[path] = Image.open(BytesIO(data)).size
+            return path
+
+        db = session_factory()
+        db.add(models.Storyboard(id=1, name="s", owner_id=3, thumbnail=""))
+        db.commit()
+
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=StubBackend()
+        ), patch.object(
+            batch_generator,
+            "get_resolved_sentences",
+            return_value=["A cat sits.", "A dog runs."],
+        ), patch.object(
+            batch_generator, "upload_image_to_s3", side_effect=fake_upload
+        ):
+            panels = batch_generator.generate_batch_images(
+                "story", 1, "1:1", seed=7, draft=True
+            )
+
+            db.expire_all()
+            drafts = db.query(models.Image).order_by(models.Image.id).all()
+            job = db.query(models.GenerationJob).one()
+
+            assert all(image.is_draft for image in drafts)
+            assert {sizes[image.image_path] for image in drafts} == {(512, 512)}
+            assert job.kind == "finalize"
+            assert job.owner_id == 3
+            assert job.payload["panels"] == panels
+
+            replaced = batch_generator.finalize_images(job.payload["panels"], "1:1")
+
+        db.expire_all()
+        finals = db.query(models.Image).order_by(models.Image.id).all()
+
+        assert [image.id for image in finals] == [image["id"] for image in replaced]
+        assert not any(image.is_draft for image in finals)
+        assert {sizes[image.image_path] for image in finals} == {(1024, 1024)}
+        assert [image.seed for image in finals] == [panel["seed"] for panel in panels]
+
+    def test_panel_with_a_missing_pose_keeps_its_draft(self, session_factory, tmp_path):
+        """One pose no worker can find does not fail the other panels"""
+        db = session_factory()
+        db.add(models.Storyboard(id=1, name="s", owner_id=3, thumbnail=""))
+        for num in range(2):
+            db.add(
+                models.Image(
+                    id=num + 1, storyboard_id=1, image_path=f"d{num}", is_draft=True
+                )
+            )
+        db.commit()
+        panels = [
+            {"image_id": 1, "prompt": "A cat.", "seed": 1, "image_path": "d0"},
+            {
+                "image_id": 2,
+                "prompt": "A dog.",
+                "seed": 2,
+                "image_path": "d1",
+                "pose_id": pose_id_for(b"gone"),
+            },
+        ]
+
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=StubBackend()
+        ), patch.object(
+            batch_generator, "pose_cache", PoseCache(str(tmp_path), 1024**2)
+        ), patch.object(
+            batch_generator,
+            "upload_image_to_s3",
+            side_effect=lambda data, filename, folder="images", **kwargs: filename,
+        ):
+            replaced = batch_generator.finalize_images(panels, "1:1")
+
+        db.expire_all()
+        assert [image["id"] for image in replaced] == [1]
+        assert db.get(models.Image, 2).is_draft
+        assert db.get(models.Image, 2).image_path == "d1"
+
+
+class TestPoseSources:
+    def test_another_host_reads_the_upload_from_the_database(self, db, tmp_path):
+        upload = BytesIO()
+        Image.new("RGB", (64, 64), (255, 0, 0)).save(upload, format="PNG")
+        pose_id = pose_id_for(upload.getvalue())
+        store_source(db, pose_id, upload.getvalue())
+
+        with patch.object(
+            batch_generator, "get_backend", return_value=StubBackend()
+        ), patch.object(
+            batch_generator, "pose_cache", PoseCache(str(tmp_path), 1024**2)
+        ):
+            pose_map = batch_generator.extract_pose_map(db, pose_id)
+
+        assert pose_map.size == (1024, 1024)
+        assert (tmp_path / f"{pose_id}_source.png").exists()
+
+    def test_unknown_pose_asks_for_a_new_upload(self, db, tmp_path):
+        with patch.object(
+            batch_generator, "pose_cache", PoseCache(str(tmp_path), 1024**2)
+        ):
+            with pytest.raises(PoseNotFound, match="upload the pose image again"):
+                batch_generator.extract_pose_map(db, pose_id_for(b"gone"))
+
+
+class TestRegenerationBatching:
+    def test_compatible_regenerations_share_one_pipeline_call(self, session_factory):
+        """Queued regenerations are rendered together and routed to their jobs"""
+        db = session_factory()
+        db.add_all(
+            [
+                models.Image(id=i, image_path="old", caption="old", storyboard_id=1)
+                for i in (1, 2, 3)
+            ]
+        )
+        db.commit()
+
+        key = "single|1:1|text|final"
+        jobs = [
+            enqueue_job(
+                db,
+                "single",
+                {"image_id": image_id, "caption": f"panel {image_id}", "seed": 1},
+                batch_key=key,
+            )
+            for image_id in (1, 2, 99, 3)
+        ]
+        other = enqueue_job(
+            db,
+            "single",
+            {"image_id": 1, "caption": "wide", "resolution": "16:9"},
+            batch_key="single|16:9|text|final",
+        )
+
+        backend = StubBackend()
+        with patch.object(worker, "SessionLocal", session_factory), patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=backend
+        ), patch.object(
+            batch_generator, "detect_and_translate_to_english", side_effect=str
+        ), patch.object(
+            batch_generator,
+            "upload_image_to_s3",
+            side_effect=lambda data, filename, folder, **kwargs: f"{folder}/{filename}",
+        ), patch.object(
+            backend, "text_to_image", wraps=backend.text_to_image
+        ) as text_to_image:
+            assert worker.process_next_job(batch_window=0, max_batch=4)
+
+        assert text_to_image.call_count == 1
+        assert len(text_to_image.call_args.args[0]) == 3
+
+        db.expire_all()
+        statuses = [db.get(models.GenerationJob, job.id) for job in jobs]
+        assert [job.status for job in statuses] == [
+            COMPLETED,
+            COMPLETED,
+            FAILED,
+            COMPLETED,
+        ]
+        assert statuses[3].result == {
+            "image_id": 3,
+            "image_path": "storyboards/1/image_3_full.jpg",
+        }
+        assert "99" in statuses[2].error
+        assert db.get(models.GenerationJob, other.id).status == "queued"
+        assert db.get(models.Image, 2).caption == "panel 2"
+
+
+class TestRefine:
+    def test_refine_starts_from_the_current_panel(self, session_factory):
+        """A caption edit re-renders the stored panel with a few steps"""
+        db = session_factory()
+        db.add(
+            models.Image(id=1, image_path="old.jpg", caption="a cat", storyboard_id=1)
+        )
+        db.commit()
+        source = BytesIO()
+        Image.new("RGB", (64, 64), (0, 0, 0)).save(source, format="JPEG")
+        job = enqueue_job(db, "single", {"image_id": 1})
+        claim_job(db)
+
+        backend = StubBackend()
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=backend
+        ), patch.object(
+            batch_generator, "detect_and_translate_to_english", side_effect=str
+        ), patch.object(
+            batch_generator, "download_image_from_s3", return_value=source.getvalue()
+        ) as download, patch.object(
+            batch_generator,
+            "encode_and_upload",
+            side_effect=lambda image, filename, folder: (filename, None),
+        ), patch.object(
+            backend, "image_to_image", wraps=backend.image_to_image
+        ) as image_to_image, patch.object(
+            backend, "text_to_image"
+        ) as text_to_image:
+            image = batch_generator.generate_single_image(
+                1,
+                "a cat with a hat",
+                seed=5,
+                job_id=job.id,
+                mode="refine",
+                strength=0.5,
+            )
+
+        download.assert_called_once_with("old.jpg")
+        text_to_image.assert_not_called()
+        init_images, strength = image_to_image.call_args.args[3:5]
+        assert init_images[0].size == (1024, 1024)
+        assert strength == 0.5
+        assert image.caption == "a cat with a hat"
+        assert image.image_path == "image_1.jpg"
+        db.expire_all()
+        progress = db.get(models.GenerationJob, job.id).progress
+        assert progress["step"] == progress["steps"] == 15
+
+
+class TestReplicaPool:
+    def test_results_match_a_single_replica(self):
+        """Splitting a call over replicas keeps order and pixels"""
+        pool = create_backend("stub", replicas=3)
+        prompts = [f"panel {num}" for num in range(5)]
+        seeds = list(range(5))
+
+        pooled = pool.text_to_image(prompts, "neg", seeds, 32, 32, 1, 8.5)
+        single = StubBackend().text_to_image(prompts, "neg", seeds, 32, 32, 1, 8.5)
+
+        assert isinstance(pool, ReplicaPool)
+        assert [image.tobytes() for image in pooled] == [
+            image.tobytes() for image in single
+        ]
+
+    def test_refinements_match_a_single_replica(self):
+        pool = create_backend("stub", replicas=2)
+        sources = [Image.new("RGB", (32, 32), (num, num, num)) for num in range(3)]
+        args = (["a", "b", "c"], "neg", [1, 2, 3], sources, 0.5, 4, 8.5)
+
+        pooled = pool.image_to_image(*args)
+        single = StubBackend().image_to_image(*args)
+
+        assert [image.tobytes() for image in pooled] == [
+            image.tobytes() for image in single
+        ]
+
+    def test_cancelling_stops_every_replica(self):
+        """No replica keeps denoising once the call was cancelled"""
+
+        class CountingStub(StubBackend):
+            steps = 0
+
+            def _run_steps(self, steps, on_step):
+                def counted(step):
+                    self.steps = step
+                    if on_step is not None:
+                        on_step(step)
+
+                super()._run_steps(steps, counted)
+
+        replicas = [CountingStub(step_latency=0.005) for _ in range(2)]
+        pool = ReplicaPool(replicas)
+        reported = []
+
+        def on_step(step):
+            reported.append(step)
+            if step == 2:
+                raise JobCancelled(1)
+
+        with pytest.raises(JobCancelled):
+            pool.text_to_image(["a", "b"], "neg", [1, 2], 16, 16, 200, 8.5, on_step)
+
+        # Both replicas stopped and are free again when the call returns.
+        assert pool._idle.qsize() == 2
+        assert all(replica.steps < 20 for replica in replicas)
+        assert reported == [1, 2]
+
+    def test_story_throughput_scales_with_replicas(self, session_factory):
+        """Each replica renders its share of a story's sentences in parallel"""
+        sentences = [f"Sentence {num}." for num in range(8)]
+
+        def render_story(replicas):
+            pool = ReplicaPool(
+                [StubBackend(step_latency=0.03) for _ in range(replicas)]
+            )
+            with patch.object(
+                batch_generator, "SessionLocal", session_factory
+            ), patch.object(
+                batch_generator, "get_backend", return_value=pool
+            ), patch.object(
+                batch_generator, "get_resolved_sentences", return_value=sentences
+            ), patch.object(
+                batch_generator, "pick_batch_size", return_value=1
+            ), patch.object(
+                batch_generator,
+                "encode_and_upload",
+                side_effect=lambda image, filename, folder: (filename, None),
+            ), patch.object(
+                batch_generator, "NUM_INFERENCE_STEPS", 5
+            ):
+                start = time.perf_counter()
+                panels = batch_generator.generate_batch_images(
+                    "story", 1, "1:1", seed=replicas
+                )
+                elapsed = time.perf_counter() - start
+            assert len(panels) == len(sentences)
+            return elapsed
+
+        one = render_story(1)
+        four = render_story(4)
+
+        # 8 sequential calls against 2 rounds of 4 parallel calls.
+        assert four < one / 2
+
+
+class TestWorkerConcurrency:
+    def test_one_thread_per_replica(self):
+        previous = loaded_backend()
+        try:
+            set_backend(StubBackend())
+            assert worker.thread_count(4) == 1
+            set_backend(create_backend("stub", replicas=3))
+            assert worker.thread_count(4) == 3
+            assert worker.thread_count(2) == 2
+            assert worker.thread_count(0) == 1
+        finally:
+            set_backend(previous)
+
+
+class TestCancellation:
+    def test_cancelled_story_stops_between_steps(self, session_factory):
+        """Remaining sentences are not rendered once the job is cancelled"""
+        db = session_factory()
+        job = enqueue_job(db, "batch", {"story": "s"}, storyboard_id=1)
+        claim_job(db)
+
+        class CancellingBackend(StubBackend):
+            calls = 0
+
+            def text_to_image(self, *args, **kwargs):
+                CancellingBackend.calls += 1
+                if CancellingBackend.calls == 2:
+                    cancel_job(db, job)
+                return super().text_to_image(*args, **kwargs)
+
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=CancellingBackend()
+        ), patch.object(
+            batch_generator,
+            "get_resolved_sentences",
+            return_value=[f"Sentence {num}." for num in range(4)],
+        ), patch.object(
+            batch_generator, "pick_batch_size", return_value=1
+        ), patch.object(
+            batch_generator,
+            "encode_and_upload",
+            side_effect=lambda image, filename, folder: (filename, None),
+        ):
+            with pytest.raises(JobCancelled):
+                batch_generator.generate_batch_images(
+                    "story", 1, "1:1", seed=1, job_id=job.id
+                )
+
+        db.expire_all()
+        assert CancellingBackend.calls == 2
+        assert db.get(models.GenerationJob, job.id).status == CANCELLED
+        assert db.query(models.Image).count() <= 1
+
+    @pytest.mark.parametrize("reason", [REPLACED, None])
+    def test_drafts_are_finalized_only_when_the_story_is_replaced(
+        self, session_factory, reason
+    ):
+        """A new story keeps the drafts it replaced; a plain cancel drops them"""
+        db = session_factory()
+        db.add(models.Storyboard(id=1, name="s", owner_id=3, thumbnail=""))
+        db.commit()
+        job = enqueue_job(db, "batch", {"story": "s"}, storyboard_id=1, owner_id=3)
+        two_saved = threading.Event()
+        save_panel = batch_generator.save_panel
+
+        def counting_save_panel(session, db_image):
+            saved = save_panel(session, db_image)
+            if db_image.sentence_index == 1:
+                two_saved.set()
+            return saved
+
+        class CancellingBackend(StubBackend):
+            calls = 0
+
+            def text_to_image(self, *args, on_step=None, **kwargs):
+                CancellingBackend.calls += 1
+                if CancellingBackend.calls == 3:
+                    # Let the first panels be saved, then stop as the step
+                    # callback of a cancelled job would.
+                    assert two_saved.wait(5)
+                    cancel_job(db, job, reason)
+                    raise JobCancelled(job.id)
+                return super().text_to_image(*args, **kwargs)
+
+        with patch.object(
+            batch_generator, "SessionLocal", session_factory
+        ), patch.object(
+            batch_generator, "get_backend", return_value=CancellingBackend()
+        ), patch.object(
+            batch_generator,
+            "get_resolved_sentences",
+            return_value=[f"Sentence {num}." for num in range(4)],
+        ), patch.object(
+            batch_generator, "pick_batch_size", return_value=1
+        ), patch.object(
+            batch_generator, "save_panel", side_effect=counting_save_panel
+        ), patch.object(
+            batch_generator,
+            "encode_and_upload",
+            side_effect=lambda image, filename, folder: (filename, None),
+        ):
+            with pytest.raises(JobCancelled):
+                batch_generator.generate_batch_images(
+                    "story", 1, "1:1", seed=1, job_id=job.id, draft=True
+                )
+
+        db.expire_all()
+        drafts = db.query(models.Image).order_by(models.Image.id).all()
+        finalize = db.query(models.GenerationJob).filter_by(kind="finalize").all()
+        assert len(drafts) == 2
+        if reason is None:
+            assert finalize == []
+        else:
+            assert [panel["image_id"] for panel in finalize[0].payload["panels"]] == [
+                image.id for image in drafts
+            ]
+
+
+class TestResume:
+    def test_interrupted_story_resumes_without_duplicates(self, session_factory):
+        """A rerun renders only the sentences the lost attempt didn't save"""
+        db = session_factory()
+        job = enqueue_job(db, "batch", {"story": "s"}, storyboard_id=1)
+        claim_job(db)
+        rendered = []
+
+        class CountingBackend(StubBackend):
+            def text_to_image(self, prompts, *args, **kwargs):
+                rendered.extend(prompts)
+                return super().text_to_image(prompts, *args, **kwargs)
+
+        def run(sentences):
+            with patch.object(
+                batch_generator, "SessionLocal", session_factory
+            ), patch.object(
+                batch_generator, "get_backend", return_value=CountingBackend()
+            ), patch.object(
+                batch_generator, "get_resolved_sentences", return_value=sentences
+            ), patch.object(
+                # One micro-batch, so progress updates never overlap the
+                # persist thread on the shared test connection.
+                batch_generator,
+                "pick_batch_size",
+                return_value=4,
+            ), patch.object(
+                batch_generator,
+                "encode_and_upload",
+                side_effect=lambda image, filename, folder: (filename, None),
+            ):
+                return batch_generator.generate_batch_images(
+                    "story", 1, "1:1", seed=1, job_id=job.id
+                )
+
+        run([f"Sentence {num}." for num in range(4)])
+        # The worker died before the last two panels reached the database.
+        db.query(models.Image).filter(models.Image.sentence_index >= 2).delete()
+        db.query(models.GenerationCacheEntry).delete()
+        db.commit()
+        rendered.clear()
+
+        # The retry keeps the sentences of the first attempt.
+        panels = run(["Something else."])
+
+        assert len(rendered) == 2
+        assert [panel["prompt"] for panel in panels] == [
+            f"Sentence {num}." for num in range(4)
+        ]
+        images = db.query(models.Image).order_by(models.Image.sentence_index).all()
+        assert [image.sentence_index for image in images] == [0, 1, 2, 3]
+        assert [image.caption for image in images] == [
+            f"Sentence {num}." for num in range(4)
+        ]
+
+    def test_panel_saved_by_another_attempt_is_reused(self, session_factory):
+        db = session_factory()
+        job = enqueue_job(db, "batch", {"story": "s"}, storyboard_id=1)
+        first = batch_generator.save_panel(
+            db,
+            models.Image(
+                storyboard_id=1, image_path="a", job_id=job.id, sentence_index=0
+            ),
+        )
+
+        second = batch_generator.save_panel(
+            db,
+            models.Image(
+                storyboard_id=1, image_path="b", job_id=job.id, sentence_index=0
+            ),
+        )
+
+        assert second.id == first.id
+        assert db.query(models.Image).count() == 1
@@ -0,0 +1,322 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from database import Base
+from job_queue import (
+    enqueue_job,
+    claim_job,
+    claim_jobs,
+    fair_order,
+    last_served,
+    cancel_job,
+    cancel_storyboard_jobs,
+    update_job_progress,
+    update_job_payload,
+    requeue_stale_jobs,
+    touch_jobs,
+    find_job_by_key,
+    retry_job,
+    CANCELLED,
+    complete_job,
+    fail_job,
+    get_job,
+    QUEUED,
+    RUNNING,
+    COMPLETED,
+    FAILED,
+    wait_for_job,
+)
+
+
+class TestJobQueue:
+    def test_enqueue_creates_queued_job(self, db):
+        """Enqueued jobs are persisted with their payload"""
+        job = enqueue_job(db, "batch", {"story": "A cat.", "resolution": "1:1"})
+
+        stored = get_job(db, job.id)
+        assert stored.status == QUEUED
+        assert stored.payload["story"] == "A cat."
+        assert stored.attempts == 0
+
+    def test_claim_returns_oldest_job_first(self, db):
+        """Jobs are claimed in FIFO order and marked running"""
+        first = enqueue_job(db, "batch", {"story": "first"})
+        enqueue_job(db, "batch", {"story": "second"})
+
+        claimed = claim_job(db)
+
+        assert claimed.id == first.id
+        assert claimed.status == RUNNING
+        assert claimed.attempts == 1
+        assert claimed.started_at is not None
+
+    def test_claimed_job_is_not_claimed_twice(self, db):
+        """A running job is never handed to a second worker"""
+        enqueue_job(db, "batch", {"story": "only"})
+
+        assert claim_job(db) is not None
+        assert claim_job(db) is None
+
+    def test_complete_and_fail(self, db):
+        """Finishing a job records its outcome and drops the pose upload"""
+        ok = enqueue_job(db, "single", {"image_id": 1}, pose_image=b"png")
+        bad = enqueue_job(db, "single", {"image_id": 2})
+
+        complete_job(db, claim_job(db), {"image_id": 1})
+        fail_job(db, claim_job(db), "boom")
+
+        ok, bad = get_job(db, ok.id), get_job(db, bad.id)
+        assert ok.status == COMPLETED
+        assert ok.result == {"image_id": 1}
+        assert ok.pose_image is None
+        assert bad.status == FAILED
+        assert bad.error == "boom"
+
+    def test_claim_jobs_only_takes_matching_batch_key(self, db):
+        """Compatible regenerations are claimed together, up to the limit"""
+        a = enqueue_job(db, "single", {"image_id": 1}, batch_key="single|1:1")
+        enqueue_job(db, "single", {"image_id": 2}, batch_key="single|16:9")
+        b = enqueue_job(db, "single", {"image_id": 3}, batch_key="single|1:1")
+        enqueue_job(db, "single", {"image_id": 4}, batch_key="single|1:1")
+
+        claimed = claim_jobs(db, "single|1:1", 2)
+
+        assert [job.id for job in claimed] == [a.id, b.id]
+        assert all(job.status == RUNNING for job in claimed)
+        assert claim_jobs(db, "single|1:1", 0) == []
+
+
+class TestWaitForJob:
+    def test_waiting_does_not_hold_a_connection(self, tmp_path):
+        """A pool of one connection still serves others while a job is awaited"""
+        engine = create_engine(
+            f"sqlite:///{tmp_path / 'jobs.db'}",
+            poolclass=QueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=1,
+        )
+        Base.metadata.create_all(bind=engine)
+        factory = sessionmaker(bind=engine)
+        with factory() as db:
+            job_id = enqueue_job(db, "single", {}).id
+
+        async def wait_and_finish():
+            waiting = asyncio.ensure_future(
+                wait_for_job(factory, job_id, 5, poll_interval=0.01)
+            )
+            await asyncio.sleep(0.05)
+            with factory() as db:
+                complete_job(db, get_job(db, job_id))
+            return await waiting
+
+        job = asyncio.run(wait_and_finish())
+
+        assert job.status == COMPLETED
+
+    def test_gives_up_after_the_timeout(self, session_factory):
+        with session_factory() as db:
+            job_id = enqueue_job(db, "single", {}).id
+
+        with pytest.raises(TimeoutError):
+            asyncio.run(wait_for_job(session_factory, job_id, 0.05, 0.01))
+
+
+class TestFairScheduling:
+    def test_interactive_jobs_jump_ahead_of_stories(self, db):
+        enqueue_job(db, "batch", {"story": "long"}, owner_id=1)
+        single = enqueue_job(db, "single", {"image_id": 1}, owner_id=2)
+
+        assert claim_job(db).id == single.id
+
+    def test_users_take_turns(self, db):
+        """A user with a backlog does not starve someone who queued later"""
+        heavy = [enqueue_job(db, "batch", {"n": n}, owner_id=1) for n in range(3)]
+        light = enqueue_job(db, "batch", {"n": 0}, owner_id=2)
+
+        claimed = []
+        for _ in range(4):
+            job = claim_job(db)
+            claimed.append(job.id)
+            complete_job(db, job)
+
+        assert claimed == [heavy[0].id, light.id, heavy[1].id, heavy[2].id]
+
+    def test_running_limit_per_user(self, db):
+        for n in range(3):
+            enqueue_job(db, "batch", {"n": n}, owner_id=1)
+
+        assert claim_job(db) is not None
+        assert claim_job(db) is not None
+        # MAX_RUNNING_JOBS_PER_USER defaults to 2
+        assert claim_job(db) is None
+
+    def test_running_stories_do_not_block_a_regeneration(self, db):
+        for n in range(2):
+            enqueue_job(db, "batch", {"n": n}, owner_id=1)
+        assert claim_job(db) is not None
+        assert claim_job(db) is not None
+        single = enqueue_job(db, "single", {"image_id": 1}, owner_id=1)
+
+        assert claim_job(db).id == single.id
+
+    def test_batched_claims_are_fair_and_limited(self, db):
+        """Joining a batch does not take anyone past their running limit"""
+        key = "single|1:1"
+        heavy = [
+            enqueue_job(db, "single", {"n": n}, owner_id=1, batch_key=key)
+            for n in range(3)
+        ]
+        light = enqueue_job(db, "single", {"n": 0}, owner_id=2, batch_key=key)
+
+        claimed = claim_jobs(db, key, 2)
+        assert [job.id for job in claimed] == [heavy[0].id, light.id]
+
+        # MAX_RUNNING_JOBS_PER_USER defaults to 2
+        assert [job.id for job in claim_jobs(db, key, 4)] == [heavy[1].id]
+
+    def test_fair_order_counts_running_jobs(self):
+        candidates = [(1, 7, 1), (2, 7, 1), (3, 8, 1)]
+
+        assert fair_order(candidates, {}, max_running=0) == [1, 3, 2]
+        assert fair_order(candidates, {(8, 1): 1}, max_running=0) == [1, 2, 3]
+        assert fair_order(candidates, {(7, 1): 1}, max_running=1) == [3]
+        # The limit is per class.
+        assert fair_order(candidates, {(7, 0): 1}, max_running=1) == [1, 3, 2]
+
+    def test_last_served_looks_at_recent_jobs_of_given_owners(self, db):
+        now = datetime.now(timezone.utc)
+        for owner_id, minutes in [(1, 5), (2, 5), (3, 120)]:
+            job = enqueue_job(db, "batch", {}, owner_id=owner_id)
+            job.started_at = now - timedelta(minutes=minutes)
+        db.commit()
+
+        served = last_served(db, [1, 3, None], window=3600)
+
+        assert set(served) == {1}
+        assert last_served(db, []) == {}
+
+    def test_fair_order_prefers_least_recently_served(self):
+        candidates = [(1, 7, 1), (2, 8, 1)]
+        now = datetime.now(timezone.utc)
+
+        assert fair_order(candidates, {}, {7: now}, max_running=0) == [2, 1]
+        assert fair_order(
+            candidates, {}, {7: now - timedelta(minutes=1), 8: now}, max_running=0
+        ) == [1, 2]
+
+
+class TestCancellation:
+    def test_cancel_queued_job(self, db):
+        job = enqueue_job(db, "batch", {"story": "s"}, pose_image=b"png")
+
+        assert cancel_job(db, job)
+        assert job.status == CANCELLED
+        assert job.pose_image is None
+        assert claim_job(db) is None
+
+    def test_running_job_stays_cancelled(self, db):
+        """The worker notices at its next step and cannot overwrite the status"""
+        job = enqueue_job(db, "batch", {"story": "s"})
+        claimed = claim_job(db)
+        assert update_job_progress(db, job.id, step=1)
+
+        cancel_job(db, job)
+
+        assert not update_job_progress(db, job.id, step=2)
+        complete_job(db, claimed, {"storyboard_id": 1})
+        assert get_job(db, job.id).status == CANCELLED
+
+    def test_finished_job_cannot_be_cancelled(self, db):
+        job = enqueue_job(db, "batch", {"story": "s"})
+        complete_job(db, claim_job(db))
+
+        assert not cancel_job(db, job)
+        assert job.status == COMPLETED
+
+    def test_cancel_storyboard_jobs(self, db):
+        db.add(models.Storyboard(id=1, name="s", owner_id=1, thumbnail=""))
+        db.add(models.Storyboard(id=2, name="t", owner_id=1, thumbnail=""))
+        db.commit()
+        batch = enqueue_job(db, "batch", {"story": "s"}, storyboard_id=1)
+        single = enqueue_job(db, "single", {"image_id": 1}, storyboard_id=1)
+        other = enqueue_job(db, "batch", {"story": "t"}, storyboard_id=2)
+
+        assert cancel_storyboard_jobs(db, 1, kinds=["batch"]) == [batch.id]
+        assert cancel_storyboard_jobs(db, 1) == [single.id]
+        assert get_job(db, other.id).status == QUEUED
+
+
+class TestRecovery:
+    def test_stale_running_job_is_requeued(self, db):
+        """A job whose worker stopped checking in goes back to the queue"""
+        job = enqueue_job(db, "batch", {"story": "s"})
+        claim_job(db)
+
+        assert requeue_stale_jobs(db, stale_after=60) == []
+        job.heartbeat_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+        db.commit()
+
+        assert requeue_stale_jobs(db, stale_after=60) == [job.id]
+        assert get_job(db, job.id).status == QUEUED
+        assert claim_job(db).attempts == 2
+
+    def test_heartbeat_keeps_job_running(self, db):
+        job = enqueue_job(db, "batch", {"story": "s"})
+        claim_job(db)
+        job.heartbeat_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+        db.commit()
+
+        touch_jobs(db, [job.id])
+
+        assert requeue_stale_jobs(db, stale_after=60) == []
+        assert get_job(db, job.id).status == RUNNING
+
+    def test_stale_job_fails_after_max_attempts(self, db):
+        job = enqueue_job(db, "batch", {"story": "s"})
+        claim_job(db)
+        job.heartbeat_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+        db.commit()
+
+        assert requeue_stale_jobs(db, stale_after=60, max_attempts=1) == []
+        db.refresh(job)
+        assert job.status == FAILED
+        assert job.error == "Worker stopped responding"
+
+    def test_update_job_payload_merges(self, db):
+        job = enqueue_job(db, "batch", {"story": "s", "seed": 1})
+
+        update_job_payload(db, job.id, sentences=["a", "b"])
+
+        assert get_job(db, job.id).payload == {
+            "story": "s",
+            "seed": 1,
+            "sentences": ["a", "b"],
+        }
+
+    def test_find_and_retry_job_by_key(self, db):
+        """A failed job found by its idempotency key can be queued again"""
+        job = enqueue_job(db, "batch", {"story": "s"}, owner_id=1, idempotency_key="k")
+        fail_job(db, claim_job(db), "boom")
+
+        assert find_job_by_key(db, 1, "k", [QUEUED, RUNNING]) is None
+        assert find_job_by_key(db, 2, "k", [FAILED]) is None
+        found = find_job_by_key(db, 1, "k", [QUEUED, RUNNING, FAILED])
+        assert found.id == job.id
+
+        retry_job(db, found)
+
+        retried = claim_job(db)
+        assert retried.id == job.id
+        assert retried.error is None
+        assert retried.finished_at is None
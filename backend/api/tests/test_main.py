@@ -0,0 +1,328 @@
+import asyncio
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+import auth
+import main
+import models
+from job_queue import (
+    CANCELLED,
+    COMPLETED,
+    QUEUED,
+    REPLACED,
+    RUNNING,
+    complete_job,
+    enqueue_job,
+    fail_job,
+    get_job,
+)
+from pose_cache import pose_id_for, store_source
+
+# The endpoints are called directly: fastapi's TestClient does not work with
+# the pinned httpx.
+
+
+@pytest.fixture(autouse=True)
+def secret_key():
+    with patch.object(auth, "SECRET_KEY", "test-secret"):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def sessions(session_factory):
+    # Regenerations wait for their job in sessions of their own.
+    with patch.object(main, "SessionLocal", session_factory):
+        yield
+
+
+@pytest.fixture
+def user(db):
+    user = models.User(username="alice", email="alice@example.com", hashed_password="")
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture
+def token(user):
+    return auth.create_access_token({"sub": user.username})
+
+
+@pytest.fixture
+def storyboard(db, user):
+    storyboard = models.Storyboard(name="s", owner_id=user.id, thumbnail="")
+    db.add(storyboard)
+    db.commit()
+    return storyboard
+
+
+@pytest.fixture
+def image(db, storyboard):
+    image = models.Image(
+        storyboard_id=storyboard.id, image_path="https://x/a.jpg", caption="a cat"
+    )
+    db.add(image)
+    db.commit()
+    return image
+
+
+def regenerate(db, token, image_id, **form):
+    fields = {
+        "caption": "a dog",
+        "seed": None,
+        "resolution": "1:1",
+        "isOpenPose": False,
+        "pose_img": None,
+        "pose_id": None,
+        "draft": False,
+        "mode": "generate",
+        "strength": None,
+    }
+    fields.update(form)
+    return asyncio.run(main.regenerate_image(image_id, db=db, token=token, **fields))
+
+
+def generate(db, token, storyboard_id, story="A cat. A dog.", idempotency_key=None):
+    return asyncio.run(
+        main.generate_images(
+            storyboard_id,
+            story=story,
+            resolution="1:1",
+            draft=False,
+            idempotency_key=idempotency_key,
+            db=db,
+            token=token,
+        )
+    )
+
+
+class TestRegenerateImage:
+    def test_token_is_checked_before_admission(self, db, image):
+        with patch.object(main, "check_admission") as check:
+            with pytest.raises(HTTPException) as denied:
+                regenerate(db, "not-a-token", image.id)
+
+        assert denied.value.status_code == 401
+        check.assert_not_called()
+
+    def test_busy_user_is_told_when_to_retry(self, db, token, user, image):
+        for n in range(admission.MAX_QUEUED_REGENERATIONS_PER_USER):
+            enqueue_job(db, "single", {"image_id": image.id}, owner_id=user.id)
+
+        with pytest.raises(HTTPException) as busy:
+            regenerate(db, token, image.id)
+
+        assert busy.value.status_code == 429
+        assert int(busy.value.headers["Retry-After"]) >= admission.MIN_RETRY_AFTER
+
+    def test_timeout_cancels_the_job(self, db, token, image):
+        """A late result must not overwrite a panel the client gave up on"""
+        with patch.object(main, "REGENERATE_TIMEOUT", 0):
+            with pytest.raises(HTTPException) as timeout:
+                regenerate(db, token, image.id)
+
+        assert timeout.value.status_code == 504
+        job_id = timeout.value.detail["job_id"]
+        assert timeout.value.detail["status_url"] == f"/jobs/{job_id}"
+        assert get_job(db, job_id).status == CANCELLED
+
+    def test_unknown_image_is_not_found(self, db, token, image):
+        with pytest.raises(HTTPException) as missing:
+            regenerate(db, token, image.id + 1)
+
+        assert missing.value.status_code == 404
+
+    def test_pose_needs_an_upload_or_a_valid_pose_id(self, db, token, image):
+        with pytest.raises(HTTPException) as invalid:
+            regenerate(db, token, image.id, isOpenPose=True, pose_id="../etc")
+
+        assert invalid.value.status_code == 400
+        assert get_job(db, 1) is None
+
+    def test_pose_that_is_no_longer_stored_asks_for_a_new_upload(
+        self, db, token, image
+    ):
+        with pytest.raises(HTTPException) as gone:
+            regenerate(db, token, image.id, isOpenPose=True, pose_id=pose_id_for(b"p"))
+
+        assert gone.value.status_code == 409
+        assert "upload the pose image again" in gone.value.detail
+        assert get_job(db, 1) is None
+
+    def test_stored_pose_is_reused_by_id(self, db, token, image):
+        pose_id = pose_id_for(b"p")
+        store_source(db, pose_id, b"p")
+
+        with patch.object(main, "REGENERATE_TIMEOUT", 0):
+            with pytest.raises(HTTPException) as timeout:
+                regenerate(db, token, image.id, isOpenPose=True, pose_id=pose_id)
+
+        job = get_job(db, timeout.value.detail["job_id"])
+        assert job.payload["pose_id"] == pose_id
+
+    @pytest.mark.parametrize(
+        "form",
+        [
+            {"mode": "sketch"},
+            {"mode": "refine", "isOpenPose": True},
+            {"mode": "refine", "strength": 1.5},
+        ],
+    )
+    def test_rejects_invalid_refine_requests(self, db, token, image, form):
+        with pytest.raises(HTTPException) as invalid:
+            regenerate(db, token, image.id, **form)
+
+        assert invalid.value.status_code == 400
+
+
+class TestGenerateImages:
+    def test_resubmitted_story_resumes_its_job(self, db, token, storyboard):
+        started = generate(db, token, storyboard.id)
+
+        resumed = generate(db, token, storyboard.id)
+
+        assert resumed == {
+            "message": "Image generation resumed",
+            "job_id": started["job_id"],
+        }
+        assert db.query(models.GenerationJob).count() == 1
+
+    def test_failed_story_is_retried(self, db, token, storyboard):
+        job = get_job(db, generate(db, token, storyboard.id)["job_id"])
+        fail_job(db, job, "boom")
+
+        resumed = generate(db, token, storyboard.id)
+
+        assert resumed["job_id"] == job.id
+        db.refresh(job)
+        assert job.status == QUEUED
+        assert job.error is None
+
+    def test_finished_story_runs_again_without_a_key(self, db, token, storyboard):
+        first = generate(db, token, storyboard.id)["job_id"]
+        complete_job(db, get_job(db, first))
+
+        again = generate(db, token, storyboard.id)
+
+        assert again["message"] == "Image generation started"
+        assert again["job_id"] != first
+
+    def test_idempotency_key_also_matches_a_finished_job(self, db, token, storyboard):
+        first = generate(db, token, storyboard.id, idempotency_key="k1")["job_id"]
+        complete_job(db, get_job(db, first))
+
+        retried = generate(db, token, storyboard.id, idempotency_key="k1")
+
+        assert retried == {"message": "Image generation resumed", "job_id": first}
+        assert get_job(db, first).status == COMPLETED
+
+    def test_new_story_cancels_the_one_still_generating(
+        self, db, token, user, storyboard
+    ):
+        finalize = enqueue_job(
+            db, "finalize", {}, storyboard_id=storyboard.id, owner_id=user.id
+        )
+        old = generate(db, token, storyboard.id, story="A cat.")["job_id"]
+
+        new = generate(db, token, storyboard.id, story="A dog.")["job_id"]
+
+        assert get_job(db, old).status == CANCELLED
+        assert get_job(db, old).error == REPLACED
+        assert get_job(db, new).status == QUEUED
+        # Its drafts are still upgraded.
+        assert get_job(db, finalize.id).status == QUEUED
+
+    def test_busy_user_is_told_when_to_retry(self, db, token, user, storyboard):
+        for n in range(admission.MAX_QUEUED_JOBS_PER_USER):
+            enqueue_job(db, "batch", {"story": str(n)}, owner_id=user.id)
+
+        with pytest.raises(HTTPException) as busy:
+            generate(db, token, storyboard.id)
+
+        assert busy.value.status_code == 429
+        assert int(busy.value.headers["Retry-After"]) >= admission.MIN_RETRY_AFTER
+        assert db.query(models.GenerationJob).count() == 3
+
+    def test_replacing_a_queued_story_is_not_turned_away(
+        self, db, token, user, storyboard
+    ):
+        """The story being replaced does not count against the user's limit"""
+        for n in range(admission.MAX_QUEUED_JOBS_PER_USER - 1):
+            enqueue_job(db, "batch", {"story": str(n)}, owner_id=user.id)
+        old = generate(db, token, storyboard.id, story="A cat.")["job_id"]
+
+        new = generate(db, token, storyboard.id, story="A dog.")
+
+        assert new["message"] == "Image generation started"
+        assert get_job(db, old).status == CANCELLED
+
+    def test_other_users_storyboard_is_not_found(self, db, token):
+        other = models.User(username="bob", email="bob@example.com", hashed_password="")
+        db.add(other)
+        db.commit()
+        storyboard = models.Storyboard(name="s", owner_id=other.id, thumbnail="")
+        db.add(storyboard)
+        db.commit()
+
+        with pytest.raises(HTTPException) as missing:
+            generate(db, token, storyboard.id)
+
+        assert missing.value.status_code == 404
+
+
+class TestDeleteStoryboard:
+    def test_cancels_its_jobs(self, db, token, user, storyboard, image):
+        queued = enqueue_job(
+            db, "batch", {}, storyboard_id=storyboard.id, owner_id=user.id
+        )
+        running = enqueue_job(
+            db, "single", {}, storyboard_id=storyboard.id, owner_id=user.id
+        )
+        running.status = RUNNING
+        db.commit()
+
+        with patch.object(main, "delete_image_from_s3") as delete_object:
+            main.delete_storyboard(storyboard.id, db=db, token=token)
+
+        assert get_job(db, queued.id).status == CANCELLED
+        assert get_job(db, running.id).status == CANCELLED
+        delete_object.assert_called_once_with("https://x/a.jpg")
+
+
+class TestStoryboardEvents:
+    def stream(self, db, storyboard_id, token):
+        return main.stream_storyboard_events(
+            storyboard_id, token=token, job_id=None, after=0, db=db
+        )
+
+    def test_token_comes_in_the_query_string(self, db, token, storyboard):
+        response = self.stream(db, storyboard.id, token)
+
+        assert isinstance(response, StreamingResponse)
+        assert response.media_type == "text/event-stream"
+        assert response.headers["Cache-Control"] == "no-cache"
+
+    def test_rejects_an_invalid_token(self, db, storyboard):
+        with pytest.raises(HTTPException) as denied:
+            self.stream(db, storyboard.id, "not-a-token")
+
+        assert denied.value.status_code == 401
+
+    def test_other_users_storyboard_is_not_found(self, db, storyboard):
+        other = models.User(username="bob", email="bob@example.com", hashed_password="")
+        db.add(other)
+        db.commit()
+        token = auth.create_access_token({"sub": other.username})
+
+        with pytest.raises(HTTPException) as missing:
+            self.stream(db, storyboard.id, token)
+
+        assert missing.value.status_code == 404
@@ -0,0 +1,141 @@
+import os
+import sys
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+from generation_backend import StubBackend, loaded_backend, set_backend
+from job_queue import JobCancelled
+from metrics import Counter, Gauge, Histogram, Registry
+from timing import stage
+
+
+class TestExposition:
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        jobs = registry.register(Counter("jobs_total", "Jobs", ("kind",)))
+        depth = registry.register(Gauge("depth", "Depth"))
+
+        jobs.inc(kind="batch")
+        jobs.inc(2, kind="single")
+        depth.set(4)
+
+        assert registry.render() == (
+            "# HELP jobs_total Jobs\n"
+            "# TYPE jobs_total counter\n"
+            'jobs_total{kind="batch"} 1.0\n'
+            'jobs_total{kind="single"} 2.0\n'
+            "# HELP depth Depth\n"
+            "# TYPE depth gauge\n"
+            "depth 4.0\n"
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("seconds", "Seconds", buckets=(1, 5))
+        for value in (0.5, 2, 10):
+            histogram.observe(value)
+
+        assert histogram.render().splitlines()[2:] == [
+            'seconds_bucket{le="1.0"} 1.0',
+            'seconds_bucket{le="5.0"} 2.0',
+            'seconds_bucket{le="+Inf"} 3.0',
+            "seconds_sum 12.5",
+            "seconds_count 3.0",
+        ]
+
+    def test_labels_are_checked_and_escaped(self):
+        counter = Counter("errors_total", "Errors", ("stage",))
+
+        with pytest.raises(ValueError):
+            counter.inc(kind="x")
+        counter.inc(stage='say "hi"\n')
+
+        assert 'errors_total{stage="say \\"hi\\"\\n"} 1.0' in counter.render()
+
+    def test_gauge_collected_at_render_time(self):
+        gauge = Gauge("memory", "Memory", ("device",), collect=lambda: {("cpu",): 7})
+
+        assert 'memory{device="cpu"} 7.0' in gauge.render()
+
+
+class TestPipelineMetrics:
+    def test_stages_are_observed(self):
+        before = metrics.STAGE_SECONDS.count(stage="upload")
+
+        with stage("upload"):
+            pass
+
+        assert metrics.STAGE_SECONDS.count(stage="upload") == before + 1
+
+    def test_failures_by_stage_skip_cancellations(self):
+        before = metrics.STAGE_FAILURES.value(stage="encode")
+
+        with pytest.raises(IOError):
+            with stage("encode"):
+                raise IOError("disk full")
+        with pytest.raises(JobCancelled):
+            with stage("encode"):
+                raise JobCancelled(1)
+
+        assert metrics.STAGE_FAILURES.value(stage="encode") == before + 1
+
+    def test_diffusion_rate(self):
+        before = metrics.DIFFUSION_STEP_RATE.count()
+
+        with metrics.diffusion_call(steps=30, images=2):
+            pass
+
+        assert metrics.DIFFUSION_STEP_RATE.count() == before + 1
+
+    def test_queue_wait_handles_naive_timestamps(self):
+        created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        job = SimpleNamespace(
+            kind="finalize",
+            created_at=created,
+            started_at=(created + timedelta(seconds=3)).replace(tzinfo=None),
+        )
+        before = metrics.QUEUE_WAIT_SECONDS.count(kind="finalize")
+
+        metrics.observe_queue_wait(job)
+
+        assert metrics.QUEUE_WAIT_SECONDS.count(kind="finalize") == before + 1
+
+    def test_model_memory_only_once_a_backend_exists(self):
+        previous = loaded_backend()
+        set_backend(None)
+        try:
+            assert "sceneweaver_model_memory_bytes{" not in metrics.render()
+            set_backend(StubBackend())
+            assert 'sceneweaver_model_memory_bytes{device="cpu"}' in metrics.render()
+        finally:
+            set_backend(previous)
+
+    def test_queue_gauges(self):
+        metrics.update_queue_gauges(
+            {"bulk": {"queued": 3, "running": 1, "oldest_queued_seconds": 12.5}}
+        )
+
+        text = metrics.render()
+        assert 'sceneweaver_queue_jobs{job_class="bulk",status="queued"} 3.0' in text
+        assert 'sceneweaver_queue_oldest_seconds{job_class="bulk"} 12.5' in text
+
+
+class TestHttpServer:
+    def test_serves_metrics(self):
+        server = metrics.start_http_server(0, host="127.0.0.1")
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/metrics"
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode("utf-8")
+                content_type = response.headers["Content-Type"]
+        finally:
+            server.shutdown()
+
+        assert content_type == metrics.CONTENT_TYPE
+        assert "# TYPE sceneweaver_stage_seconds histogram" in body
+        assert "sceneweaver_process_resident_memory_bytes " in body
@@ -0,0 +1,105 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+import result_cache
+from database import Base
+from migrations import migrate
+
+# The images, generation_jobs and generation_cache tables as the first job
+# queue release created them.
+OLD_SCHEMA = [
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY, username VARCHAR, email VARCHAR,
+        hashed_password VARCHAR, is_active BOOLEAN
+    )""",
+    """CREATE TABLE storyboards (
+        id INTEGER PRIMARY KEY, name VARCHAR, owner_id INTEGER REFERENCES users (id),
+        thumbnail VARCHAR, created_at DATETIME, updated_at DATETIME
+    )""",
+    """CREATE TABLE images (
+        id INTEGER PRIMARY KEY, storyboard_id INTEGER REFERENCES storyboards (id),
+        image_path VARCHAR, caption VARCHAR
+    )""",
+    """CREATE TABLE generation_jobs (
+        id INTEGER PRIMARY KEY, kind VARCHAR, status VARCHAR,
+        storyboard_id INTEGER REFERENCES storyboards (id) ON DELETE SET NULL,
+        owner_id INTEGER REFERENCES users (id), payload JSON, pose_image BLOB,
+        result JSON, error TEXT, attempts INTEGER, created_at DATETIME,
+        started_at DATETIME, finished_at DATETIME
+    )""",
+    """CREATE TABLE generation_cache (
+        id INTEGER PRIMARY KEY, key VARCHAR UNIQUE, image_path VARCHAR,
+        hits INTEGER, created_at DATETIME, last_used_at DATETIME
+    )""",
+    """INSERT INTO generation_cache (id, key, image_path, hits)
+        VALUES (1, 'k', 'https://x/a.jpg', 0)""",
+    "INSERT INTO storyboards (id, name, owner_id, thumbnail) VALUES (1, 's', 1, '')",
+    """INSERT INTO images (id, storyboard_id, image_path, caption)
+        VALUES (1, 1, 'https://x/a.jpg', 'a cat')""",
+]
+
+
+@pytest.fixture
+def old_engine():
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA:
+            conn.execute(text(statement))
+    # What the worker runs on start.
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+class TestMigrate:
+    def test_existing_tables_gain_every_model_column(self, old_engine):
+        migrate(old_engine)
+
+        inspector = inspect(old_engine)
+        for table in Base.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            assert {column.name for column in table.columns} <= columns
+
+        db = sessionmaker(bind=old_engine)()
+        image = db.query(models.Image).one()
+        assert image.caption == "a cat"
+        assert image.is_draft is False
+        assert result_cache.lookup(db, "k") == "https://x/a.jpg"
+
+    def test_panels_are_unique_per_job_and_sentence(self, old_engine):
+        migrate(old_engine)
+        db = sessionmaker(bind=old_engine)()
+
+        for _ in range(2):
+            db.add(models.Image(storyboard_id=1, job_id=None, sentence_index=0))
+        db.commit()
+        db.add(models.GenerationJob(id=5, kind="batch", status="queued"))
+        db.add(models.Image(storyboard_id=1, job_id=5, sentence_index=0))
+        db.commit()
+        db.add(models.Image(storyboard_id=1, job_id=5, sentence_index=0))
+
+        with pytest.raises(IntegrityError):
+            db.commit()
+
+    def test_runs_once(self, old_engine):
+        applied = migrate(old_engine)
+
+        assert "images.seed" in applied
+        assert "generation_cache.placeholder" in applied
+        assert "ix_generation_jobs_batch_key" in applied
+        assert migrate(old_engine) == []
+
+    def test_fresh_database_needs_nothing(self, session_factory):
+        assert migrate(session_factory.kw["bind"]) == []
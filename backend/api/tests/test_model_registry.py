@@ -0,0 +1,104 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_registry import ModelRegistry
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestModelRegistry:
+    def test_loads_on_first_use_only(self):
+        """A loader runs once, on the first get()"""
+        calls = []
+        registry = ModelRegistry()
+        registry.register("model", lambda: calls.append(1) or "loaded")
+
+        assert calls == []
+        assert registry.is_loaded("model") is False
+
+        assert registry.get("model") == "loaded"
+        assert registry.get("model") == "loaded"
+        assert calls == [1]
+
+    def test_status_reports_timings(self):
+        """Status exposes load state and timings per model"""
+        registry = ModelRegistry()
+        registry.register("a", lambda: "a")
+        registry.register("b", lambda: "b")
+
+        registry.warmup(["a"])
+        status = registry.status()
+
+        assert status["a"]["loaded"] is True
+        assert status["a"]["load_seconds"] >= 0
+        assert status["b"]["loaded"] is False
+        assert status["b"]["load_seconds"] is None
+
+    def test_failed_load_is_reported_and_retried(self):
+        """A failing loader records the error and can be retried"""
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("no weights")
+            return "ok"
+
+        registry = ModelRegistry()
+        registry.register("flaky", flaky)
+
+        with pytest.raises(RuntimeError):
+            registry.get("flaky")
+        assert registry.status()["flaky"]["error"] == "no weights"
+
+        assert registry.get("flaky") == "ok"
+        assert registry.status()["flaky"]["error"] is None
+
+    def test_concurrent_get_loads_once(self):
+        """Threads racing on the first get() share a single load"""
+        calls = []
+        registry = ModelRegistry()
+        registry.register("model", lambda: calls.append(1) or object())
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(registry.get("model")))
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert all(r is results[0] for r in results)
+
+    def test_unknown_model(self):
+        """Asking for an unregistered model fails loudly"""
+        with pytest.raises(KeyError):
+            ModelRegistry().get("missing")
+
+
+def test_main_imports_without_ml_stack():
+    """The API can be imported without pulling in torch or spaCy"""
+    code = (
+        "import sys, main; "
+        "heavy = [m for m in ('torch', 'spacy', 'diffusers', 'fastcoref') "
+        "if m in sys.modules]; "
+        "print(','.join(heavy))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=API_DIR,
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
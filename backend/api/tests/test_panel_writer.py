@@ -0,0 +1,77 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from panel_writer import BackgroundStage
+from timing import collect_stages, stage
+
+
+class TestBackgroundStage:
+    def test_handles_every_item(self):
+        seen = []
+        with BackgroundStage(seen.append, workers=3) as writer:
+            for num in range(20):
+                writer.submit(num)
+
+        assert sorted(seen) == list(range(20))
+
+    def test_submit_blocks_when_queue_is_full(self):
+        """A slow consumer holds the producer back"""
+        release = threading.Event()
+        submitted = []
+
+        writer = BackgroundStage(lambda item: release.wait(), max_pending=1)
+
+        def produce():
+            for num in range(3):
+                writer.submit(num)
+                submitted.append(num)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join(timeout=0.2)
+
+        # One item is being handled and one waits in the queue.
+        assert producer.is_alive()
+        assert submitted == [0, 1]
+
+        release.set()
+        producer.join()
+        writer.close()
+        assert submitted == [0, 1, 2]
+
+    def test_failure_is_raised_to_the_producer(self):
+        def upload(item):
+            if item == 2:
+                raise IOError("upload failed")
+
+        writer = BackgroundStage(upload)
+        with pytest.raises(IOError, match="upload failed"):
+            for num in range(100):
+                writer.submit(num)
+            writer.close()
+
+    def test_failure_does_not_mask_caller_exception(self):
+        def upload(item):
+            raise IOError("upload failed")
+
+        with pytest.raises(KeyError):
+            with BackgroundStage(upload) as writer:
+                writer.submit(1)
+                raise KeyError("caller")
+
+    def test_stage_timings_reach_the_caller(self):
+        def encode(item):
+            with stage("encode"):
+                pass
+
+        with collect_stages() as timings:
+            with BackgroundStage(encode, workers=2) as writer:
+                writer.submit(1)
+                writer.submit(2)
+
+        assert len(timings["encode"]) == 2
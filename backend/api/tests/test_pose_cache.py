@@ -0,0 +1,100 @@
+import os
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from pose_cache import (
+    PoseCache,
+    evict_sources,
+    has_source,
+    is_valid_pose_id,
+    load_source,
+    pose_id_for,
+    store_source,
+)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PoseCache(str(tmp_path), max_bytes=10 * 1024**2)
+
+
+def skeleton(color):
+    return Image.new("RGB", (64, 64), color)
+
+
+class TestPoseId:
+    def test_is_content_hash(self):
+        assert pose_id_for(b"pose") == pose_id_for(b"pose")
+        assert pose_id_for(b"pose") != pose_id_for(b"other")
+        assert is_valid_pose_id(pose_id_for(b"pose"))
+
+    @pytest.mark.parametrize("pose_id", [None, "", "abc", "../../etc/passwd" + "0" * 48])
+    def test_rejects_non_hash_ids(self, pose_id):
+        assert is_valid_pose_id(pose_id) is False
+
+
+class TestPoseCache:
+    def test_skeleton_round_trip(self, cache):
+        """A stored skeleton is returned for the same pose and resolution"""
+        pose_id = pose_id_for(b"pose")
+        assert cache.get_skeleton(pose_id, 512, 1024) is None
+
+        cache.put_skeleton(pose_id, 512, 1024, skeleton("red"))
+
+        hit = cache.get_skeleton(pose_id, 512, 1024)
+        assert hit.getpixel((0, 0)) == (255, 0, 0)
+        assert cache.get_skeleton(pose_id, 256, 1024) is None
+
+    def test_source_round_trip(self, cache):
+        pose_id = pose_id_for(b"pose")
+        cache.put_source(pose_id, skeleton("blue"))
+        assert cache.get_source(pose_id).getpixel((0, 0)) == (0, 0, 255)
+
+    def test_invalid_pose_id_never_touches_disk(self, cache):
+        with pytest.raises(ValueError):
+            cache.get_skeleton("../secret", 512, 1024)
+
+    def test_prunes_least_recently_used(self, cache, tmp_path):
+        """Oldest files are removed once the size bound is exceeded"""
+        first, second = pose_id_for(b"1"), pose_id_for(b"2")
+        cache.put_skeleton(first, 512, 1024, skeleton("red"))
+        os.utime(tmp_path / f"{first}_512_1024.png", (0, 0))
+        cache.put_skeleton(second, 512, 1024, skeleton("green"))
+
+        cache.max_bytes = os.path.getsize(tmp_path / f"{second}_512_1024.png")
+        cache.prune()
+
+        assert cache.get_skeleton(first, 512, 1024) is None
+        assert cache.get_skeleton(second, 512, 1024) is not None
+
+
+class TestPoseSources:
+    def test_upload_round_trip(self, db):
+        pose_id = pose_id_for(b"pose")
+        assert not has_source(db, pose_id)
+        assert load_source(db, pose_id) is None
+
+        upload = BytesIO()
+        skeleton("blue").save(upload, format="PNG")
+        store_source(db, pose_id, upload.getvalue())
+        store_source(db, pose_id, upload.getvalue())
+
+        assert has_source(db, pose_id)
+        assert load_source(db, pose_id).getpixel((0, 0)) == (0, 0, 255)
+        assert db.query(models.PoseSource).count() == 1
+
+    def test_evicts_least_recently_used(self, db):
+        first, second = pose_id_for(b"1"), pose_id_for(b"2")
+        store_source(db, first, b"1")
+        store_source(db, second, b"2")
+        has_source(db, first)
+
+        assert evict_sources(db, 1) == 1
+        assert has_source(db, first)
+        assert not has_source(db, second)
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from job_queue import enqueue_job, claim_job, complete_job, fail_job, update_job_progress
+from progress import format_sse, storyboard_events
+
+
+def collect(agen):
+    async def run():
+        return [event async for event in agen]
+
+    return asyncio.run(run())
+
+
+def parse(events):
+    parsed = []
+    for raw in events:
+        if raw.startswith(":"):
+            continue
+        name, data = raw.strip().split("\n")
+        parsed.append((name[len("event: ") :], json.loads(data[len("data: ") :])))
+    return parsed
+
+
+def test_format_sse():
+    assert format_sse("image", {"id": 1}) == 'event: image\ndata: {"id": 1}\n\n'
+
+
+class TestStoryboardEvents:
+    def test_finished_batch_job_reports_images_then_completed(self, session_factory):
+        """Committed panels are streamed before the final status"""
+        db = session_factory()
+        job = enqueue_job(db, "batch", {"story": "x"}, storyboard_id=7)
+        claim_job(db)
+        db.add_all(
+            [
+                models.Image(storyboard_id=7, image_path="a.jpg", caption="a"),
+                models.Image(storyboard_id=7, image_path="b.jpg", caption="b"),
+                models.Image(storyboard_id=8, image_path="c.jpg", caption="c"),
+            ]
+        )
+        db.commit()
+        complete_job(db, job, {"storyboard_id": 7})
+
+        events = parse(collect(storyboard_events(session_factory, 7, poll_interval=0)))
+
+        assert [name for name, _ in events] == ["image", "image", "completed"]
+        assert [data["image_path"] for _, data in events[:2]] == ["a.jpg", "b.jpg"]
+
+    def test_running_job_streams_progress_until_failure(self, session_factory):
+        """Step updates are pushed as they happen and failure ends the stream"""
+        db = session_factory()
+        job = enqueue_job(db, "batch", {"story": "x"}, storyboard_id=7)
+        claim_job(db)
+        update_job_progress(db, job.id, completed=0, total=2, step=5, steps=30)
+
+        async def run():
+            events = []
+            async for event in storyboard_events(
+                session_factory, 7, job_id=job.id, poll_interval=0
+            ):
+                events.append(event)
+                if len(events) == 1:
+                    fail_job(db, job, "out of memory")
+            return events
+
+        events = parse(asyncio.run(run()))
+
+        assert events[0] == (
+            "running",
+            {"job_id": job.id, "completed": 0, "total": 2, "step": 5, "steps": 30},
+        )
+        assert events[-1] == ("failed", {"job_id": job.id, "error": "out of memory"})
+
+    def test_no_job(self, session_factory):
+        events = parse(collect(storyboard_events(session_factory, 1, poll_interval=0)))
+        assert events == [("idle", {"storyboard_id": 1})]
@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_cache import PromptEmbeddingCache
+
+
+class TestPromptEmbeddingCache:
+    def test_computes_once_per_key(self):
+        """Repeated texts are encoded once and then served from the cache"""
+        calls = []
+        cache = PromptEmbeddingCache(max_entries=4)
+        key = ("ugly, deformed", "sdxl-base", "sketch=0.5")
+
+        for _ in range(3):
+            value = cache.get_or_compute(key, lambda: calls.append(1) or "embeds")
+
+        assert value == "embeds"
+        assert calls == [1]
+        assert cache.stats()["hits"] == 2
+        assert cache.stats()["misses"] == 1
+
+    def test_lora_state_is_part_of_the_key(self):
+        """The same text under different LoRA weights is encoded again"""
+        cache = PromptEmbeddingCache()
+        cache.get_or_compute(("text", "sdxl-base", "sketch=0.5"), lambda: 1)
+        value = cache.get_or_compute(("text", "sdxl-base", "sketch=1.0"), lambda: 2)
+
+        assert value == 2
+        assert cache.misses == 2
+
+    def test_evicts_least_recently_used(self):
+        """The oldest untouched entry is evicted once the cache is full"""
+        cache = PromptEmbeddingCache(max_entries=2)
+        cache.get_or_compute("a", lambda: "A")
+        cache.get_or_compute("b", lambda: "B")
+        cache.get_or_compute("a", lambda: "A2")  # refresh "a"
+        cache.get_or_compute("c", lambda: "C")  # evicts "b"
+
+        assert len(cache) == 2
+        assert cache.get_or_compute("a", lambda: "new") == "A"
+        assert cache.get_or_compute("b", lambda: "B2") == "B2"
+
+    def test_clear_resets_counters(self):
+        cache = PromptEmbeddingCache()
+        cache.get_or_compute("a", lambda: 1)
+        cache.clear()
+
+        assert cache.stats() == {
+            "entries": 0,
+            "max_entries": 128,
+            "hits": 0,
+            "misses": 0,
+        }
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import sys
+from unittest.mock import patch
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+from result_cache import (
+    cache_key,
+    lookup,
+    lookup_entry,
+    store,
+    evict,
+    is_image_path_referenced,
+)
+
+
+class TestCacheKey:
+    def test_same_inputs_same_key(self):
+        assert cache_key("a cat", 1, "1:1", "v1") == cache_key("a cat", 1, "1:1", "v1")
+
+    @pytest.mark.parametrize(
+        "changed",
+        [
+            ("a dog", 1, "1:1", "v1", None),
+            ("a cat", 2, "1:1", "v1", None),
+            ("a cat", 1, "16:9", "v1", None),
+            ("a cat", 1, "1:1", "v2", None),
+            ("a cat", 1, "1:1", "v1", "posehash"),
+            ("a cat", 1, "1:1", "v1", None, "old.jpg@0.35"),
+        ],
+    )
+    def test_every_input_changes_the_key(self, changed):
+        """Caption, seed, resolution, model version and pose are all part of the key"""
+        assert cache_key(*changed) != cache_key("a cat", 1, "1:1", "v1", None)
+
+    def test_refine_source_keeps_existing_keys(self):
+        """Keys of renders from noise did not change when refinements came"""
+        material = json.dumps(["a cat", 1, "1:1", None, "v1"])
+        assert cache_key("a cat", 1, "1:1", "v1") == (
+            hashlib.sha256(material.encode("utf-8")).hexdigest()
+        )
+
+
+class TestResultCache:
+    def test_store_then_lookup(self, db):
+        assert lookup(db, "k") is None
+
+        store(db, "k", "https://bucket/a.jpg")
+
+        assert lookup(db, "k") == "https://bucket/a.jpg"
+        entry = db.query(models.GenerationCacheEntry).one()
+        assert entry.hits == 1
+
+    def test_cached_render_keeps_its_placeholder(self, db):
+        store(db, "k", "https://bucket/a.jpg", "data:image/webp;base64,AAAA")
+
+        entry = lookup_entry(db, "k")
+        assert entry.image_path == "https://bucket/a.jpg"
+        assert entry.placeholder == "data:image/webp;base64,AAAA"
+
+    def test_duplicate_store_is_ignored(self, db):
+        """Two workers caching the same render keep the first object"""
+        store(db, "k", "first.jpg")
+        store(db, "k", "second.jpg")
+
+        assert lookup(db, "k") == "first.jpg"
+
+    def test_evicts_least_recently_used(self, db):
+        store(db, "old", "old.jpg")
+        store(db, "used", "used.jpg")
+        store(db, "new", "new.jpg")
+        lookup(db, "old")  # "used" is now the least recently used
+
+        with patch("result_cache.delete_image_from_s3") as delete:
+            evicted = evict(db, max_entries=2)
+
+        assert evicted == ["used.jpg"]
+        assert lookup(db, "used") is None
+        delete.assert_called_once_with("used.jpg")
+
+    def test_eviction_keeps_objects_still_used_by_images(self, db):
+        """An evicted render that an image still shows is not deleted from S3"""
+        db.add(models.Image(storyboard_id=1, image_path="shown.jpg", caption="c"))
+        db.commit()
+        store(db, "shown", "shown.jpg")
+
+        with patch("result_cache.delete_image_from_s3") as delete:
+            evict(db, max_entries=0)
+
+        delete.assert_not_called()
+        assert is_image_path_referenced(db, "shown.jpg") is True
+        assert is_image_path_referenced(db, "gone.jpg") is False
@@ -0,0 +1,187 @@
+import json
+import os
+import sys
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import text_processor
+from text_processor import (
+    load_nlp,
+    load_senter,
+    project_sentences,
+    remove_dialogues,
+    split_sentences,
+)
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS = os.path.join(API_DIR, "benchmarks", "stories.json")
+
+
+def fake_nlp(text):
+    return SimpleNamespace(
+        sents=[SimpleNamespace(text=part) for part in text.split(".") if part]
+    )
+
+
+class TestCorefSwitch:
+    def test_coref_off_uses_the_sentence_segmenter_only(self):
+        loaded = []
+
+        def get(name):
+            loaded.append(name)
+            return fake_nlp
+
+        with patch.object(text_processor, "COREF_ENABLED", False), patch.object(
+            text_processor.registry, "get", side_effect=get
+        ), patch.object(
+            text_processor, "detect_and_translate_to_english", side_effect=str
+        ), patch.object(
+            text_processor, "resolve_coreferences"
+        ) as resolve:
+            sentences = text_processor.get_resolved_sentences(
+                'A cat sat. "Hi," it said. It left.'
+            )
+
+        resolve.assert_not_called()
+        assert loaded == ["spacy_senter"]
+        assert sentences == ["A cat sat", "it said", "It left"]
+
+    def test_coref_on_parses_the_story_once(self):
+        resolved = ["Maria ", "ran", ". ", "Maria ", "hid", "."]
+        doc = FakeDoc(resolved, [(0, 3), (3, 6)])
+
+        with patch.object(text_processor, "COREF_ENABLED", True), patch.object(
+            text_processor.registry, "get", return_value=never_parse
+        ), patch.object(
+            text_processor, "detect_and_translate_to_english", side_effect=str
+        ), patch.object(
+            text_processor, "resolve_coreference_tokens", return_value=(doc, resolved)
+        ) as resolve:
+            sentences = text_processor.get_resolved_sentences("Maria ran. She hid.")
+
+        resolve.assert_called_once_with("Maria ran. She hid.")
+        assert sentences == ["Maria ran.", "Maria hid."]
+
+    def test_unknown_profile(self):
+        with pytest.raises(ValueError):
+            load_nlp("nope")
+
+
+class FakeDoc:
+    """Tokens plus sentences given as ``(start, end)`` token ranges."""
+
+    def __init__(self, tokens, sentences):
+        self.tokens = tokens
+        self.sents = [SimpleNamespace(start=s, end=e) for s, e in sentences]
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+def never_parse(text):
+    raise AssertionError(f"re-parsed {text!r}")
+
+
+class TestProjectSentences:
+    def test_boundaries_come_from_the_first_parse(self):
+        resolved = ["Maria ", "found ", "a ", "map", ". ", "Maria ", "smiled", "."]
+        doc = FakeDoc(resolved, [(0, 5), (5, 8)])
+
+        sentences = project_sentences(doc, resolved, never_parse)
+
+        assert sentences == ["Maria found a map.", "Maria smiled."]
+
+    def test_dialogue_inside_a_sentence(self):
+        resolved = ["A ", "cat ", "sat", ". ", '"', "Hi", ",", '" ', "it ", "said", "."]
+        doc = FakeDoc(resolved, [(0, 4), (4, 11)])
+
+        sentences = project_sentences(doc, resolved, never_parse)
+
+        assert sentences == ["A cat sat.", "it said."]
+
+    def test_sentences_left_empty_are_dropped(self):
+        resolved = ["He ", "ran", ". ", '"', "Go", '!" ', "They ", "left", "."]
+        doc = FakeDoc(resolved, [(0, 3), (3, 6), (6, 9)])
+
+        assert project_sentences(doc, resolved, never_parse) == [
+            "He ran.",
+            "They left.",
+        ]
+
+    def test_dialogue_across_sentences_is_parsed_again(self):
+        resolved = ["He ", "said ", '"', "Stop", ". ", "Now", '." ', "and ", "ran", "."]
+        doc = FakeDoc(resolved, [(0, 5), (5, 10)])
+        parsed = []
+
+        def nlp(text):
+            parsed.append(text)
+            return fake_nlp(text)
+
+        sentences = project_sentences(doc, resolved, nlp)
+
+        assert parsed == ["He said and ran."]
+        assert sentences == ["He said and ran"]
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    pytest.importorskip("spacy")
+    pytest.importorskip(text_processor.SPACY_MODEL)
+    with open(CORPUS, encoding="utf-8") as f:
+        return [entry["story"] for entry in json.load(f)]
+
+
+class TestSlimProfileRegression:
+    """The slim profile must give the same output as the full model."""
+
+    def test_pos_tags_and_sentences_match(self, corpus):
+        full, slim = load_nlp("full"), load_nlp("slim")
+        assert "ner" not in slim.pipe_names
+
+        for story in corpus:
+            full_doc, slim_doc = full(story), slim(story)
+            assert [t.pos_ for t in full_doc] == [t.pos_ for t in slim_doc]
+            assert [t.whitespace_ for t in full_doc] == [
+                t.whitespace_ for t in slim_doc
+            ]
+            text = remove_dialogues(story)
+            assert split_sentences(text, slim) == split_sentences(text, full)
+
+    def test_coreference_output_matches(self, corpus):
+        pytest.importorskip("fastcoref")
+        full, slim = load_nlp("full"), load_nlp("slim")
+
+        for story in corpus:
+            assert text_processor.resolve_coreferences(
+                story, slim
+            ) == text_processor.resolve_coreferences(story, full)
+
+    def test_sentence_segmenter_keeps_all_text(self, corpus):
+        senter = load_senter()
+        assert senter.pipe_names == ["senter"]
+
+        for story in corpus:
+            text = remove_dialogues(story)
+            sentences = split_sentences(text, senter)
+            assert all(sentences)
+            assert " ".join(sentences).split() == text.split()
+
+
+class TestSingleParse:
+    """Projecting the coref parse's sentences keeps the story's text."""
+
+    def test_matches_parsing_twice(self, corpus):
+        pytest.importorskip("fastcoref")
+        nlp = load_nlp()
+
+        for story in corpus:
+            doc, resolved = text_processor.resolve_coreference_tokens(story, nlp)
+            twice = split_sentences(remove_dialogues("".join(resolved)), nlp)
+            once = project_sentences(doc, resolved, nlp)
+
+            assert all(once)
+            assert " ".join(once).split() == " ".join(twice).split()
@@ -1,11 +1,63 @@
-import spacy
-from fastcoref import FCoref
-from typing import List
+from __future__ import annotations
+
+from typing import List, Tuple, TYPE_CHECKING
+import os
 import re
 from googletrans import Translator
+from model_registry import registry
+from timing import stage
+
+if TYPE_CHECKING:
+    import spacy
+
+
+SPACY_MODEL = "en_core_web_lg"
+
+# Components each NLP profile leaves out of SPACY_MODEL. Coreference
+# resolution reads POS tags and token whitespace and sentence splitting
+# reads parser boundaries, so "slim" drops NER and the lemmatizer, which
+# feed neither. The static vectors stay: tok2vec is built on them.
+NLP_PROFILES = {
+    "full": [],
+    "slim": ["ner", "lemmatizer"],
+}
+NLP_PROFILE = os.getenv("NLP_PROFILE", "slim")
+
+# With coreference off, sentences are split by the standalone sentence
+# segmenter instead of the parser, and neither the parser nor fastcoref is
+# ever loaded.
+COREF_ENABLED = os.getenv("COREF_ENABLED", "1") != "0"
+SENTER_EXCLUDE = ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner"]
+
+
+def load_nlp(profile: str = NLP_PROFILE):
+    if profile not in NLP_PROFILES:
+        raise ValueError(f"Unknown NLP profile: {profile}")
+    import spacy
+
+    return spacy.load(SPACY_MODEL, exclude=NLP_PROFILES[profile])
+
+
+def load_senter():
+    import spacy
+
+    # The senter ships disabled; it has its own tok2vec layer.
+    return spacy.load(SPACY_MODEL, exclude=SENTER_EXCLUDE, enable=["senter"])
+
+
+def _load_coref():
+    from fastcoref import FCoref
+
+    return FCoref()
+
+
+registry.register("spacy", load_nlp)
+registry.register("spacy_senter", load_senter)
+registry.register("fastcoref", _load_coref)
+
+# What the worker loads up front with --warmup.
+NLP_MODELS = ["spacy", "fastcoref"] if COREF_ENABLED else ["spacy_senter"]
 
-nlp = spacy.load("en_core_web_lg")
-model = FCoref()
 CAPITALIZED_PRONOUNS = {
     "He",
     "She",
@@ -35,7 +87,7 @@ def is_capitalized_pronoun(span: spacy.tokens.Span, text: str) -> bool:
 
 
 def get_fastcoref_clusters(doc, text):
-    preds = model.predict(texts=[text])
+    preds = registry.get("fastcoref").predict(texts=[text])
     fast_clusters = preds[0].get_clusters(as_strings=False)
 
     converted_clusters = []
@@ -87,6 +139,13 @@ def replace_coref_span(doc, coref_span, resolved_text, mention_span):
 def improved_replace_corefs(
     doc: spacy.tokens.Doc, clusters: List[List[List[int]]], text: str
 ):
+    return "".join(replace_coref_tokens(doc, clusters, text))
+
+
+def replace_coref_tokens(
+    doc: spacy.tokens.Doc, clusters: List[List[List[int]]], text: str
+) -> List[str]:
+    """What each token of ``doc`` (with its whitespace) is rewritten to."""
     resolved = [token.text_with_ws for token in doc]
     all_spans = [span for cluster in clusters for span in cluster]
 
@@ -106,7 +165,7 @@ def improved_replace_corefs(
             ):
                 replace_coref_span(doc, coref, resolved, mention_span)
 
-    return "".join(resolved)
+    return resolved
 
 
 def detect_and_translate_to_english(text: str) -> str:
@@ -123,21 +182,100 @@ def detect_and_translate_to_english(text: str) -> str:
         return text
 
 
-def resolve_coreferences(text: str) -> str:
-    doc = nlp(text)
+def resolve_coreference_tokens(text: str, nlp=None):
+    """Parse ``text`` once; return the doc and its coref-resolved tokens."""
+    doc = (nlp or registry.get("spacy"))(text)
     clusters = get_fastcoref_clusters(doc, text)
-    return improved_replace_corefs(doc, clusters, text)
+    return doc, replace_coref_tokens(doc, clusters, text)
+
+
+def resolve_coreferences(text: str, nlp=None) -> str:
+    return "".join(resolve_coreference_tokens(text, nlp)[1])
+
+
+DIALOGUE = re.compile(r'(["“\']).*?\1')
+RUN_OF_SPACES = re.compile(r"\s{2,}")
 
 
 def remove_dialogues(text: str) -> str:
-    text = re.sub(r'(["“\']).*?\1', "", text)
-    text = re.sub(r"\s{2,}", " ", text)
+    text = DIALOGUE.sub("", text)
+    text = RUN_OF_SPACES.sub(" ", text)
     return text.strip()
 
 
+def _sub_with_owners(
+    pattern: re.Pattern, replacement: str, text: str, owners: List[int]
+) -> Tuple[str, List[int]]:
+    """``pattern.sub`` that also carries ``owners`` (one entry per character)
+    along; inserted characters belong to the start of their match."""
+    parts, kept, pos = [], [], 0
+    for match in pattern.finditer(text):
+        parts += [text[pos : match.start()], replacement]
+        kept += owners[pos : match.start()] + [owners[match.start()]] * len(replacement)
+        pos = match.end()
+    parts.append(text[pos:])
+    kept += owners[pos:]
+    return "".join(parts), kept
+
+
+def project_sentences(doc: spacy.tokens.Doc, resolved: List[str], nlp) -> List[str]:
+    """Split the resolved story without dialogue along the sentences of ``doc``.
+
+    ``resolved[i]`` is what token ``i`` of ``doc`` was rewritten to. Every
+    character remembers the sentence its token was in through dialogue
+    removal, so the boundaries of the first parse still apply. Only where a
+    removed quote spanned several sentences are those joined and parsed
+    again with ``nlp``.
+    """
+    sentence_of = [0] * len(doc)
+    sentences = list(doc.sents)
+    for num, sent in enumerate(sentences):
+        sentence_of[sent.start : sent.end] = [num] * (sent.end - sent.start)
+
+    text = "".join(resolved)
+    owners = [sentence_of[i] for i, piece in enumerate(resolved) for _ in piece]
+
+    # Sentences a quote runs across end up in one group.
+    group = list(range(len(sentences)))
+    for match in DIALOGUE.finditer(text):
+        first, last = owners[match.start()], owners[match.end() - 1]
+        for num in range(first + 1, last + 1):
+            group[num] = group[first]
+    owners = [group[owner] for owner in owners]
+
+    text, owners = _sub_with_owners(DIALOGUE, "", text, owners)
+    text, owners = _sub_with_owners(RUN_OF_SPACES, " ", text, owners)
+
+    result = []
+    start = 0
+    for end in range(1, len(text) + 1):
+        if end < len(text) and owners[end] == owners[start]:
+            continue
+        segment = text[start:end].strip()
+        if segment and group.count(owners[start]) > 1:
+            result += [sent.text.strip() for sent in nlp(segment).sents]
+        elif segment:
+            result.append(segment)
+        start = end
+    return [sentence for sentence in result if sentence]
+
+
+def split_sentences(text: str, nlp=None) -> List[str]:
+    if nlp is None:
+        nlp = registry.get("spacy" if COREF_ENABLED else "spacy_senter")
+    return [sent.text.strip() for sent in nlp(text).sents]
+
+
 def get_resolved_sentences(text: str) -> List[str]:
-    text = detect_and_translate_to_english(text)
-    resolved_text = resolve_coreferences(text)
-    no_dialogue_text = remove_dialogues(resolved_text)
-    resolved_doc = nlp(no_dialogue_text)
-    return [sent.text.strip() for sent in resolved_doc.sents]
+    with stage("translate"):
+        text = detect_and_translate_to_english(text)
+    if not COREF_ENABLED:
+        with stage("sentence_split"):
+            return split_sentences(remove_dialogues(text))
+
+    # The coref parse also provides the sentence boundaries, so the
+    # rewritten story is not parsed a second time.
+    with stage("coref"):
+        doc, resolved = resolve_coreference_tokens(text)
+    with stage("sentence_split"):
+        return project_sentences(doc, resolved, registry.get("spacy"))
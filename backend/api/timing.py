@@ -0,0 +1,56 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+# Where the current story's stage timings are collected, if anywhere.
+_collector: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar(
+    "stage_collector", default=None
+)
+
+# Called with (stage, seconds) for every finished stage, e.g. by metrics.
+_listeners: List[Callable[[str, float], None]] = []
+
+# Called with (stage, exception) for every stage that raised.
+_failure_listeners: List[Callable[[str, BaseException], None]] = []
+
+
+def add_listener(listener: Callable[[str, float], None]):
+    _listeners.append(listener)
+
+
+def add_failure_listener(listener: Callable[[str, BaseException], None]):
+    _failure_listeners.append(listener)
+
+
+def record(name: str, seconds: float):
+    collector = _collector.get()
+    if collector is not None:
+        collector.setdefault(name, []).append(seconds)
+    for listener in _listeners:
+        listener(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Time one stage of the generation path (translate, diffusion, upload...)."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        for listener in _failure_listeners:
+            listener(name, e)
+        raise
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_stages():
+    """Collect every stage timed inside the block into ``{stage: [seconds]}``."""
+    timings: Dict[str, List[float]] = {}
+    token = _collector.set(timings)
+    try:
+        yield timings
+    finally:
+        _collector.reset(token)
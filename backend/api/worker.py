@@ -0,0 +1,370 @@
+"""Generation worker.
+
+Owns the diffusion pipelines and processes jobs that the API enqueues in the
+``generation_jobs`` table. Run one per GPU host::
+
+    python worker.py
+
+To use several GPUs from one process, set ``GENERATION_REPLICAS`` and
+``GENERATION_DEVICES`` and pass ``--concurrency``. CPU hosts can instead run
+several worker processes; they share the queue safely.
+
+``PIPELINE_MODE=optimized`` compiles the pipelines and warms every render
+size up before the first job; compiled kernels are cached on disk under
+``PIPELINE_CACHE_DIR`` for the next start.
+"""
+
+import argparse
+import contextlib
+import os
+import threading
+import time
+import traceback
+from io import BytesIO
+
+from PIL import Image
+
+import models
+from database import SessionLocal, engine
+from migrations import migrate
+from batching import REGENERATE_BATCH_WINDOW, REGENERATE_MAX_BATCH
+from generation_backend import PIPELINE_CACHE_DIR, PIPELINE_MODE
+import metrics
+from job_queue import (
+    JobCancelled,
+    claim_job,
+    claim_jobs,
+    complete_job,
+    fail_job,
+    requeue_stale_jobs,
+    touch_jobs,
+)
+
+# Jobs one worker process runs at once.
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+
+# Port of the worker's Prometheus /metrics endpoint; 0 disables it.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# Seconds between heartbeats of running jobs; well below STALE_JOB_SECONDS.
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "30"))
+
+
+def run_job(job: models.GenerationJob) -> dict:
+    # Imported here so the pipelines are only loaded in the worker process.
+    from batch_generator import (
+        generate_batch_images,
+        generate_single_image,
+        finalize_images,
+    )
+
+    payload = job.payload or {}
+
+    if job.kind == "batch":
+        generate_batch_images(
+            payload["story"],
+            job.storyboard_id,
+            payload.get("resolution", "1:1"),
+            payload.get("seed"),
+            job_id=job.id,
+            draft=payload.get("draft", False),
+        )
+        return {"storyboard_id": job.storyboard_id}
+
+    if job.kind == "single":
+        db_image = generate_single_image(**single_request(job))
+        return {"image_id": db_image.id, "image_path": db_image.image_path}
+
+    if job.kind == "finalize":
+        images = finalize_images(
+            payload["panels"], payload.get("resolution", "1:1"), job_id=job.id
+        )
+        return {"storyboard_id": job.storyboard_id, "images": images}
+
+    raise ValueError(f"Unknown job kind: {job.kind}")
+
+
+def single_request(job: models.GenerationJob) -> dict:
+    payload = job.payload or {}
+    return {
+        "image_id": payload["image_id"],
+        "caption": payload["caption"],
+        "seed": payload.get("seed"),
+        "resolution": payload.get("resolution", "1:1"),
+        "isOpenPose": payload.get("isOpenPose", False),
+        "pose_img": Image.open(BytesIO(job.pose_image)) if job.pose_image else None,
+        "job_id": job.id,
+        "pose_id": payload.get("pose_id"),
+        "draft": payload.get("draft", False),
+        "mode": payload.get("mode", "generate"),
+        "strength": payload.get("strength"),
+    }
+
+
+def collect_single_jobs(
+    db, first: models.GenerationJob, window: float, max_batch: int
+) -> list:
+    """Claim queued regenerations compatible with ``first``.
+
+    Keeps claiming until ``max_batch`` jobs are held or ``window`` seconds
+    have passed since ``first`` was claimed.
+    """
+    jobs = [first]
+    if not first.batch_key:
+        return jobs
+
+    deadline = time.monotonic() + window
+    while len(jobs) < max_batch:
+        jobs += claim_jobs(db, first.batch_key, max_batch - len(jobs))
+        remaining = deadline - time.monotonic()
+        if len(jobs) >= max_batch or remaining <= 0:
+            break
+        time.sleep(min(remaining, 0.01))
+    return jobs
+
+
+def run_single_jobs(db, jobs: list):
+    """Run compatible regenerations as one batch and finish each job."""
+    from batch_generator import generate_single_images
+
+    print(f"[Info] Regenerating {len(jobs)} images in one batch")
+    started = time.monotonic()
+    try:
+        results = generate_single_images([single_request(job) for job in jobs])
+    except Exception as e:
+        traceback.print_exc()
+        results = [e] * len(jobs)
+
+    if any(isinstance(result, JobCancelled) for result in results):
+        release_memory()
+
+    seconds = time.monotonic() - started
+    for job, result in zip(jobs, results):
+        if isinstance(result, JobCancelled):
+            print(f"[Info] Job {job.id} was cancelled")
+            metrics.observe_job(job, "cancelled", seconds)
+        elif isinstance(result, Exception):
+            fail_job(db, job, str(result))
+            metrics.observe_job(job, "failed", seconds)
+        else:
+            complete_job(
+                db, job, {"image_id": result.id, "image_path": result.image_path}
+            )
+            metrics.observe_job(job, "completed", seconds)
+
+
+@contextlib.contextmanager
+def heartbeat(job_ids: list, interval: float = HEARTBEAT_INTERVAL):
+    """Keep marking ``job_ids`` alive while the block runs.
+
+    Progress updates also count, but a long first denoising step or a slow
+    upload would otherwise look like a dead worker.
+    """
+    stop = threading.Event()
+
+    def beat():
+        db = SessionLocal()
+        try:
+            while not stop.wait(interval):
+                touch_jobs(db, job_ids)
+        finally:
+            db.close()
+
+    thread = threading.Thread(target=beat, name="heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def release_memory():
+    """Hand back what an abandoned pipeline call was holding."""
+    from generation_backend import get_backend
+
+    get_backend().release_memory()
+
+
+def thread_count(requested: int) -> int:
+    """Job threads to run: at most one per pipeline replica.
+
+    Pipelines are not thread-safe (scheduler state, offload hooks), and only
+    a replica pool gives each call a replica of its own.
+    """
+    from generation_backend import get_backend
+
+    replicas = get_backend().replicas
+    if requested > replicas:
+        print(
+            f"[Info] Running {replicas} job thread(s) instead of {requested}: "
+            "one per pipeline replica (GENERATION_REPLICAS)"
+        )
+    return max(1, min(requested, replicas))
+
+
+def warmup_models():
+    import text_processor
+    from generation_backend import get_backend
+    from model_registry import registry
+
+    get_backend().warmup()
+    registry.warmup(text_processor.NLP_MODELS)
+    for name, state in registry.status().items():
+        if state["loaded"]:
+            print(f"[Info] {name}: loaded in {state['load_seconds']:.1f}s")
+
+    if PIPELINE_MODE == "optimized":
+        warm_start_pipelines()
+
+
+def warm_start_pipelines():
+    """Compile and warm every render size before the first job needs it."""
+    from batch_generator import GUIDANCE_SCALE, NEGATIVE_PROMPT, warmup_plan
+    from generation_backend import get_backend, warm_start
+
+    backend = get_backend()
+    report = warm_start(
+        backend,
+        warmup_plan(backend),
+        NEGATIVE_PROMPT,
+        GUIDANCE_SCALE,
+        report_path=os.path.join(PIPELINE_CACHE_DIR, "warm_start.json"),
+    )
+    for pipeline, warmed in report["pipelines"].items():
+        if warmed["skipped"]:
+            print(f"[Info] {pipeline}: not warmed")
+        for size, timing in warmed["sizes"].items():
+            saved = timing["first_seconds"] - timing["warm_seconds"]
+            print(
+                f"[Info] {pipeline} {size}: first call {timing['first_seconds']:.1f}s, "
+                f"warm {timing['warm_seconds']:.1f}s, "
+                f"{saved:.1f}s saved on the first request"
+            )
+    line = f"[Info] Warm start took {report['startup_seconds']:.1f}s"
+    previous = report["previous_startup_seconds"]
+    if previous is not None:
+        line += f" (previous boot {previous:.1f}s)"
+    print(line)
+    return report
+
+
+def process_next_job(
+    batch_window: float = REGENERATE_BATCH_WINDOW,
+    max_batch: int = REGENERATE_MAX_BATCH,
+) -> bool:
+    """Claim and run one job. Returns False when the queue is empty."""
+    db = SessionLocal()
+    try:
+        # Jobs of a worker that died are picked up again from their progress.
+        requeue_stale_jobs(db)
+        job = claim_job(db)
+        if job is None:
+            return False
+
+        if job.kind == "single" and max_batch > 1:
+            jobs = collect_single_jobs(db, job, batch_window, max_batch)
+            for claimed in jobs:
+                metrics.observe_queue_wait(claimed)
+            with heartbeat([claimed.id for claimed in jobs]):
+                run_single_jobs(db, jobs)
+            return True
+
+        print(f"[Info] Running {job.kind} job {job.id}")
+        metrics.observe_queue_wait(job)
+        started = time.monotonic()
+        try:
+            with heartbeat([job.id]):
+                result = run_job(job)
+        except JobCancelled:
+            print(f"[Info] Job {job.id} was cancelled")
+            release_memory()
+            status = "cancelled"
+        except Exception as e:
+            traceback.print_exc()
+            fail_job(db, job, str(e))
+            status = "failed"
+        else:
+            complete_job(db, job, result)
+            status = "completed"
+        metrics.observe_job(job, status, time.monotonic() - started)
+        return True
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SceneWeaver generation worker")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Seconds to wait before polling an empty queue again",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Drain the queue and exit"
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="Load every model before claiming the first job "
+        "(always on with PIPELINE_MODE=optimized)",
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=REGENERATE_BATCH_WINDOW,
+        help="Seconds to wait for compatible regenerations to batch together",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=REGENERATE_MAX_BATCH,
+        help="Most regenerations to run in one pipeline call",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=WORKER_CONCURRENCY,
+        help="Jobs to run at once, at most one per GENERATION_REPLICAS",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=WORKER_METRICS_PORT,
+        help="Serve Prometheus metrics on this port (0 disables)",
+    )
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    migrate(engine)
+
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+        print(f"[Info] Serving metrics on :{args.metrics_port}/metrics")
+
+    if args.warmup or PIPELINE_MODE == "optimized":
+        warmup_models()
+
+    def loop():
+        while True:
+            if process_next_job(args.batch_window, args.max_batch):
+                continue
+            if args.once:
+                break
+            time.sleep(args.poll_interval)
+
+    # Each thread claims its own jobs; with a replica pool they render on
+    # different replicas at the same time.
+    threads = [
+        threading.Thread(target=loop, name=f"worker-{num}")
+        for num in range(thread_count(args.concurrency))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()